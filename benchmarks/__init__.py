@@ -0,0 +1,6 @@
+"""
+benchmarks - synthetic workbooks and timing runs for sheet_stats.py
+
+    python -m benchmarks.generate --rows 100000 --cols 400 big.xlsx
+    python -m benchmarks.run --baseline baseline.json
+"""
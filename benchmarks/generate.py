@@ -0,0 +1,246 @@
+"""
+generate.py - write synthetic .xlsx (and matching .csv) files for
+benchmarking and testing sheet_stats.py
+
+The .xlsx is written directly as XML, so files of any size can be
+made quickly, with control over the kinds of cells present:
+
+ - numbers, as plain <v> numeric cells
+ - numbers stored as text in the shared strings table
+ - blanks, cells left out
+ - bad values, text like 'n/a' in the shared strings table
+"""
+
+import argparse
+import csv
+import os
+import random
+import sys
+import tempfile
+import zipfile
+
+PYTHON_2 = sys.version_info[0] < 3
+
+BAD_VALUES = ['n/a', '--', '.', 'see notes', '12.3.2']
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+{sheets}
+<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>"""
+CONTENT_TYPE_SHEET = """<Override PartName="/xl/worksheets/sheet{n}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>"""
+
+PACKAGE_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>{sheets}</sheets>
+</workbook>"""
+WORKBOOK_SHEET = """<sheet name="Sheet{n}" sheetId="{n}" r:id="rId{n}"/>"""
+
+WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+{sheets}
+<Relationship Id="rIdStrings" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" Target="sharedStrings.xml"/>
+<Relationship Id="rIdStyles" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+WORKBOOK_RELS_SHEET = """<Relationship Id="rId{n}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{n}.xml"/>"""
+
+STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="1"><font><sz val="10"/><name val="Arial"/></font></fonts>
+<fills count="1"><fill><patternFill patternType="none"/></fill></fills>
+<borders count="1"><border/></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>"""
+
+SHEET_START = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<dimension ref="A1:{last}"/><sheetData>"""
+SHEET_END = """</sheetData></worksheet>"""
+
+def column_letters(index):
+    """column_letters - 0 based column index to letters, 0 -> 'A'
+
+    :param int index: column index
+    :return: str letters
+    """
+    letters = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+def xml_escape(text):
+    """xml_escape - escape text for XML content"""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def make_values(rows, cols, blank=0.05, bad=0.01, strings=0.0, seed=0):
+    """make_values - generator - rows of synthetic values
+
+    Each value is None (blank), a float, or a (str, is_bad) tuple for
+    text, either a number stored as text, or a bad value.
+
+    :param int rows: number of data rows
+    :param int cols: number of columns
+    :param float blank: fraction of cells left blank
+    :param float bad: fraction of cells with non-numeric text
+    :param float strings: fraction of numbers stored as text
+    :param int seed: random seed, the same seed gives the same values
+    """
+    rand = random.Random(seed)
+    for row_n in range(rows):
+        row = []
+        for col_n in range(cols):
+            pick = rand.random()
+            if pick < blank:
+                row.append(None)
+            elif pick < blank + bad:
+                row.append((rand.choice(BAD_VALUES), True))
+            else:
+                x = round(rand.gauss(col_n, 1 + col_n / 10.), 6)
+                if rand.random() < strings:
+                    row.append((repr(x), False))
+                else:
+                    row.append(x)
+        yield row
+
+def write_sheet(out, values, cols, rows, strings):
+    """write_sheet - write worksheet XML
+
+    :param file out: binary file to write to
+    :param iterable values: from make_values()
+    :param int cols: number of columns
+    :param int rows: number of data rows
+    :param dict strings: shared string -> index, updated
+    """
+    letters = [column_letters(i) for i in range(cols)]
+
+    def index(text):
+        if text not in strings:
+            strings[text] = len(strings)
+        return strings[text]
+
+    out.write(SHEET_START.format(last="%s%d" % (letters[-1], rows+1)).encode('utf-8'))
+    out.write(b'<row r="1">')
+    for col_n in range(cols):
+        out.write(('<c r="%s1" t="s"><v>%d</v></c>' % (
+            letters[col_n], index("c%d" % col_n))).encode('utf-8'))
+    out.write(b'</row>')
+    for row_n, row in enumerate(values, start=2):
+        cells = ['<row r="%d">' % row_n]
+        for letter, value in zip(letters, row):
+            if value is None:
+                continue
+            if isinstance(value, tuple):
+                cells.append('<c r="%s%d" t="s"><v>%d</v></c>' % (
+                    letter, row_n, index(value[0])))
+            else:
+                cells.append('<c r="%s%d"><v>%r</v></c>' % (letter, row_n, value))
+        cells.append('</row>')
+        out.write(''.join(cells).encode('utf-8'))
+    out.write(SHEET_END.encode('utf-8'))
+
+def generate(path, rows=1000, cols=20, blank=0.05, bad=0.01, strings=0.0,
+             seed=0, csv_path=None, sheets=1):
+    """generate - write a synthetic .xlsx file, and optionally the same
+    values as a .csv file
+
+    :param str path: .xlsx file to write
+    :param int rows: number of data rows
+    :param int cols: number of columns
+    :param float blank: fraction of cells left blank
+    :param float bad: fraction of cells with non-numeric text
+    :param float strings: fraction of numbers stored as shared strings
+    :param int seed: random seed
+    :param str csv_path: .csv file to write, for the first sheet
+    :param int sheets: number of sheets, each with different values
+    """
+    strings_index = {}
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for sheet_n in range(1, sheets+1):
+            values = make_values(rows, cols, blank, bad, strings, seed+sheet_n-1)
+            if csv_path and sheet_n == 1:
+                values = _tee_csv(values, cols, csv_path)
+            # zipfile can't stream writes in Python 2, so use a temp. file
+            handle, temp_path = tempfile.mkstemp(suffix='.xml')
+            try:
+                with os.fdopen(handle, 'wb') as out:
+                    write_sheet(out, values, cols, rows, strings_index)
+                archive.write(temp_path, 'xl/worksheets/sheet%d.xml' % sheet_n)
+            finally:
+                os.remove(temp_path)
+        numbers = range(1, sheets+1)
+        archive.writestr('[Content_Types].xml', CONTENT_TYPES.format(
+            sheets=''.join(CONTENT_TYPE_SHEET.format(n=n) for n in numbers)))
+        archive.writestr('_rels/.rels', PACKAGE_RELS)
+        archive.writestr('xl/workbook.xml', WORKBOOK.format(
+            sheets=''.join(WORKBOOK_SHEET.format(n=n) for n in numbers)))
+        archive.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS.format(
+            sheets=''.join(WORKBOOK_RELS_SHEET.format(n=n) for n in numbers)))
+        archive.writestr('xl/styles.xml', STYLES)
+        ordered = sorted(strings_index, key=strings_index.get)
+        archive.writestr('xl/sharedStrings.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'uniqueCount="%d">' % len(ordered) +
+            ''.join('<si><t>%s</t></si>' % xml_escape(i) for i in ordered) +
+            '</sst>'
+        ).encode('utf-8'))
+
+def _tee_csv(values, cols, csv_path):
+    """_tee_csv - generator - pass values through, writing them to CSV"""
+    if PYTHON_2:
+        out = open(csv_path, 'wb')
+    else:
+        out = open(csv_path, 'w', newline='')
+    with out:
+        writer = csv.writer(out)
+        writer.writerow(["c%d" % i for i in range(cols)])
+        for row in values:
+            writer.writerow([
+                '' if value is None else
+                value[0] if isinstance(value, tuple) else repr(value)
+                for value in row
+            ])
+            yield row
+
+def make_parser():
+    """build an argparse.ArgumentParser"""
+    parser = argparse.ArgumentParser(
+        description="""Write synthetic .xlsx files for benchmarking""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('path', help=".xlsx file to write")
+    parser.add_argument('--rows', type=int, default=1000, help="Data rows")
+    parser.add_argument('--cols', type=int, default=20, help="Columns")
+    parser.add_argument('--blank', type=float, default=0.05,
+        help="Fraction of cells left blank")
+    parser.add_argument('--bad', type=float, default=0.01,
+        help="Fraction of cells with non-numeric text")
+    parser.add_argument('--strings', type=float, default=0.0,
+        help="Fraction of numbers stored as shared strings")
+    parser.add_argument('--sheets', type=int, default=1, help="Sheets")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    parser.add_argument('--csv', metavar='FILE',
+        help="Also write the first sheet's values to FILE")
+    return parser
+
+def main():
+    opt = make_parser().parse_args()
+    generate(opt.path, rows=opt.rows, cols=opt.cols, blank=opt.blank,
+             bad=opt.bad, strings=opt.strings, seed=opt.seed,
+             csv_path=opt.csv, sheets=opt.sheets)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+run.py - time sheet_stats.py over synthetic workbooks, for each engine
+and pool configuration, and compare with a saved baseline
+
+    python -m benchmarks.run --jobs 1,2,4 --output results.json
+    python -m benchmarks.run --baseline results.json --threshold 0.2
+
+Exits with status 1 if any configuration's rows / second falls more
+than --threshold below the baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from itertools import product
+
+import sheet_stats
+from benchmarks.generate import generate
+
+def int_list(text):
+    """int_list - "1,2,4" -> [1, 2, 4], for argparse"""
+    return [int(i) for i in text.split(',') if i.strip()]
+
+def make_parser():
+    """build an argparse.ArgumentParser"""
+    parser = argparse.ArgumentParser(
+        description="""Benchmark sheet_stats.py engines and pool configurations""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--files', type=int, default=4,
+        help="Number of workbooks to generate")
+    parser.add_argument('--rows', type=int, default=5000,
+        help="Data rows per workbook")
+    parser.add_argument('--cols', type=int, default=40,
+        help="Columns per workbook")
+    parser.add_argument('--blank', type=float, default=0.05,
+        help="Fraction of cells left blank")
+    parser.add_argument('--bad', type=float, default=0.01,
+        help="Fraction of cells with non-numeric text")
+    parser.add_argument('--strings', type=float, default=0.1,
+        help="Fraction of numbers stored as shared strings")
+    parser.add_argument('--engines', default=','.join(sheet_stats.ENGINES),
+        help="Engines to run, comma separated")
+    parser.add_argument('--batch', type=int_list, default=[0, 4096],
+        help="--batch values to run, comma separated")
+    parser.add_argument('--jobs', type=int_list, default=[1, 2],
+        help="--jobs values to run, comma separated")
+    parser.add_argument('--shards', type=int_list, default=[1],
+        help="--shards values to run, comma separated")
+    parser.add_argument('--repeat', type=int, default=1,
+        help="Run each configuration this many times, keep the fastest")
+    parser.add_argument('--data', metavar='DIR',
+        help="Keep generated workbooks in DIR, re-using any already there, "
+             "default is a temporary directory")
+    parser.add_argument('--output', metavar='FILE',
+        help="Write results to FILE as JSON")
+    parser.add_argument('--baseline', metavar='FILE',
+        help="Compare with results previously written with --output")
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help="Fail if rows / second is this fraction below the baseline")
+    return parser
+
+def make_files(opt, path):
+    """make_files - generate (or re-use) workbooks for a run
+
+    :param argparse.Namespace opt: options
+    :param str path: folder for workbooks
+    :return: list of file paths
+    """
+    files = []
+    for n in range(opt.files):
+        filepath = os.path.join(path, "bench_%dx%d_%d.xlsx" % (opt.rows, opt.cols, n))
+        if not os.path.exists(filepath):
+            generate(filepath, rows=opt.rows, cols=opt.cols, blank=opt.blank,
+                     bad=opt.bad, strings=opt.strings, seed=n)
+        files.append(filepath)
+    return files
+
+def run_config(files, engine, batch, jobs, shards, metrics):
+    """run_config - run sheet_stats over files once
+
+    :param list files: workbooks
+    :param str engine: --engine
+    :param int batch: --batch
+    :param int jobs: --jobs
+    :param int shards: --shards
+    :param str metrics: file for --metrics
+    :return: dict of results
+    """
+    summary = {}
+    start = time.time()
+    for answer in sheet_stats.get_answers(
+            files=files, engine=engine, batch=batch, jobs=jobs, shards=shards,
+            ordered=False, no_cache=True, metrics=metrics, summary=summary):
+        pass
+    seconds = time.time() - start
+    peak = [0]
+    with open(metrics) as lines:
+        for line in lines:
+            peak.append(json.loads(line).get('peak_rss_mb') or 0)
+    return {
+        'engine': engine,
+        'batch': batch,
+        'jobs': jobs,
+        'shards': shards,
+        'seconds': round(seconds, 3),
+        'rows': summary['rows'],
+        'cells': summary['cells'],
+        'rows_per_sec': round(summary['rows'] / seconds, 1),
+        'cells_per_sec': round(summary['cells'] / seconds, 1),
+        'peak_rss_mb': max(peak),
+    }
+
+def config_name(result):
+    """config_name - key for matching results with the baseline"""
+    return "%(engine)s batch=%(batch)d jobs=%(jobs)d shards=%(shards)d" % result
+
+def compare(results, baseline, threshold):
+    """compare - find regressions against a baseline
+
+    :param list results: from run_config()
+    :param list baseline: results from an earlier run
+    :param float threshold: allowed fractional slowdown
+    :return: list of (name, baseline rows / sec, rows / sec) regressions
+    """
+    before = dict((config_name(i), i) for i in baseline)
+    regressions = []
+    for result in results:
+        old = before.get(config_name(result))
+        if old is None:
+            continue
+        if result['rows_per_sec'] < old['rows_per_sec'] * (1 - threshold):
+            regressions.append((config_name(result), old['rows_per_sec'],
+                                result['rows_per_sec']))
+    return regressions
+
+def main():
+    opt = make_parser().parse_args()
+
+    data = opt.data or tempfile.mkdtemp()
+    if not os.path.exists(data):
+        os.makedirs(data)
+    metrics = os.path.join(data, 'metrics.jsonl')
+    try:
+        files = make_files(opt, data)
+        results = []
+        engines = [i.strip() for i in opt.engines.split(',')]
+        for engine, batch, jobs, shards in product(
+                engines, opt.batch, opt.jobs, opt.shards):
+            runs = [run_config(files, engine, batch, jobs, shards, metrics)
+                    for i in range(max(1, opt.repeat))]
+            results.append(min(runs, key=lambda x: x['seconds']))
+    finally:
+        if opt.data:
+            if os.path.exists(metrics):
+                os.remove(metrics)
+        else:
+            shutil.rmtree(data)
+
+    # scaling, speed relative to jobs=1 for the same engine, batch, shards
+    single = dict(((i['engine'], i['batch'], i['shards']), i['rows_per_sec'])
+                  for i in results if i['jobs'] == 1)
+    for result in results:
+        base = single.get((result['engine'], result['batch'], result['shards']))
+        if base:
+            result['speedup'] = round(result['rows_per_sec'] / base, 2)
+
+    print("\n%-40s %10s %8s %8s" % ('configuration', 'rows/sec', 'MB', 'speedup'))
+    for result in results:
+        print("%-40s %10.0f %8.1f %8s" % (
+            config_name(result), result['rows_per_sec'], result['peak_rss_mb'],
+            result.get('speedup', '')))
+
+    if opt.output:
+        with open(opt.output, 'w') as out:
+            json.dump({
+                'params': dict((k, getattr(opt, k)) for k in
+                    ('files', 'rows', 'cols', 'blank', 'bad', 'strings')),
+                'python': platform.python_version(),
+                'results': results,
+            }, out, indent=2, sort_keys=True)
+
+    if opt.baseline:
+        with open(opt.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)['results'],
+                                  opt.threshold)
+        for name, old, new in regressions:
+            print("REGRESSION %s: %.0f -> %.0f rows/sec" % (name, old, new))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
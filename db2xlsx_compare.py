@@ -4,25 +4,59 @@ db2xlsx_compare.py - compare DB data to XLS files.
 Terry N. Brown, Brown.TerryN@epa.gov, Tue Jan 03 14:49:44 2017
 """
 
+import argparse
 import csv
+import importlib
 import json
+import multiprocessing
 import os
+import re
+import sqlite3
 import sys
+import tempfile
 import textwrap
+import threading
 import time
 from collections import namedtuple, defaultdict
+from contextlib import contextmanager
+from functools import partial
 from hashlib import sha1
+try:
+    from itertools import imap
+except ImportError:  # Python 3
+    imap = map
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+PYTHON_2 = sys.version_info[0] < 3
+if not PYTHON_2:
+    raw_input = input
 
 MatchError = namedtuple("MatchError",
     "survey leg xl_file xl_field db_field stat xl_val db_val")
 
-CLIPBOARD_SQL = True
-if CLIPBOARD_SQL:
-    from PyQt4 import QtGui, QtCore, Qt
-    __app = Qt.QApplication(sys.argv)
+CLIPBOARD_SQL = True  # default --backend clipboard, rather than manual
 
 QUERIES_DIR = 'queries'
 SHEET_STATS = 'd_dba.csv'
+BACKENDS = 'clipboard', 'manual', 'dbapi', 'sqlite'  # --backend choices
+
+# the parts of the nearshore schema the comparison queries use, for the
+# SQLite stand-in, see SQLiteBackend
+NEARSHORE_SCHEMA = """
+create table nearshore.survey (
+    survey_id integer primary key, lake_cd text, begin_date text,
+    end_date text);
+create table nearshore.tow (
+    tow_id integer primary key, survey_id integer, leg_loop integer,
+    DDLat real, DDLong real, Depth real, Design_km real, UTC_Time real);
+create table nearshore.measurement (
+    measure_id integer primary key, measure_name text, sort_order integer);
+create table nearshore.tow_measurement (
+    tow_id integer, measure_id integer, measure_value real);
+"""
 
 LEG_TO_XLSX = {  # map survey legs to XLSX files
     (13, 1): r"d:\large\dba_nearshore_data\GB_Leg1.xlsx",  # 2010
@@ -140,6 +174,9 @@ FIELD_PREC.update({
     'Design_km': 2,
     'UTC_Time': 2,
 })
+# DB field -> its variants, for XLSX_TO_FIELD renamed stats, see sheet_stats_legs()
+FIELD_VARIANTS = {variants[0]: variants for variants in XLSX_TO_FIELD.values()}
+
 # add entries for variants
 for variants in XLSX_TO_FIELD.values():
     FIELD_PREC.update({
@@ -156,55 +193,382 @@ EXTRA_FIELDS = [
     'DDLat', 'DDLong', 'Depth', 'Design_km', 'UTC_Time',
 ]
 
-def run_query(sql):
-    """run_query - request running of SQL, cache results
+# DB fields with the opposite sign to the XLSX files
+NEGATE_FIELDS = ['Depth']
 
-    :param str sql: SQL to execute
-    :return: Oracle JSON export structure
+def make_parser():
+    """build an argparse.ArgumentParser, don't call this directly,
+       call get_options() instead.
     """
+    parser = argparse.ArgumentParser(
+        description="""Compare sheet_stats.py output to DB stats""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('--stats', default=SHEET_STATS, metavar='FILE',
+        help="sheet_stats.py output to compare"
+    )
+    parser.add_argument('--integrated', action='store_true',
+        help="Run sheet_stats.py on the XLSX files, comparing each as "
+             "it finishes, rather than reading --stats"
+    )
+    parser.add_argument('--output', default='match_errors.csv', metavar='FILE',
+        help="Write mismatches to FILE"
+    )
+    parser.add_argument('--backend', choices=BACKENDS,
+        default='clipboard' if CLIPBOARD_SQL else 'manual',
+        help="How to run SQL: by copying it to and results from the "
+             "clipboard, by asking for results to be saved to a file, "
+             "with a DB-API module, see --db-module, or with an SQLite "
+             "stand-in for the DB, see --fixture"
+    )
+    parser.add_argument('--queries', default=QUERIES_DIR, metavar='DIR',
+        help="Folder caching query results, for any --backend"
+    )
+    parser.add_argument('--db-module', metavar='MODULE',
+        help="DB-API module for --backend dbapi, e.g. cx_Oracle"
+    )
+    parser.add_argument('--db-connect', metavar='TEXT',
+        help="Argument for --db-module's connect(), e.g. user/password@host"
+    )
+    parser.add_argument('--pool', type=int, default=4, metavar='N',
+        help="Most DB connections for --backend dbapi / sqlite"
+    )
+    parser.add_argument('--report', action='store_true',
+        help="Print a per-leg report of each field comparison"
+    )
+    parser.add_argument('--jobs', type=int, metavar='N',
+        help="Compare legs in N processes, default 1, or with --integrated, "
+             "run sheet_stats.py in N processes, default is the number of "
+             "available CPUs"
+    )
+    parser.add_argument('--fixture', metavar='FILE',
+        help="JSON {table: [{column: value}]} data for the nearshore "
+             "survey, tow, measurement, and tow_measurement tables, for "
+             "--backend sqlite"
+    )
+
+    return parser
+
+def get_options(args=None):
+    """
+    get_options - use argparse to parse args, and return a
+    argparse.Namespace, possibly with some changes / expansions /
+    validatations.
 
-    clipboard = Qt.QApplication.clipboard()
+    Client code should call this method with args as per sys.argv[1:],
+    rather than calling make_parser() directly.
 
-    if not os.path.exists(QUERIES_DIR):
-        os.mkdir(QUERIES_DIR)
-    sql_hash = sha1(sql).hexdigest()
-    json_path = os.path.join(QUERIES_DIR, sql_hash+'.json')
-    json_path = os.path.abspath(json_path)
-    open(r"d:\scratch\delete\sql.sql", 'w').write(sql)
-    if not os.path.exists(json_path):
-        sql_path = os.path.join(QUERIES_DIR, sql_hash+'.sql')
-        open(sql_path, 'w').write(sql)
-        if CLIPBOARD_SQL:
+    :param [str] args: arguments to parse
+    :return: options with modifications / validations
+    :rtype: argparse.Namespace
+    """
+    opt = make_parser().parse_args(args)
+
+    # modifications / validations go here
+
+    if opt.backend == 'dbapi' and not opt.db_module:
+        print("--backend dbapi needs --db-module")
+        exit(10)
+
+    if opt.jobs is not None and opt.jobs < 1:
+        print("--jobs must be at least 1")
+        exit(10)
+
+    if opt.backend == 'sqlite' and not opt.fixture:
+        print("--backend sqlite needs --fixture")
+        exit(10)
+
+    return opt
+
+def inline_params(sql, params=None):
+    """inline_params - SQL with :name parameters replaced by literals,
+    for backends where a person runs the SQL
+
+    :param str sql: SQL with :name parameters
+    :param dict params: parameter values
+    :return: str SQL
+    """
+    if not params:
+        return sql
+
+    def literal(match):
+        if match.group(1) not in params:
+            return match.group(0)
+        value = params[match.group(1)]
+        if value is None:
+            return 'null'
+        if isinstance(value, (int, float)):
+            return repr(value)
+        return "'%s'" % str(value).replace("'", "''")
+
+    return re.sub(r'(?<!:):(\w+)', literal, sql)
+
+class QueryBackend(object):
+    """Runs SQL against the nearshore DB.  run() returns results in the
+    Oracle JSON export structure, {'items': [{column: value}, ...]},
+    with lower case column names.  See run_query() for caching.
+    """
+    def run(self, sql, params=None):
+        """run - run SQL
+
+        :param str sql: SQL, with :name parameters
+        :param dict params: parameter values
+        :return: {'items': [{column: value}, ...]}
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """close - release resources"""
+        pass
+
+class ClipboardBackend(QueryBackend):
+    """SQL is copied to the clipboard for a person to run, and the JSON
+    output they copy back is the result.  Needs PyQt4, imported when
+    first needed, so cached results can be used without it.
+    """
+    def __init__(self):
+        self.app = None
+
+    def run(self, sql, params=None):
+        sql = inline_params(sql, params)
+        from PyQt4 import Qt
+        if self.app is None:
+            self.app = Qt.QApplication.instance() or Qt.QApplication(sys.argv)
+        clipboard = Qt.QApplication.clipboard()
+        open(r"d:\scratch\delete\sql.sql", 'w').write(sql)
+        Qt.QApplication.processEvents()
+        print("Execute SQL on clipboard, then copy JSON output")
+        clipboard.setText(sql)
+        json_txt = sql
+        while json_txt == sql:
             Qt.QApplication.processEvents()
-            print("Execute SQL on clipboard, then copy JSON output")
-            clipboard.setText(sql)
-            json_txt = sql
-            while json_txt == sql:
-                Qt.QApplication.processEvents()
-                json_txt = str(clipboard.text())
-                time.sleep(0.5)
             json_txt = str(clipboard.text())
-            json.loads(json_txt)  # check it loads
-            open(json_path, 'wb').write(json_txt)
-        else:
-            print("\n\n%s\n\n" % sql)
-            print("Execute SQL and save as '%s'" % json_path)
-            print("Press return to continue")
-            raw_input()
+            time.sleep(0.5)
+        json_txt = str(clipboard.text())
+        return json.loads(json_txt)
+
+class ManualBackend(QueryBackend):
+    """SQL is printed for a person to run and save the JSON output"""
+    def __init__(self, path='query.json'):
+        """
+        :param str path: where the JSON output is saved
+        """
+        self.path = os.path.abspath(path)
+
+    def run(self, sql, params=None):
+        print("\n\n%s\n\n" % inline_params(sql, params))
+        print("Execute SQL and save as '%s'" % self.path)
+        print("Press return to continue")
+        raw_input()
+        with open(self.path) as result:
+            return json.load(result)
+
+class ConnectionPool(object):
+    """Pool of up to size DB-API connections, opened as needed, and
+    shared by threads
+    """
+    def __init__(self, connect, size=4):
+        """
+        :param function connect: returns a new connection
+        :param int size: most connections to open
+        """
+        self.connect = connect
+        self.size = size
+        self.opened = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """connection - context manager, a connection from the pool,
+        waiting for one if size are in use
+        """
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                new = self.opened < self.size
+                if new:
+                    self.opened += 1
+            if new:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self.lock:  # so another call can try again
+                        self.opened -= 1
+                    raise
+            else:
+                conn = self.idle.get()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        """close - close idle connections"""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+            self.opened -= 1
+
+class DBAPIBackend(QueryBackend):
+    """SQL is run with a DB-API module supporting :name parameters, e.g.
+    cx_Oracle or sqlite3, using pooled connections
+    """
+    def __init__(self, connect, size=4):
+        """
+        :param function connect: returns a new connection
+        :param int size: most connections to open
+        """
+        self.pool = ConnectionPool(connect, size)
+
+    def run(self, sql, params=None):
+        # Oracle rejects a trailing ;
+        sql = sql.strip().rstrip(';')
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params or {})
+                columns = [i[0].lower() for i in cursor.description]
+                items = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        return {'items': items}
+
+    def close(self):
+        self.pool.close()
+
+def load_fixture(conn, fixture):
+    """load_fixture - create the NEARSHORE_SCHEMA tables in a database
+    attached as nearshore, and load data into them
+
+    :param conn: sqlite3 connection
+    :param dict fixture: {table: [{column: value}, ...]}
+    """
+    conn.executescript(NEARSHORE_SCHEMA)
+    for table, rows in fixture.items():
+        for row in rows:
+            columns = sorted(row)
+            conn.execute("insert into nearshore.%s (%s) values (%s)" % (
+                table, ', '.join(columns), ', '.join('?' * len(columns))),
+                [row[k] for k in columns])
+    conn.commit()
+
+class SQLiteBackend(DBAPIBackend):
+    """A stand-in for the nearshore DB, an SQLite database loaded from
+    fixture data and attached as nearshore, so the queries run unchanged
+    and comparisons can run unattended, e.g. for tests
+    """
+    def __init__(self, fixture, size=4):
+        """
+        :param fixture: path to JSON fixture data, or the data, see
+            load_fixture()
+        :param int size: most connections to open
+        """
+        if not isinstance(fixture, dict):
+            with open(fixture) as data:
+                fixture = json.load(data)
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        conn = self._connect()
+        load_fixture(conn, fixture)
+        conn.close()
+        DBAPIBackend.__init__(self, self._connect, size)
+
+    def _connect(self):
+        """_connect - a connection with the database attached as nearshore"""
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        conn.execute("attach database ? as nearshore", [self.path])
+        return conn
+
+    def close(self):
+        DBAPIBackend.close(self)
+        os.remove(self.path)
+
+def make_backend(opt):
+    """make_backend - the QueryBackend chosen by options
+
+    :param argparse.Namespace opt: options
+    :return: QueryBackend
+    """
+    if opt.backend == 'clipboard':
+        return ClipboardBackend()
+    if opt.backend == 'manual':
+        return ManualBackend(os.path.join(opt.queries, 'query.json'))
+    if opt.backend == 'sqlite':
+        return SQLiteBackend(opt.fixture, opt.pool)
+    module = importlib.import_module(opt.db_module)
+    connect = partial(module.connect, opt.db_connect) if opt.db_connect else module.connect
+    return DBAPIBackend(connect, opt.pool)
+
+_BACKEND = None  # default backend for run_query()
+
+def run_query(sql, backend=None, params=None, queries_dir=QUERIES_DIR):
+    """run_query - request running of SQL, cache results
+
+    :param str sql: SQL to execute, with :name parameters
+    :param QueryBackend backend: how to run SQL, default as CLIPBOARD_SQL
+    :param dict params: parameter values
+    :param str queries_dir: folder caching results, keyed on sha1 of the
+        SQL (and parameters)
+    :return: Oracle JSON export structure
+    """
+    global _BACKEND
+    if backend is None:
+        if _BACKEND is None:
+            _BACKEND = ClipboardBackend() if CLIPBOARD_SQL else ManualBackend()
+        backend = _BACKEND
+
+    if not os.path.exists(queries_dir):
+        os.mkdir(queries_dir)
+    key = sql
+    if params:
+        key += '\n-- %s' % json.dumps(params, sort_keys=True)
+    sql_hash = sha1(key.encode('utf-8')).hexdigest()
+    json_path = os.path.join(queries_dir, sql_hash+'.json')
+    json_path = os.path.abspath(json_path)
+    if not os.path.exists(json_path):
+        sql_path = os.path.join(queries_dir, sql_hash+'.sql')
+        open(sql_path, 'w').write(inline_params(sql, params))
+        result = backend.run(sql, params)
+        # written after the query succeeds, so a failure isn't cached
+        with open(json_path, 'w') as out:
+            json.dump(result, out, default=str)
     return json.load(open(json_path))
 
-def get_measures():
+def leg_filter(survey=None, leg=None):
+    """leg_filter - where clause and parameters for a survey leg
+
+    :param int survey: survey id, None for all
+    :param int leg: leg id
+    :return: (str where clause, dict parameters)
+    """
+    if survey is None:
+        return '', None
+    return ("where survey_id = :survey and leg_loop = :leg",
+            {'survey': survey, 'leg': leg})
+
+def get_measures(backend=None, survey=None, leg=None, queries_dir=QUERIES_DIR):
     """get_measures - get measures in DB for a leg
 
     Checks that for measures with non-unique names, only one
     is used within a leg (doesn't mean it's the right one, but
     the case where more than one is present is not handled).
 
-    :param int survey: survery id
+    :param QueryBackend backend: see run_query()
+    :param int survey: survery id, None for all surveys
     :param int leg: leg id
+    :param str queries_dir: see run_query()
     :return: dict of dicts
     """
 
+    where, params = leg_filter(survey, leg)
     sql = """
 with measures as (
 select distinct survey_id as survey, leg_loop as leg,
@@ -213,22 +577,28 @@ select distinct survey_id as survey, leg_loop as leg,
        join nearshore.tow using (survey_id)
        join nearshore.tow_measurement using (tow_id)
        join nearshore.measurement using (measure_id)
-)
+%s)
 select /*json*/ survey, leg, measure_name, sort_order,
        count(*) as n
   from measures
  group by survey, leg, measure_name, sort_order
-;"""
+;""" % (where + '\n' if where else '')
 
-    return run_query(sql)
-def get_db_stats():
+    return run_query(sql, backend, params, queries_dir)
+def get_db_stats(backend=None, survey=None, leg=None, queries_dir=QUERIES_DIR):
     """get_db_stats - get field stats from the DB
 
-    :param int survey: survery id
+    :param QueryBackend backend: see run_query()
+    :param int survey: survery id, None for all surveys
     :param int leg: leg id
+    :param str queries_dir: see run_query()
     :return: dict of dicts
     """
 
+    where, params = leg_filter(survey, leg)
+    if where:
+        where = ' ' + where + '\n'
+
     sql = """
 select /*json*/ survey_id as survey, leg_loop as leg,
        measure_name as field,
@@ -238,8 +608,8 @@ select /*json*/ survey_id as survey, leg_loop as leg,
        join nearshore.tow using (survey_id)
        join nearshore.tow_measurement using (tow_id)
        join nearshore.measurement using (measure_id)
- group by survey_id, leg_loop, measure_name
-"""
+{where} group by survey_id, leg_loop, measure_name
+""".format(where=where)
 
     for extra in EXTRA_FIELDS:
         sql += """
@@ -250,13 +620,13 @@ select /*json*/ survey_id as survey, leg_loop as leg,
        min({extra}) as min, max({extra}) as max
   from nearshore.survey
        join nearshore.tow using (survey_id)
- group by survey_id, leg_loop
+{where} group by survey_id, leg_loop
 
-""".format(extra=extra)
+""".format(extra=extra, where=where)
 
     # return {i['field']:i for i in run_query(sql)['items']}
 
-    return run_query(sql)
+    return run_query(sql, backend, params, queries_dir)
 def prec_match(a, b, prec, stat):
     """
     prec_match - check a == b at prec decimal places
@@ -276,10 +646,128 @@ def prec_match(a, b, prec, stat):
 
     return abs(a - b) <= pow(10., -prec)
 
-def main():
+def index_items(items, name):
+    """index_items - index query results by survey, leg, and name, so a
+    leg's items are found without scanning all of them
 
-    # read sheet stats
-    reader = csv.reader(open(SHEET_STATS))
+    :param list items: query result items, with survey and leg keys
+    :param str name: key in items of the name, e.g. 'field'
+    :return: ({(survey, leg): {name: item}}, [(survey, leg, name)
+        seen more than once])
+    """
+    index = defaultdict(dict)
+    repeated = []
+    for item in items:
+        leg = index[(item['survey'], item['leg'])]
+        if item[name] in leg:
+            repeated.append((item['survey'], item['leg'], item[name]))
+        leg[item[name]] = item
+    return index, repeated
+
+def compare_leg(task):
+    """compare_leg - compare sheet_stats.py output for a leg's XLSX
+    file with DB stats for the leg, see main()
+
+    :param tuple task: (survey, leg, xl_file, {xl_field: stats},
+        {measure_name: measure}, {field: dbstat}, names), a tuple for
+        Pool.imap(), names is None, or {db_field: XLSX column name} if
+        stats are keyed by DB field, with NEGATE_FIELDS already negated,
+        see sheet_stats_legs()
+    :return: ([MatchError], [str report lines])
+    """
+    survey, leg, xl_file, xlstats, measures, dbstats, names = task
+    mapped = names is not None
+    names = names or {}
+
+    indent = '    '
+    match_errors = []
+    lines = ["%s%s" % (indent*0, xl_file)]
+
+    # find *one* db field for each xl field
+    x2d = {}
+    available = list(measures) + EXTRA_FIELDS
+    for xl_field in xlstats:
+        candidates = XLSX_TO_FIELD.get(xl_field, [])
+        if mapped:
+            candidates = FIELD_VARIANTS.get(xl_field, candidates)
+        if not candidates:
+            raise Exception("No candidates for %s" % xl_field)
+        present = [i for i in candidates if i in available]
+        if len(present) > 1:
+            raise Exception()
+        elif len(present) == 1:
+            x2d[xl_field] = present[0]
+
+    missing = []
+
+    # pre-pass to get sort order
+    ordered = []
+    for xl_field in xlstats:
+        db_field = x2d.get(xl_field)
+        if db_field is not None and db_field in measures:
+            ordered.append((measures[db_field]['sort_order'], xl_field))
+        else:
+            ordered.append((-1, xl_field))
+    ordered.sort()
+
+    for xl_field in [i[1] for i in ordered]:
+        db_field = x2d.get(xl_field)
+        if db_field is None:
+            missing.append(names.get(xl_field, xl_field))
+            continue
+        lines.append("%s %s -> %s:" % (indent*1, names.get(xl_field, xl_field), db_field))
+        dbstat = dict(dbstats[db_field])  # copy, the index is shared
+        if db_field in NEGATE_FIELDS and not mapped:
+            a, b = dbstat['min'], dbstat['max']
+            dbstat['min'], dbstat['max'] = -b, -a
+            dbstat['mean'] *= -1
+        if xlstats[xl_field]['n'] == 1:
+            # work around for sheet_stats.py bug
+            xlstats[xl_field]['mean'] == xlstats[xl_field]['min']
+        prec = FIELD_PREC[db_field]
+        for stat in dbstat:
+            if stat in xlstats[xl_field] and \
+               stat not in SKIP_STATS:
+                a = xlstats[xl_field][stat]
+                b = dbstat[stat]
+                text = "%s%s: %s vs %s" % (indent*2, stat, a, b)
+                if not prec_match(a, b, prec, stat):
+                    text = 'X'+text[1:]
+                    match_errors.append(MatchError(
+                        survey, leg, xl_file, names.get(xl_field, xl_field), db_field,
+                        stat, a, b
+                    ))
+                lines.append(text)
+
+    # things in DB not in Excel
+    missed = [i for i in available if i not in x2d.values()]
+    # show things missing on either end
+    for miss, name in (missing, 'db'), (missed, 'Excel file'):
+        if miss:
+            missing.sort()
+            lines.append("X%sMissing from %s:" % (indent[:-1], name))
+            lines.extend(textwrap.wrap(
+                ' '.join(miss),
+                initial_indent=indent*2,
+                subsequent_indent=indent*2
+            ))
+            for i in miss:
+                match_errors.append(MatchError(
+                    survey, leg, xl_file,
+                    i if name == 'db' else '',
+                    i if name != 'db' else '',
+                    "missing in other", '', ''
+                ))
+
+    return match_errors, lines
+
+def read_stats(path):
+    """read_stats - read sheet_stats.py output
+
+    :param str path: sheet_stats.py output .csv
+    :return: {file: {field: {stat: value}}}
+    """
+    reader = csv.reader(open(path))
     fields = next(reader)
     # CSV as list of dicts
     stats_in = [{k:v for k,v in zip(fields, row)} for row in reader]
@@ -287,128 +775,114 @@ def main():
     xlstats_all = defaultdict(lambda: dict())
     for stat in stats_in:
         xlstats_all[stat['file']][stat['field']] = stat
+    return xlstats_all
+
+def sheet_stats_legs(jobs=None):
+    """sheet_stats_legs - generator - run sheet_stats.py on the
+    LEG_TO_XLSX files, with fields renamed as in XLSX_TO_FIELD and
+    NEGATE_FIELDS negated as they're read, so stats can be compared
+    without a .csv round trip
+
+    :param int jobs: sheet_stats.py processes, None for available CPUs
+    :return: (survey, leg, xl_file, {db_field: {stat: value}},
+        {db_field: XLSX column name}) for each leg as its file finishes,
+        then legs with no file
+    """
+    import sheet_stats  # only needed here
+
+    # XLSX fields with no DB field keep their names
+    renames = sorted(
+        "%s=%s" % (xl_field, variants[0])
+        for xl_field, variants in XLSX_TO_FIELD.items()
+        if variants[0] not in (xl_field, '_NO_CORRESPONDING_MEASURE_')
+    )
+    legs = defaultdict(list)
+    for survey, leg in sorted(LEG_TO_XLSX):
+        legs[LEG_TO_XLSX[(survey, leg)]].append((survey, leg))
+    for answer in sheet_stats.get_answers(
+            files=sorted(legs), rename=renames, negate=NEGATE_FIELDS,
+            jobs=jobs):
+        if answer is None:  # stopped by ./STOP
+            continue
+        rows = sheet_stats.get_table_rows([answer])
+        header = next(rows)
+        xlstats = {i['field']: i for i in (dict(zip(header, row)) for row in rows)}
+        # columns with DB field names, for reports, '+' if several merged
+        names = {k: '+'.join(v) for k, v in answer.get('renamed', {}).items()}
+        for survey, leg in legs.pop(answer['filepath'], []):
+            yield survey, leg, answer['filepath'], xlstats, names
+    for xl_file, file_legs in sorted(legs.items()):
+        for survey, leg in file_legs:
+            yield survey, leg, xl_file, {}, {}
+
+def open_csv(path):
+    """open_csv - open a file for csv.writer"""
+    # csv.writer does its own EOL handling,
+    # see https://docs.python.org/3/library/csv.html#csv.reader
+    if PYTHON_2:
+        return open(path, 'wb')
+    return open(path, 'w', newline='')
+
+def main(args=None):
+    """main() - when invoked directly
+
+    :param [str] args: arguments, default sys.argv[1:]
+    """
 
-    indent = '    '
-    match_errors = []
-    
-    all_measures = get_measures()
-
-    # first, check only one of each measure in each leg
-    leg_measures = defaultdict(lambda: 0)
-    for measure in all_measures['items']:
-        k = measure['survey'], measure['leg'], measure['measure_name']
-        leg_measures[k] += 1
-    bad_measures = {k:v for k,v in leg_measures.items() if v > 1}
-    if bad_measures:
-        for k,v in bad_measures.items():
-            print k, v
-        raise Exception("Ambiguous measures")
-
-    all_dbstats = get_db_stats()
-    
-    # return {i['field']:i for i in run_query(sql)['items']}
-
-    for survey, leg in LEG_TO_XLSX:
-
-        xl_file = LEG_TO_XLSX[(survey, leg)]
-
-        # FIXME, should check some list for things already QA'ed
-
-        print ("%s%s" % (indent*0, xl_file))
-
-        xlstats = xlstats_all[xl_file]
-
-        measures = {
-            measure['measure_name']:measure
-            for measure in all_measures['items']
-            if (measure['survey'], measure['leg']) == (survey, leg)
-        }
-        dbstats = {
-            dbstat['field']:dbstat
-            for dbstat in all_dbstats['items']
-            if (dbstat['survey'], dbstat['leg']) == (survey, leg)
-        }
-
-        # find *one* db field for each xl field
-        x2d = {}
-        available = list(measures) + EXTRA_FIELDS
-        for xl_field in xlstats:
-            candidates = XLSX_TO_FIELD.get(xl_field, [])
-            if not candidates:
-                raise Exception("No candidates for %s" % xl_field)
-            present = [i for i in candidates if i in available]
-            if len(present) > 1:
-                raise Exception()
-            elif len(present) == 1:
-                x2d[xl_field] = present[0]
-
-        missing = []
-
-        # pre-pass to get sort order
-        ordered = []
-        for xl_field in xlstats:
-            db_field = x2d.get(xl_field)
-            if db_field is not None and db_field in measures:
-                ordered.append((measures[db_field]['sort_order'], xl_field))
-            else:
-                ordered.append((-1, xl_field))
-        ordered.sort()
-
-        for xl_field in [i[1] for i in ordered]:
-            db_field = x2d.get(xl_field)
-            if db_field is None:
-                missing.append(xl_field)
-                continue
-            print("%s %s -> %s:" % (indent*1, xl_field, db_field))
-            if db_field == 'Depth':
-                a, b = dbstats[db_field]['min'], dbstats[db_field]['max']
-                dbstats[db_field]['min'], dbstats[db_field]['max'] = -b, -a
-                dbstats[db_field]['mean'] *= -1
-            if xlstats[xl_field]['n'] == 1:
-                # work around for sheet_stats.py bug
-                xlstats[xl_field]['mean'] == xlstats[xl_field]['min']
-            for stat in dbstats[db_field]:
-                if stat in xlstats[xl_field] and \
-                   stat not in SKIP_STATS:
-                    a = xlstats[xl_field][stat]
-                    b = dbstats[db_field][stat]
-                    prec = FIELD_PREC[db_field]
-                    text = "%s%s: %s vs %s" % (indent*2, stat, a, b)
-                    # neg_b = -b if db_field == 'Depth' else b
-                    if not prec_match(a, b, prec, stat):
-                        text = 'X'+text[1:]
-                        match_errors.append(MatchError(
-                            survey, leg, xl_file, xl_field, db_field,
-                            stat, a, b
-                        ))
-                    print(text)
-
-        # things in DB not in Excel
-        missed = [i for i in available if i not in x2d.values()]
-        # show things missing on either end
-        for miss, name in (missing, 'db'), (missed, 'Excel file'):
-            if miss:
-                missing.sort()
-                print("X%sMissing from %s:" % (indent[:-1], name))
-                print('\n'.join(textwrap.wrap(
-                    ' '.join(miss),
-                    initial_indent=indent*2,
-                    subsequent_indent=indent*2
-                )))
-                for i in miss:
-                    match_errors.append(MatchError(
-                        survey, leg, xl_file,
-                        i if name == 'db' else '',
-                        i if name != 'db' else '',
-                        "missing in other", '', ''
-                    ))
-
-    print len(match_errors), "mismatches"
-    writer = csv.writer(open("match_errors.csv", 'wb'))
-    writer.writerow(MatchError._fields)
-    writer.writerows(match_errors)
+    opt = get_options(args)
+    backend = make_backend(opt)
+    try:
+        all_measures = get_measures(backend, queries_dir=opt.queries)
+
+        # first, check only one of each measure in each leg
+        leg_measures, bad_measures = index_items(all_measures['items'], 'measure_name')
+        if bad_measures:
+            for k in sorted(set(bad_measures)):
+                print("%s %d" % (k, bad_measures.count(k) + 1))
+            raise Exception("Ambiguous measures")
+
+        all_dbstats = get_db_stats(backend, queries_dir=opt.queries)
+    finally:
+        backend.close()
+    leg_dbstats = index_items(all_dbstats['items'], 'field')[0]
+
+    # FIXME, should check some list for things already QA'ed
+    if opt.integrated:
+        legs = sheet_stats_legs(opt.jobs)
+    else:
+        xlstats_all = read_stats(opt.stats)
+        legs = (
+            (survey, leg, LEG_TO_XLSX[(survey, leg)],
+             xlstats_all[LEG_TO_XLSX[(survey, leg)]], None)
+            for survey, leg in sorted(LEG_TO_XLSX)
+        )
+    tasks = (
+        (survey, leg, xl_file, xlstats,
+         leg_measures.get((survey, leg), {}),
+         leg_dbstats.get((survey, leg), {}),
+         names)
+        for survey, leg, xl_file, xlstats, names in legs
+    )
+    # with --integrated, --jobs is for sheet_stats.py, comparing is quick
+    pool = None
+    if opt.jobs and opt.jobs > 1 and not opt.integrated:
+        pool = multiprocessing.Pool(opt.jobs)
+    mismatches = 0
+    try:
+        with open_csv(opt.output) as out:
+            writer = csv.writer(out)
+            writer.writerow(MatchError._fields)
+            for match_errors, lines in (pool.imap if pool else imap)(compare_leg, tasks):
+                if opt.report:
+                    print('\n'.join(lines))
+                writer.writerows(match_errors)
+                mismatches += len(match_errors)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    print("%d mismatches" % mismatches)
 
 if __name__ == '__main__':
     main()
-
-
@@ -2,64 +2,446 @@
 @auto scan_xlsx.py - find XLSX fields
 
 Terry N. Brown, terrynbrown@gmail.com, Tue Jan 03 12:11:30 2017
+
+Reads the first row of the first worksheet of each file listed in
+xlsx.lst, stopping as soon as it's read, with a pool of processes.  Each
+result is appended to a JSON lines journal, xlsx.jsonl, so an interrupted
+scan picks up where it stopped, and a file is only scanned again if it
+changes.  Then counts how often each field name is used, and optionally
+updates an SQLite index of field names, which --query searches.
 """
 
+import argparse
 import datetime
+import difflib
 import json
+import multiprocessing
 import os
+import re
+import sqlite3
 import sys
 import zipfile
-from collections import namedtuple, defaultdict
-
-from openpyxl import load_workbook
-
-if os.path.exists("xlsx.json"):
-    xlsx = json.load(open("xlsx.json"))
-else:
-    xlsx = {}
-    
-for line_n, line in enumerate(open("xlsx.lst")):
-    break
-    # xlsx.lst list of all .xlsx files
-    if False and line_n > 10:
-        break
-    if line_n % 10 == 0:
-        json.dump(xlsx, open("xlsx.json", 'w'))
-    line = line.strip()
-    print("%4d %s" % (line_n, line))
-    if line in xlsx:
-        continue
+import zlib
+from collections import defaultdict
+
+from sheet_stats import ElementTree, XLSXReader, available_cpus
+
+PYTHON_2 = sys.version_info[0] < 3
+if not PYTHON_2:
+    unicode = str
+
+# fields recorded for files which can't be read
+BAD_ZIPFILE = "BAD ZIPFILE ERROR ON LOAD"
+BAD_XLSX = "BAD XLSX ERROR ON LOAD"  # a zip, but missing parts or bad XML
+FILE_REMOVED = "FILE REMOVED"
+NO_ROWS = "NO ROWS IN FILE"
+# errors reading a zip which isn't a readable .xlsx file, missing parts,
+# bad XML, corrupt or truncated members, bad cell references or indices
+BAD_XLSX_ERRORS = (KeyError, IndexError, ValueError, EOFError, zlib.error,
+                   ElementTree.ParseError)
+
+NOT_NAME_CHARS = re.compile(r'[\W_]+', re.UNICODE)  # dropped by normalise()
+MATCHES = 'exact', 'prefix', 'fuzzy'  # --match choices
+
+def make_parser():
+    """build an argparse.ArgumentParser, don't call this directly,
+       call get_options() instead.
+    """
+    parser = argparse.ArgumentParser(
+        description="""Count field names in the first rows of .xlsx files""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('--list', default='xlsx.lst', metavar='FILE',
+        help="List of .xlsx files, one per line"
+    )
+    parser.add_argument('--journal', default='xlsx.jsonl', metavar='FILE',
+        help="JSON lines file of fields for each file scanned, appended "
+             "to as files are scanned, files already in it aren't scanned "
+             "again"
+    )
+    parser.add_argument('--json', default='xlsx.json', metavar='FILE',
+        help="Write {file: fields} for all files to FILE as JSON at the "
+             "end, as earlier versions did, '' for none.  If FILE exists "
+             "and --journal doesn't, the journal starts from FILE"
+    )
+    parser.add_argument('--jobs', type=int, default=0, metavar='N',
+        help="Processes to use, 0 for the CPUs available"
+    )
+    parser.add_argument('--index', metavar='FILE',
+        help="SQLite index of field names, updated from --journal after "
+             "scanning, for --query"
+    )
+    parser.add_argument('--query', action='append', metavar='NAME',
+        help="Instead of scanning, list the files in --index with field "
+             "NAME, see --match, repeat for more names"
+    )
+    parser.add_argument('--match', choices=MATCHES, default='fuzzy',
+        help="--query matching: exact names, names starting with NAME "
+             "when normalised (lower case, letters and digits only), or "
+             "fuzzy, names the same as NAME or close when normalised"
+    )
+    parser.add_argument('--files', action='store_true',
+        help="--query lists just the files, one per line, e.g. for "
+             "sheet_stats.py"
+    )
+    parser.add_argument('--mapping', metavar='FIELD',
+        help="--query lists the names found as XLSX_TO_FIELD style "
+             "'name': 'FIELD', entries"
+    )
+
+    return parser
+
+def get_options(args=None):
+    """
+    get_options - use argparse to parse args, and return a
+    argparse.Namespace, possibly with some changes / expansions /
+    validatations.
+
+    Client code should call this method with args as per sys.argv[1:],
+    rather than calling make_parser() directly.
+
+    :param [str] args: arguments to parse
+    :return: options with modifications / validations
+    :rtype: argparse.Namespace
+    """
+    opt = make_parser().parse_args(args)
+
+    # modifications / validations go here
+
+    if opt.query and not opt.index:
+        print("--query needs --index")
+        exit(10)
+
+    return opt
+
+def clean_value(value):
+    """clean_value - a field name as JSON can store it, dates / times as
+    text, text stripped
+
+    :param value: cell value
+    :return: value
+    """
+    if isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+        return str(value)
+    if isinstance(value, (str, unicode)):
+        return value.strip()
+    return value
+
+def read_header(filepath):
+    """read_header - values in the first row of the first worksheet,
+    reading only the start of the worksheet, and shared strings only as
+    far as the row uses them
+
+    :param str filepath: path to .xlsx file
+    :return: list of values, or [BAD_ZIPFILE], [BAD_XLSX], [FILE_REMOVED],
+        or [NO_ROWS]
+    """
     try:
-        book = load_workbook(line, read_only=True)
-        sheets = book.get_sheet_names()
-        sheet = book[sheets[0]]
-        try:
-            row0 = next(sheet.rows)
-            xlsx[line] = [i.value for i in row0]
-            xlsx[line] = [
-                str(i) if isinstance(i, datetime.datetime) else i
-                for i in xlsx[line]
-            ]
-            xlsx[line] = [
-                i.strip() if isinstance(i, (str, unicode)) else i
-                for i in xlsx[line]
-            ]
-        except StopIteration:
-            xlsx[line] = ["NO ROWS IN FILE"]
+        reader = XLSXReader(filepath, stream_strings=True)
     except zipfile.BadZipfile:
-        xlsx[line] = ["BAD ZIPFILE ERROR ON LOAD"]
+        return [BAD_ZIPFILE]
+    except BAD_XLSX_ERRORS:
+        return [BAD_XLSX]
     except IOError:
-        xlsx[line] = ["FILE REMOVED"]
+        return [FILE_REMOVED]
+    try:
+        if not reader.sheets:
+            return [NO_ROWS]
+        rows = reader.rows(0)
+        try:
+            row = next(rows, None)
+        finally:
+            rows.close()
+    except zipfile.BadZipfile:  # e.g. CRC errors reading the worksheet
+        return [BAD_ZIPFILE]
+    except BAD_XLSX_ERRORS:
+        return [BAD_XLSX]
+    finally:
+        reader.close()
+    if row is None:
+        return [NO_ROWS]
+    return [clean_value(i) for i in row]
+
+def file_state(filepath):
+    """file_state - modification time and size of a file, to see if it's
+    changed since it was scanned
+
+    :param str filepath: path to file
+    :return: (mtime, size), (None, None) if it doesn't exist
+    """
+    try:
+        info = os.stat(filepath)
+    except OSError:
+        return None, None
+    return info.st_mtime, info.st_size
+
+def scan_file(filepath):
+    """scan_file - read_header() for the processor pool
+
+    :param str filepath: path to .xlsx file
+    :return: journal entry, dict with file, fields, mtime, and size
+    """
+    mtime, size = file_state(filepath)
+    return {'file': filepath, 'fields': read_header(filepath),
+            'mtime': mtime, 'size': size}
+
+def read_list(path):
+    """read_list - files listed in path, one per line, without repeats
+
+    :param str path: path to list
+    :return: list of paths
+    """
+    files = []
+    seen = set()
+    with open(path) as lines:
+        for line in lines:
+            if PYTHON_2:
+                line = line.decode('utf-8')
+            line = line.strip()
+            if line and line not in seen:
+                seen.add(line)
+                files.append(line)
+    return files
+
+def read_journal(path):
+    """read_journal - results recorded in a journal, the latest for files
+    scanned more than once
+
+    :param str path: path to journal
+    :return: {filepath: journal entry}, see scan_file()
+    """
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path) as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # partly written by an interrupted scan
+                continue
+            results[entry['file']] = entry
+    return results
+
+def open_journal(path):
+    """open_journal - open a journal for appending, after finishing any
+    line partly written by an interrupted scan
+
+    :param str path: path to journal
+    :return: open file
+    """
+    partial = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as existing:
+            existing.seek(-1, os.SEEK_END)
+            partial = existing.read(1) != b'\n'
+    journal = open(path, 'a')
+    if partial:
+        journal.write('\n')
+    return journal
+
+def write_entry(journal, entry):
+    """write_entry - append a result to a journal
+
+    :param file journal: from open_journal()
+    :param dict entry: from scan_file()
+    """
+    journal.write(json.dumps(entry, sort_keys=True) + '\n')
+    journal.flush()
+
+def scan(files, journal_path, jobs=0):
+    """scan - read_header() for files not in the journal, or changed since
+    they were scanned, in parallel, recording each result in the journal
+    as it's finished
+
+    :param list files: paths to .xlsx files
+    :param str journal_path: path to journal
+    :param int jobs: processes to use, 0 for the CPUs available
+    :return: {filepath: journal entry} for all files in the journal
+    """
+    results = read_journal(journal_path)
+    todo = [
+        i for i in files if i not in results
+        or file_state(i) != (results[i].get('mtime'), results[i].get('size'))
+    ]
+    if not todo:
+        return results
+    pool = multiprocessing.Pool(jobs or available_cpus())
+    completed = False
+    try:
+        with open_journal(journal_path) as journal:
+            for line_n, entry in enumerate(pool.imap_unordered(scan_file, todo)):
+                print("%4d %s" % (line_n, entry['file']))
+                results[entry['file']] = entry
+                write_entry(journal, entry)
+        completed = True
+    finally:
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+    return results
+
+def normalise(name):
+    """normalise - a field name for matching, lower case letters and
+    digits only, so 'ZugDW', 'Zug_DW', and 'zug dw' are the same
+
+    :param name: field name
+    :return: str
+    """
+    return NOT_NAME_CHARS.sub('', unicode(name).lower())
+
+class HeaderIndex(object):
+    """Inverted index of field names in an SQLite file, normalised name ->
+    (file, column position, file mtime), updated from scan() results.
+    Only files which have changed since they were indexed are updated.
+    """
+    def __init__(self, path):
+        """
+        :param str path: path to SQLite file
+        """
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            create table if not exists file (
+                id integer primary key, path text unique, mtime real,
+                size integer);
+            create table if not exists field (
+                norm text, name text, file integer, position integer);
+            create index if not exists field_norm on field (norm);
+            create index if not exists field_name on field (name);
+            create index if not exists field_file on field (file);
+            -- distinct normalised names, for fuzzy matching
+            create table if not exists norm (norm text primary key);
+        """)
+
+    def update(self, entries):
+        """update - index files which are new or have changed
+
+        :param list entries: journal entries, see scan_file()
+        :return: int number of files updated
+        """
+        known = {path: (file_id, mtime, size) for file_id, path, mtime, size
+                 in self.db.execute("select id, path, mtime, size from file")}
+        updated = 0
+        for entry in entries:
+            filepath = entry['file']
+            state = entry.get('mtime'), entry.get('size')
+            if filepath in known:
+                file_id, mtime, size = known[filepath]
+                if (mtime, size) == state:
+                    continue
+                self.db.execute("delete from field where file = ?", [file_id])
+                self.db.execute("update file set mtime = ?, size = ? where id = ?",
+                                [state[0], state[1], file_id])
+            else:
+                file_id = self.db.execute(
+                    "insert into file (path, mtime, size) values (?, ?, ?)",
+                    [filepath, state[0], state[1]]).lastrowid
+            fields = entry['fields']
+            if fields not in ([BAD_ZIPFILE], [BAD_XLSX], [FILE_REMOVED], [NO_ROWS]):
+                rows = [(normalise(name), unicode(name), file_id, position)
+                        for position, name in enumerate(fields) if name is not None]
+                self.db.executemany("insert into field values (?, ?, ?, ?)", rows)
+                self.db.executemany("insert or ignore into norm values (?)",
+                                    [row[:1] for row in rows])
+            updated += 1
+        self.db.commit()
+        return updated
+
+    def query(self, name, match='fuzzy'):
+        """query - files with a field name
+
+        :param str name: field name
+        :param str match: 'exact', 'prefix', or 'fuzzy', see --match
+        :return: list of (name, path, position, mtime)
+        """
+        select = """select name, path, position, mtime
+                      from field join file on (file.id = field.file) where """
+        if match == 'exact':
+            rows = self.db.execute(select + "name = ?", [name.strip()])
+        elif match == 'prefix':
+            prefix = normalise(name)
+            rows = self.db.execute(select + "norm >= ? and norm < ?",
+                                   [prefix, prefix + u'\uffff'])
+        else:
+            norms = [normalise(name)]
+            norms.extend(i for i in difflib.get_close_matches(
+                norms[0], self.names(), n=10, cutoff=0.8) if i != norms[0])
+            rows = self.db.execute(
+                select + "norm in (%s)" % ','.join('?' * len(norms)), norms)
+        return sorted(rows)
+
+    def names(self):
+        """names - distinct normalised field names, including some which
+        may no longer be used
+
+        :return: list of str
+        """
+        return [i[0] for i in self.db.execute("select norm from norm")]
+
+    def close(self):
+        self.db.close()
+
+def get_query_rows(index, opt):
+    """get_query_rows - generator - output lines for --query
+
+    :param HeaderIndex index: index to search
+    :param argparse.Namespace opt: options
+    :return: str lines
+    """
+    found = []
+    for name in opt.query:
+        found.extend(index.query(name, opt.match))
+    if opt.files:
+        for path in sorted(set(i[1] for i in found)):
+            yield path
+    elif opt.mapping:
+        files = defaultdict(set)
+        for name, path, position, mtime in found:
+            files[name].add(path)
+        for name in sorted(files):
+            yield "    %r: %r,  # %d files" % (name, opt.mapping, len(files[name]))
+    else:
+        for name, path, position, mtime in found:
+            yield "%s\t%d\t%s" % (name, position, path)
+
+def main():
+    """main() - when invoked directly"""
+    opt = get_options()
+
+    if opt.query:
+        index = HeaderIndex(opt.index)
+        for line in get_query_rows(index, opt):
+            print(line)
+        index.close()
+        return
+
+    if opt.json and os.path.exists(opt.json) and not os.path.exists(opt.journal):
+        with open_journal(opt.journal) as journal:
+            for filepath, fields in json.load(open(opt.json)).items():
+                mtime, size = file_state(filepath)  # assume xlsx.json is current
+                write_entry(journal, {'file': filepath, 'fields': fields,
+                                      'mtime': mtime, 'size': size})
+
+    results = scan(read_list(opt.list), opt.journal, opt.jobs)
+    xlsx = {filepath: entry['fields'] for filepath, entry in results.items()}
+    if opt.json:
+        json.dump(xlsx, open(opt.json, 'w'))
+    if opt.index:
+        index = HeaderIndex(opt.index)
+        print("%d files indexed" % index.update(results.values()))
+        index.close()
 
-json.dump(xlsx, open("xlsx.json", 'w'))
+    count = defaultdict(lambda: 0)
 
-        
-count = defaultdict(lambda: 0)
+    for fields in xlsx.values():
+        for field in fields:
+            count[unicode(field).lower().strip()] += 1
 
-for fields in xlsx.values():
-    for field in fields:
-        count[unicode(field).lower().strip()] += 1
+    results = sorted(count.items(), reverse=True, key=lambda x:(x[1],x[0]))
+    for result in results:
+        print("%4d %s" % (result[1], result[0]))
 
-results = sorted(count.items(), reverse=True, key=lambda x:(x[1],x[0]))
-for result in results:
-    print("%4d %s" % (result[1], result[0]))
+if __name__ == '__main__':
+    main()
@@ -14,34 +14,768 @@ Terry N. Brown, terrynbrown@gmail.com, Fri Dec 16 13:20:47 2016
 
 import csv
 import argparse
+import base64
+import cProfile
+import datetime
 import glob
+import json
+import mmap
 import multiprocessing
 import os
+import random
+import re
+import shutil
+import sqlite3
+import struct
 import sys
+import tempfile
 import time
-from collections import namedtuple
-from math import sqrt, isnan
+import zipfile
+from array import array
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+from collections import namedtuple, defaultdict, deque
+from fnmatch import fnmatchcase
+from hashlib import sha1
+from functools import partial
+from math import ceil, erf, exp, floor, isnan, log, sqrt
 NAN = float('NAN')
 
+import numpy as np
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:  # removed in Python 3.9, ElementTree uses C anyway
+    from xml.etree import ElementTree
+
 from openpyxl import load_workbook
 
 PYTHON_2 = sys.version_info[0] < 3
 if not PYTHON_2:
     unicode = str
+    long = int
 
 FIELDS = [  # fields in outout table
-    'file', 'field', 'n', 'blank', 'bad', 'min', 'max', 'mean', 'std',
+    'file', 'sheet', 'field', 'n', 'blank', 'bad', 'min', 'max', 'mean', 'std',
     'sum', 'sumsq', 'variance', 'coefvar'
 ]
 
-class AttrDict(dict):
-    """allow d.attr instead of d['attr']
-    http://stackoverflow.com/a/14620633
+SAMPLE_FIELDS = [  # fields added to output table by --sample / --max-rows
+    'mean_low', 'mean_high', 'sampled', 'estimate'
+]
+
+HISTOGRAM_FIELDS = [  # fields in --histograms table
+    'field', 'lower', 'upper', 'count'
+]
+
+MATRIX_FIELDS = [  # fields in --matrix .csv table
+    'file', 'sheet', 'field', 'field2', 'n', 'covariance', 'correlation'
+]
+
+VALUE_FIELDS = [  # fields in --values table
+    'file', 'sheet', 'field', 'n', 'bad', 'distinct', 'distinct_bad',
+    'value', 'count', 'error'
+]
+
+ENGINES = 'openpyxl', 'xml'  # ways of reading rows, openpyxl is the reference
+SHARD_ROWS = 4096  # rows in each stripe of a file split with --shards
+COMOMENT_ROWS = 4096  # rows per CoMoments update without --batch
+HIST_BUFFER = 1024  # values Histogram.add() buffers for numpy updates
+STATS_ROWS = 1024  # rows per ColumnStats block, see ColumnStats.flush()
+STATS_SMALL = 64  # ColumnStats blocks smaller than this skip numpy
+# bump CACHE_VERSION when a change alters results, to invalidate --cache
+CACHE_VERSION = 6
+# options which alter results, and so are part of --cache keys
+CACHE_OPTIONS = ['engine', 'fields', 'exclude', 'quantiles', 'sketch_k',
+                 'distinct_precision', 'top_k', 'group_by', 'time_column',
+                 'bucket', 'covariance', 'hist_fields', 'hist_edges', 'hist_log',
+                 'hist_bins', 'hist_pilot', 'sample', 'max_rows', 'seed',
+                 'datetimes', 'rename', 'negate']
+# options which alter results only by being set or not, e.g. output paths
+CACHE_FLAGS = ['values', 'buckets', 'matrix', 'histograms']
+# type tag -> (type, strptime() formats of its isoformat()), for header cells
+# which aren't JSON types, e.g. a date as a field name, in --cache entries
+CACHE_TYPES = {
+    'datetime': (datetime.datetime, ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f')),
+    'date': (datetime.date, ('%Y-%m-%d',)),
+    'time': (datetime.time, ('%H:%M:%S', '%H:%M:%S.%f')),
+}
+# zip members which determine results, for --cache keys
+CACHE_MEMBERS = re.compile(r'xl/(worksheets/.*|sharedStrings\.xml|styles\.xml|workbook\.xml)$')
+
+# XML names used by the 'xml' engine
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+DOC_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+ROW_TAG = SHEET_NS+'row'
+VALUE_TAG = SHEET_NS+'v'
+TEXT_TAG = SHEET_NS+'t'
+RUN_TAG = SHEET_NS+'r'
+INLINE_TAG = SHEET_NS+'is'
+SHEET_DATA_TAG = SHEET_NS+'sheetData'
+DIMENSION_TAG = SHEET_NS+'dimension'
+# start of a shared string, <si>, <si/>, or <x:si> with a prefix
+SI_START = re.compile(br'<(?:(\w+):)?si[\s/>]')
+# start of a row, <row ...>, <row/>, or <x:row> with a prefix
+ROW_START = re.compile(br'<(?:\w+:)?row[\s/>]')
+ROW_NUMBER = re.compile(br'\sr=["\'](\d+)')  # in a <row> start tag
+SHEET_DATA_END = re.compile(br'</(?:\w+:)?sheetData>')
+# built in number formats which are dates / times
+DATE_FORMAT_IDS = set(range(14, 23)) | set(range(45, 48))
+# as openpyxl, ignore colors, "literals", and [$locales] when looking for dates
+DATE_FORMAT_STRIP = re.compile(
+    r'\[(BLACK|BLUE|CYAN|GREEN|MAGENTA|RED|WHITE|YELLOW)\]|"[^"]+"|\[\$[^\]]+\]',
+    re.IGNORECASE + re.UNICODE
+)
+
+def cast_number(text):
+    """cast_number - convert <v> text to an int or float, as openpyxl does
+
+    :param str text: text of a numeric cell
+    :return: int or float
+    """
+    if '.' in text or 'E' in text or 'e' in text:
+        return float(text)
+    return int(text)
+
+def from_excel(value, date1904=False):
+    """from_excel - convert an Excel serial date to a datetime, or a
+    time for fractions of a day, as openpyxl does
+
+    :param float value: Excel serial date
+    :param bool date1904: workbook uses the 1904 date system
+    :return: datetime.datetime or datetime.time
     """
-    def __init__(self, *args, **kwargs):
-        super(AttrDict, self).__init__(*args, **kwargs)
-        self.__dict__ = self
+    if date1904:
+        epoch = datetime.datetime(1904, 1, 1)
+    else:
+        epoch = datetime.datetime(1899, 12, 30)
+        if 1 < value < 60:  # Excel thinks 1900 was a leap year
+            value += 1
+    when = epoch + datetime.timedelta(days=value)
+    if 0 < abs(value) < 1:
+        return when.time()
+    return when
+
+def column_index(letters):
+    """column_index - convert column letters to a 0 based index
+
+    :param str letters: column letters, e.g. 'AB'
+    :return: int index
+    """
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+class SharedStrings(object):
+    """Shared strings table read on demand, for workbooks with large
+    string tables.  sharedStrings.xml is extracted to a temporary file
+    and memory-mapped, and only the offset of each <si> element is kept,
+    so a string is only parsed when a cell using it is read.
+    """
+    CACHE_SIZE = 1024  # most recently parsed strings, headers, 'n/a' etc.
+
+    def __init__(self, source):
+        """
+        :param file source: sharedStrings.xml stream, e.g. from ZipFile.open()
+        """
+        self._file = tempfile.TemporaryFile()
+        shutil.copyfileobj(source, self._file)
+        self._file.flush()
+        self._map = None
+        self._offsets = np.zeros(0, dtype=np.int64)
+        self._cache = {}
+        if self._file.tell() == 0:
+            return
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        prefix = []
+
+        def starts():
+            for match in SI_START.finditer(self._map):
+                if not prefix:
+                    prefix.append(match.group(1))
+                yield match.start()
+
+        self._offsets = np.fromiter(starts(), dtype=np.int64)
+        self._end = self._map.rfind(b'</')  # </sst>
+        # fragments are parsed wrapped in an element declaring the namespace
+        xmlns = b'xmlns="' + SHEET_NS[1:-1].encode('ascii') + b'"'
+        if prefix and prefix[0]:
+            xmlns += b' xmlns:' + prefix[0] + b'="' + SHEET_NS[1:-1].encode('ascii') + b'"'
+        self._wrap = b'<sst ' + xmlns + b'>', b'</sst>'
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        text = self._cache.get(index)
+        if text is not None:
+            return text
+        start = int(self._offsets[index])
+        end = int(self._offsets[index+1]) if index+1 < len(self._offsets) else self._end
+        root = ElementTree.fromstring(self._wrap[0] + self._map[start:end] + self._wrap[1])
+        text = XLSXReader._get_text(root[0])
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[index] = text
+        return text
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+class StreamedStrings(object):
+    """Shared strings table read incrementally, only as far as the
+    highest index used so far, for reading the first rows of a sheet,
+    e.g. field names, without decompressing the whole table.
+    """
+    def __init__(self, source):
+        """
+        :param file source: sharedStrings.xml stream, e.g. from ZipFile.open()
+        """
+        self._source = source
+        self._events = ElementTree.iterparse(source)
+        self._strings = []
+
+    def __getitem__(self, index):
+        while index >= len(self._strings):
+            for event, elem in self._events:
+                if elem.tag == SHEET_NS+'si':
+                    self._strings.append(XLSXReader._get_text(elem))
+                    elem.clear()
+                    break
+            else:
+                raise IndexError(index)
+        return self._strings[index]
 
+    def close(self):
+        self._source.close()
+
+class RowFilter(object):
+    """Worksheet XML stream with unwanted <row> elements cut out before
+    they reach the XML parser, so e.g. a --shards shard only parses its own
+    rows.  Rows are found by scanning the decompressed bytes for <row
+    start tags, each row runs to the next one or to </sheetData>.  Rows
+    kept without an r attribute are given one, so the parser still knows
+    their numbers.
+    """
+    CHUNK = 65536  # bytes read from source at a time
+    OVERLAP = 64  # bytes kept back in case a tag spans two chunks
+
+    def __init__(self, source, drop):
+        """
+        :param file source: worksheet XML stream, e.g. from ZipFile.open()
+        :param function drop: drop(position) True for rows (0 based) to cut
+            out, called ahead of the rows being parsed
+        """
+        self._source = source
+        self._drop = drop
+        self._buf = b''
+        self._out = []
+        self._out_len = 0
+        self._state = 'head'  # 'head' before the rows, 'rows', 'tail' after
+        self._searched = 0  # bytes of a row in _buf already searched for its end
+        self._counter = 1  # row number for a <row> with no r attribute
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or self._out_len < size):
+            chunk = self._source.read(self.CHUNK)
+            if not chunk:
+                self._eof = True
+            self._buf += chunk
+            self._filter()
+        data = b''.join(self._out)
+        if size >= 0:
+            data, rest = data[:size], data[size:]
+        else:
+            rest = b''
+        self._out = [rest] if rest else []
+        self._out_len = len(rest)
+        return data
+
+    def _emit(self, data):
+        if data:
+            self._out.append(data)
+            self._out_len += len(data)
+
+    def _filter(self):
+        """_filter - move what can be decided from _buf to _out"""
+        buf = self._buf
+        if self._state == 'head':
+            match = ROW_START.search(buf)
+            if match is None:
+                keep = len(buf) if self._eof else max(0, len(buf) - self.OVERLAP)
+                self._emit(buf[:keep])
+                self._buf = buf[keep:]
+                return
+            self._emit(buf[:match.start()])
+            buf = buf[match.start():]
+            self._state = 'rows'
+        start = 0
+        while self._state == 'rows':
+            pos = max(start + 1, start + self._searched - self.OVERLAP)
+            row = ROW_START.search(buf, pos)
+            end = SHEET_DATA_END.search(buf, pos, row.start() if row else len(buf))
+            if end is not None:
+                row = end
+                self._state = 'tail'
+            elif row is None:
+                if self._eof:  # truncated, let the parser complain
+                    self._emit(buf[start:])
+                    start = len(buf)
+                    break
+                self._searched = len(buf) - start
+                break
+            tag_end = buf.find(b'>', start, row.start())
+            number = ROW_NUMBER.search(buf, start, tag_end)
+            idx = int(number.group(1)) if number else self._counter
+            self._counter = idx + 1
+            if self._drop(idx - 1):
+                pass
+            elif number:
+                self._emit(buf[start:row.start()])
+            else:  # number it, the parser can't count the rows cut out
+                name_end = ROW_START.match(buf, start).end() - 1
+                self._emit(buf[start:name_end])
+                self._emit(b' r="%d"' % idx)
+                self._emit(buf[name_end:row.start()])
+            start = row.start()
+            self._searched = 0
+        if self._state == 'tail':
+            self._emit(buf[start:])
+            start = len(buf)
+        self._buf = buf[start:]
+
+    def close(self):
+        self._source.close()
+
+class XLSXReader(object):
+    """Read cell values from an .xlsx file by streaming the worksheet XML,
+    without building openpyxl cell objects.  Rows are yielded as lists
+    of values the same as openpyxl's read_only, data_only mode would give.
+    """
+    def __init__(self, filepath, timer=None, lazy_strings=False, strings=True,
+                 stream_strings=False):
+        """
+        :param str filepath: path to .xlsx file
+        :param PhaseTimer timer: to record time opening file and
+            loading shared strings
+        :param bool lazy_strings: use SharedStrings rather than reading
+            all shared strings into a list
+        :param bool strings: False to skip reading shared strings and
+            styles, when only sheet names are needed
+        :param bool stream_strings: use StreamedStrings, when only the
+            first rows are needed
+        """
+        self.filepath = filepath
+        self.zip = zipfile.ZipFile(filepath)
+        self.date1904 = False
+        self.sheets = self._get_sheets()  # [(name, member path), ...]
+        self.date_styles = set()
+        self.shared_strings = []
+        if not strings:
+            return
+        self.date_styles = self._get_date_styles()
+        if timer:
+            timer.lap('open')
+        self.shared_strings = self._get_shared_strings(lazy_strings, stream_strings)
+        if timer:
+            timer.lap('shared strings')
+
+    def close(self):
+        if isinstance(self.shared_strings, (SharedStrings, StreamedStrings)):
+            self.shared_strings.close()
+        self.zip.close()
+
+    def _read_rels(self, path):
+        """_read_rels - read the .rels member for path,
+        {Id: (relationship type, target member path)}
+        """
+        folder, name = path.rsplit('/', 1) if '/' in path else ('', path)
+        rels_path = (folder + '/' if folder else '') + '_rels/' + name + '.rels'
+        rels = {}
+        if rels_path not in self.zip.namelist():
+            return rels
+        for rel in ElementTree.fromstring(self.zip.read(rels_path)):
+            target = rel.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            elif folder:
+                target = folder + '/' + target
+            rels[rel.get('Id')] = rel.get('Type', '').rsplit('/', 1)[-1], target
+        return rels
+
+    def _get_sheets(self):
+        """_get_sheets - worksheet names and member paths in workbook
+        order, chart sheets etc. are left out
+        """
+        self.workbook_path = 'xl/workbook.xml'
+        for kind, target in self._read_rels('').values():
+            if kind == 'officeDocument':
+                self.workbook_path = target
+        self.workbook_rels = self._read_rels(self.workbook_path)
+        workbook = ElementTree.fromstring(self.zip.read(self.workbook_path))
+        props = workbook.find(SHEET_NS+'workbookPr')
+        if props is not None:
+            self.date1904 = props.get('date1904') in ('1', 'true')
+        sheets = []
+        for sheet in workbook.iter(SHEET_NS+'sheet'):
+            kind, target = self.workbook_rels[sheet.get(DOC_REL_NS+'id')]
+            if kind == 'worksheet':
+                sheets.append((sheet.get('name'), target))
+        return sheets
+
+    def sheet_index(self, name=None):
+        """sheet_index - index of the sheet called name, or of the first
+        sheet if name is None
+        """
+        if name is None:
+            return 0
+        return [i[0] for i in self.sheets].index(name)
+
+    def _get_member(self, kind):
+        """_get_member - path of the workbook part with relationship type kind"""
+        for rel_kind, target in self.workbook_rels.values():
+            if rel_kind == kind:
+                return target
+        return None
+
+    def _get_date_styles(self):
+        """_get_date_styles - set of style indices which format dates"""
+        path = self._get_member('styles')
+        if path is None:
+            return set()
+        styles = ElementTree.fromstring(self.zip.read(path))
+        custom = {
+            int(fmt.get('numFmtId')): fmt.get('formatCode')
+            for fmt in styles.iter(SHEET_NS+'numFmt')
+        }
+        date_styles = set()
+        xfs = styles.find(SHEET_NS+'cellXfs')
+        for idx, xf in enumerate(xfs if xfs is not None else []):
+            fmt_id = int(xf.get('numFmtId', 0))
+            if fmt_id in custom:
+                fmt = DATE_FORMAT_STRIP.sub('', custom[fmt_id].split(';')[0])
+                if re.search('[dmhysDMHYS]', fmt):
+                    date_styles.add(idx)
+            elif fmt_id in DATE_FORMAT_IDS:
+                date_styles.add(idx)
+        return date_styles
+
+    def _get_shared_strings(self, lazy=False, stream=False):
+        """_get_shared_strings - list of shared strings, or SharedStrings
+        if lazy, or StreamedStrings if stream
+        """
+        path = self._get_member('sharedStrings')
+        strings = []
+        if path is None:
+            return strings
+        if stream:
+            return StreamedStrings(self.zip.open(path))
+        if lazy:
+            source = self.zip.open(path)
+            try:
+                return SharedStrings(source)
+            finally:
+                source.close()
+        for event, elem in ElementTree.iterparse(self.zip.open(path)):
+            if elem.tag == SHEET_NS+'si':
+                strings.append(self._get_text(elem))
+                elem.clear()
+        return strings
+
+    @staticmethod
+    def _get_text(elem):
+        """_get_text - text from <si> / <is> elements, ignoring phonetic runs"""
+        text = []
+        for child in elem:
+            if child.tag == TEXT_TAG:
+                text.append(child.text or '')
+            elif child.tag == RUN_TAG:
+                text.append(child.findtext(TEXT_TAG) or '')
+        return ''.join(text)
+
+    def get_value(self, cell):
+        """get_value - value of a <c> element"""
+        kind = cell.get('t')
+        if kind == 'inlineStr':
+            inline = cell.find(INLINE_TAG)
+            return None if inline is None else self._get_text(inline)
+        value = cell.findtext(VALUE_TAG) or None
+        if value is None:
+            return None
+        if kind is None or kind == 'n':
+            value = cast_number(value)
+            if cell.get('s') and int(cell.get('s')) in self.date_styles:
+                value = from_excel(value, self.date1904)
+            return value
+        if kind == 's':
+            return self.shared_strings[int(value)]
+        if kind == 'b':
+            return bool(int(value))
+        return value  # 'str' formula text, 'e' error, 'd' ISO date text
+
+    def header(self, sheet=0):
+        """header - values in the first row of a sheet, without reading
+        any further
+
+        :param int sheet: index of sheet to read
+        :return: list of values
+        """
+        rows = self.rows(sheet)
+        try:
+            return next(rows, [])
+        finally:
+            rows.close()
+
+    def rows(self, sheet=0, skip=None, columns=None, drop=None):
+        """rows - generator - lists of values for each row of a sheet, padded
+        to the sheet's dimension, missing rows filled with None
+
+        :param int sheet: index of sheet to read
+        :param function skip: skip(position) True for rows (0 based) that
+            aren't wanted, these are yielded as None without reading values
+        :param list columns: 0 based indices of columns wanted, rows are
+            lists of values for just these columns, other cells aren't read
+        :param function drop: drop(position) True for rows (0 based) that
+            are never wanted, these are yielded as None without being
+            parsed, see RowFilter.  Unlike skip, it's called before earlier
+            rows are yielded, so it mustn't depend on them
+        """
+        max_col = max_row = None
+        empty_row = []
+        positions = None  # column index -> position in row
+        if columns is not None:
+            positions = {col: pos for pos, col in enumerate(columns)}
+            empty_row = [None] * len(columns)
+        counter = 1
+        sheet_data = None
+        col_cache = {}  # column letters -> index
+        get_value = self.get_value
+        date_styles = set(str(i) for i in self.date_styles)  # 's' attributes
+        source = self.zip.open(self.sheets[sheet][1])
+        if drop is not None:
+            source = RowFilter(source, drop)
+        try:
+            for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == SHEET_DATA_TAG:
+                        sheet_data = elem
+                    continue
+                if elem.tag == ROW_TAG:
+                    idx = int(elem.get('r', counter))
+                    if max_row is not None and idx > max_row:
+                        break
+                    while counter < idx:  # some rows are missing, or dropped
+                        counter += 1
+                        if drop is not None and drop(counter-2):
+                            yield None
+                        else:
+                            yield list(empty_row)
+                    if skip is not None and skip(counter-1):
+                        counter += 1
+                        sheet_data.clear()
+                        yield None
+                        continue
+                    if positions is not None or max_col is not None:
+                        row = list(empty_row)
+                    else:
+                        row = []
+                    col = -1
+                    for cell in elem:
+                        ref = cell.get('r')
+                        if ref:
+                            letters = ref.rstrip('0123456789')
+                            col = col_cache.get(letters)
+                            if col is None:
+                                col = col_cache[letters] = column_index(letters)
+                        else:
+                            col += 1
+                        if positions is not None:
+                            pos = positions.get(col)
+                            if pos is None:
+                                continue
+                        elif max_col is None:
+                            row.extend([None] * (col + 1 - len(row)))
+                            pos = col
+                        elif col >= max_col:
+                            continue
+                        else:
+                            pos = col
+                        # fast path for the common case, plain numbers
+                        if cell.get('t') is None and cell.get('s') not in date_styles:
+                            value = cell.findtext(VALUE_TAG)
+                            row[pos] = cast_number(value) if value else None
+                        else:
+                            row[pos] = get_value(cell)
+                    counter += 1
+                    sheet_data.clear()
+                    yield row
+                elif elem.tag == DIMENSION_TAG:
+                    ref = elem.get('ref', '').split(':')[-1]
+                    letters = ref.rstrip('0123456789')
+                    if letters and letters != ref:
+                        max_col = column_index(letters) + 1
+                        max_row = int(ref[len(letters):])
+                        if positions is None:
+                            empty_row = [None] * max_col
+        finally:
+            source.close()
+        # as openpyxl, a sheet with no rows has none, whatever its dimension
+        if max_row is not None and counter > 1:
+            for position in range(counter-1, max_row):
+                if drop is not None and drop(position):
+                    yield None
+                else:
+                    yield list(empty_row)
+
+def read_rows_openpyxl(filepath, sheet=None, skip=None, select=None,
+                       timer=None, lazy_strings=False, drop=None):
+    """read_rows_openpyxl - generator - lists of values for each row of a
+    sheet, read with openpyxl
+
+    :param str filepath: path to file
+    :param str sheet: name of sheet to read, default the first
+    :param function skip: skip(position) True for rows (0 based) that
+        aren't wanted, these are yielded as None.  openpyxl still parses
+        every row, but their values aren't collected
+    :param function select: select(first row values) returns indices of
+        the columns wanted, rows (including the first) only hold these
+    :param PhaseTimer timer: to record time opening file, which
+        includes loading shared strings for openpyxl
+    :param bool lazy_strings: ignored, openpyxl always loads all strings
+    :param function drop: as skip, openpyxl can't avoid parsing rows
+    """
+    book = get_workbook(filepath, 'openpyxl', timer=timer)
+    if sheet is None:
+        sheet = book.worksheets[0].title
+    # not .rows, which is one generator per read only worksheet
+    row_source = book[sheet].iter_rows()
+    header = [cell.value for cell in next(row_source, [])]
+    skipped = lambda position: (
+        skip is not None and skip(position) or
+        drop is not None and drop(position))
+    if select is None:
+        yield header
+        empty_row = [None] * len(header)
+        for position, row in enumerate(row_source, 1):
+            if skipped(position):
+                yield None
+            elif row:
+                yield [cell.value for cell in row]
+            else:  # all blank rows have no cells
+                yield list(empty_row)
+        return
+    columns = select(header)
+    yield [header[i] for i in columns]
+    last = max(columns) if columns else -1
+    for position, row in enumerate(row_source, 1):
+        if skipped(position):
+            yield None
+        elif len(row) > last:
+            yield [row[i].value for i in columns]
+        else:  # empty row
+            yield [row[i].value if i < len(row) else None for i in columns]
+
+def read_rows_xml(filepath, sheet=None, skip=None, select=None, timer=None,
+                  lazy_strings=False, drop=None):
+    """read_rows_xml - generator - lists of values for each row of a
+    sheet, read with XLSXReader
+
+    :param str filepath: path to file
+    :param str sheet: name of sheet to read, default the first
+    :param function skip: see XLSXReader.rows()
+    :param function select: see read_rows_openpyxl(), values in other
+        columns aren't read
+    :param PhaseTimer timer: see XLSXReader()
+    :param bool lazy_strings: see XLSXReader()
+    :param function drop: see XLSXReader.rows()
+    """
+    reader = get_workbook(filepath, 'xml', lazy_strings=lazy_strings, timer=timer)
+    index = reader.sheet_index(sheet)
+    columns = None if select is None else select(reader.header(index))
+    for row in reader.rows(index, skip=skip, columns=columns, drop=drop):
+        yield row
+
+_WORKBOOK = {}  # the workbook open for proc_file(), see get_workbook()
+
+def get_workbook(filepath, engine='openpyxl', lazy_strings=False, timer=None):
+    """get_workbook - open a workbook, or return the one already open, so
+    reading the sheet names and the rows of each sheet for a proc_file() or
+    proc_workbook() call share the zip handle, workbook metadata, and
+    shared strings.  They close it, see close_workbook()
+
+    :param str filepath: path to file
+    :param str engine: 'openpyxl' for an openpyxl read only Workbook,
+        'xml' for an XLSXReader
+    :param bool lazy_strings: see XLSXReader()
+    :param PhaseTimer timer: to record time opening file
+    :return: Workbook or XLSXReader
+    """
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_mtime, stat.st_size, engine, lazy_strings)
+    if _WORKBOOK.get('key') != key:
+        close_workbook()
+        if engine == 'xml':
+            book = XLSXReader(filepath, timer=timer, lazy_strings=lazy_strings)
+        else:
+            book = load_workbook(filename=filepath, read_only=True, data_only=True)
+            if timer:
+                timer.lap('open')
+        _WORKBOOK.update(key=key, book=book)
+    return _WORKBOOK['book']
+
+def close_workbook():
+    """close_workbook - close the workbook kept open by get_workbook()"""
+    book = _WORKBOOK.pop('book', None)
+    _WORKBOOK.clear()
+    if isinstance(book, XLSXReader):
+        book.close()
+    elif book is not None and getattr(book, '_archive', None) is not None:
+        book._archive.close()  # openpyxl read only workbooks keep this open
+
+def get_sheet_names(filepath):
+    """get_sheet_names - names of the worksheets in a workbook, reading
+    only the workbook metadata
+
+    :param str filepath: path to file
+    :return: list of names
+    """
+    reader = XLSXReader(filepath, strings=False)
+    try:
+        return [name for name, path in reader.sheets]
+    finally:
+        reader.close()
+
+def select_sheets(names, sheets=None):
+    """select_sheets - names of the sheets wanted from a workbook
+
+    :param list names: worksheet names in the workbook
+    :param str sheets: 'all', or comma separated names, or 1 based
+        indices, see --sheets, None for just the first sheet
+    :return: list of names, missing sheets are left out
+    """
+    if not sheets:
+        return names[:1]
+    selected = []
+    for sheet in split_names(sheets):
+        if sheet.lower() == 'all':
+            selected.extend(names)
+        elif sheet in names:
+            selected.append(sheet)
+        elif sheet.isdigit() and 0 < int(sheet) <= len(names):
+            selected.append(names[int(sheet)-1])
+    return [name for n, name in enumerate(selected) if name not in selected[:n]]
+
+ROW_READERS = {
+    'openpyxl': read_rows_openpyxl,
+    'xml': read_rows_xml,
+}
 
 def make_parser():
     """build an argparse.ArgumentParser, don't call this directly,
@@ -56,6 +790,200 @@ def make_parser():
         help="Files to process, '*' patterns expanded."
     )
 
+    parser.add_argument('--engine', choices=ENGINES, default='openpyxl',
+        help="How to read .xlsx files, 'xml' streams the worksheet XML "
+             "directly and is faster for large files"
+    )
+
+    parser.add_argument('--sheets', metavar='SHEETS',
+        help="Sheets to process, 'all', or comma separated names or 1 "
+             "based indices, default is the first sheet.  Sheets missing "
+             "from a file are skipped.  A file's sheets are processed in "
+             "one task, so it's only opened once, use --shards to spread "
+             "them across processes"
+    )
+
+    parser.add_argument('--lazy-strings', action='store_true', default=False,
+        help="With --engine xml, index the shared strings table and read "
+             "strings only when needed, rather than loading them all "
+             "before the first row.  Faster to start and uses less memory "
+             "for files with large string tables"
+    )
+
+    parser.add_argument('--batch', type=int, default=0, metavar='ROWS',
+        help="Accumulate stats in blocks of ROWS rows with numpy, "
+             "e.g. 4096, rather than cell by cell, 0 for cell by cell.  "
+             "Results are the same either way"
+    )
+
+    parser.add_argument('--fields', action='append', metavar='NAMES',
+        help="Only process these fields, comma separated names or "
+             "patterns like '*um', may be repeated"
+    )
+    parser.add_argument('--exclude', action='append', metavar='NAMES',
+        help="Don't process these fields, as for --fields"
+    )
+    parser.add_argument('--rename', action='append', metavar='OLD=NEW',
+        help="Report field OLD as NEW, comma separated OLD=NEW pairs, "
+             "may be repeated.  Fields renamed to the same name share "
+             "stats, and --negate, --hist-fields, and --covariance use "
+             "the new names"
+    )
+    parser.add_argument('--negate', action='append', metavar='NAMES',
+        help="Negate numbers in these fields as they're read, as for "
+             "--fields"
+    )
+    parser.add_argument('--quantiles', metavar='PERCENTS',
+        help="Estimate these percentiles for each field, e.g. '5,50,95', "
+             "output as columns p5, p50, p95"
+    )
+    parser.add_argument('--sketch-k', type=int, default=200, metavar='K',
+        help="Accuracy of --quantiles, rank error is about 2/K and "
+             "memory about 3*K values per field"
+    )
+
+    parser.add_argument('--values', metavar='FILE',
+        help="Write estimated distinct counts of numbers and of bad "
+             "values, and the most common bad values, for each field to "
+             "FILE as .csv"
+    )
+    parser.add_argument('--top-k', type=int, default=10, metavar='K',
+        help="Number of most common bad values tracked for --values"
+    )
+    parser.add_argument('--distinct-precision', type=int, default=12, metavar='P',
+        help="Distinct counts for --values use 2**P bytes per field, "
+             "with about 1.04/sqrt(2**P) error, 1.6%% for 12"
+    )
+
+    parser.add_argument('--group-by', metavar='NAMES',
+        help="Stats for each distinct value of these fields, comma "
+             "separated, rather than for the whole sheet.  Output has "
+             "a group column, values separated by '|'"
+    )
+    parser.add_argument('--max-groups', type=int, default=10000, metavar='N',
+        help="Fail if --group-by finds more than N groups in a sheet, "
+             "checked in each --shards shard and after merging them, "
+             "memory used is about N * fields * 350 bytes, more with "
+             "--quantiles, --values or --histograms"
+    )
+
+    parser.add_argument('--time-column', metavar='NAME',
+        help="Field with times, dates or Excel serial date numbers, for "
+             "--buckets"
+    )
+    parser.add_argument('--bucket', type=float, default=300, metavar='SECONDS',
+        help="Size of --buckets time buckets"
+    )
+    parser.add_argument('--buckets', metavar='FILE',
+        help="Write stats for each --bucket seconds of --time-column "
+             "to FILE as .csv, rows may be in any order.  Rows without "
+             "a time go in a bucket with a blank start"
+    )
+
+    parser.add_argument('--covariance', action='append', metavar='NAMES',
+        help="Fields for --matrix, comma separated names or patterns "
+             "as for --fields, may be repeated"
+    )
+    parser.add_argument('--matrix', metavar='FILE',
+        help="Write covariance and correlation matrices of the "
+             "--covariance fields for each file / sheet to FILE, .npz "
+             "if FILE ends with .npz, otherwise .csv.  Only rows where "
+             "all these fields are numbers are used"
+    )
+
+    parser.add_argument('--histograms', metavar='FILE',
+        help="Write histograms of --hist-fields to FILE as .csv, one row "
+             "per bin, combined over all files"
+    )
+    parser.add_argument('--hist-fields', action='append', metavar='NAMES',
+        help="Fields for --histograms, as for --fields, default all"
+    )
+    parser.add_argument('--hist-edges', metavar='EDGES',
+        help="Comma separated bin edges for --histograms"
+    )
+    parser.add_argument('--hist-log', metavar='MIN,MAX,BINS',
+        help="Log spaced bin edges for --histograms"
+    )
+    parser.add_argument('--hist-bins', type=int, default=50, metavar='N',
+        help="Without --hist-edges / --hist-log, about N bins with a "
+             "power of 10 width chosen from the first --hist-pilot values "
+             "of the column in each file (and --shards shard), widened as "
+             "needed.  Widths are powers of 10, so merged histograms line "
+             "up, at the widest width"
+    )
+    parser.add_argument('--hist-pilot', type=int, default=1000, metavar='N',
+        help="See --hist-bins"
+    )
+
+    parser.add_argument('--datetimes', choices=['bad', 'numeric'], default='bad',
+        help="Count date / time cells as bad values, or as numbers, days "
+             "since 1899-12-30 as Excel stores them"
+    )
+
+    parser.add_argument('--sample', type=float, metavar='FRACTION',
+        help="Process a random FRACTION of rows, for quick estimates. "
+             "Counts and sums are for the sampled rows, means have "
+             "--confidence intervals, see the estimate column.  The xml "
+             "engine skips other rows without reading their values"
+    )
+    parser.add_argument('--max-rows', type=int, metavar='N',
+        help="As --sample, but process a random sample of at most N rows "
+             "from each sheet, held in memory until the sheet is read.  "
+             "With --shards, each shard samples N / shards of its rows"
+    )
+    parser.add_argument('--seed', type=int, default=0,
+        help="Random seed for --sample / --max-rows"
+    )
+    parser.add_argument('--confidence', type=float, default=0.95,
+        help="Confidence level for mean_low / mean_high with --sample / "
+             "--max-rows"
+    )
+
+    parser.add_argument('--shards', type=int, default=1, metavar='N',
+        help="Split each file into N shards of interleaved row ranges "
+             "processed by separate workers and then merged.  Each shard "
+             "decompresses the whole sheet, but with --engine xml only "
+             "parses its own rows, with openpyxl every row is parsed"
+    )
+
+    parser.add_argument('--jobs', type=int, metavar='N',
+        help="Number of worker processes, default is the number of CPUs "
+             "available, allowing for affinity and container quotas"
+    )
+    parser.add_argument('--max-tasks', type=int, metavar='N',
+        help="Replace each worker process after it has processed N "
+             "files / shards, to limit memory growth"
+    )
+    parser.add_argument('--ordered', action='store_true', default=False,
+        help="Write files in the order given, rather than as they're "
+             "finished.  Otherwise files are processed largest first"
+    )
+    parser.add_argument('--verbose', action='store_true',
+        help="Print each file name and a count every 1000 rows as files "
+             "are processed"
+    )
+    parser.add_argument('--metrics', metavar='FILE',
+        help="Write per file / shard timings by phase, rows/sec., "
+             "cells/sec., and worker peak memory to FILE as JSON lines"
+    )
+    parser.add_argument('--profile', metavar='DIR',
+        help="Write cProfile stats for each worker process to "
+             "DIR/worker-PID.prof"
+    )
+    parser.add_argument('--cache', metavar='PATH',
+        help="SQLite file caching results, so unchanged files aren't "
+             "processed again, created if missing"
+    )
+    parser.add_argument('--no-cache', action='store_true', default=False,
+        help="Don't use --cache"
+    )
+    parser.add_argument('--cache-max-age', type=float, default=90, metavar='DAYS',
+        help="Drop --cache entries unused for more than DAYS days"
+    )
+    parser.add_argument('--cache-max-size', type=float, default=100, metavar='MB',
+        help="Drop least recently used --cache entries beyond MB megabytes"
+    )
+
     required_named = parser.add_argument_group('required named arguments')
 
     required_named.add_argument("--output",
@@ -86,40 +1014,94 @@ def get_options(args=None):
         print("No --output supplied")
         exit(10)
 
+    if bool(opt.buckets) != bool(opt.time_column):
+        print("--buckets and --time-column must be used together")
+        exit(10)
+
+    if bool(opt.matrix) != bool(opt.covariance):
+        print("--matrix and --covariance must be used together")
+        exit(10)
+
+    if opt.sample is not None and not 0 < opt.sample <= 1:
+        print("--sample must be more than 0 and at most 1")
+        exit(10)
+
+    if opt.sample and opt.max_rows:
+        print("Use --sample or --max-rows, not both")
+        exit(10)
+
+    bad = [i for i in split_names(opt.rename) if '=' not in i]
+    if bad:
+        print("--rename needs OLD=NEW, not %s" % ', '.join(bad))
+        exit(10)
+
     return opt
 
-def get_aggregate(psumsqn, psumn, pcountn, pdof=1):
+def get_defaults(**kwargs):
+    """
+    get_defaults - options as get_options() would return them with no
+    optional arguments, updated from kwargs, for API use.
+
+    :param kwargs: options to set
+    :return: options
+    :rtype: argparse.Namespace
     """
+    opt = argparse.Namespace(**{
+        action.dest: action.default for action in make_parser()._actions
+        if action.default != argparse.SUPPRESS
+    })
+    vars(opt).update(kwargs)
+    return opt
 
+def get_aggregate(psumsqn, psumn, pcountn, pdof=1):
+    """
     get_aggregate - compute mean, variance, standard deviation,
-    coefficient of variation This function is used instead of
-    numpy.mean, numpy.var, numpy.std since the sum, sumsq, and count are
-    available when the function is called. It avoids an extra pass
-    through the list.
-    
-    # note pcountn means the full list n,  not a sample n - 1. The degree of freedom defaults to n-1
-      to match the value that Oracle variance uses. Notice the use of n and n-1
-      Naive algorithm from https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
-        Var = (SumSq − (Sum × Sum) / n) / (n − 1)
+    coefficient of variation from the sum of squares, sum, and count,
+    for callers which only have those.  m2 is found from them as
+    SumSq - Sum * Mean, which loses precision when the mean is large
+    compared to the spread, ColumnStats accumulates m2 directly and uses
+    get_aggregate_m2().
 
+    :param float psumsqn: sum of squares
+    :param float psumn: sum
+    :param int pcountn: count
+    :param int pdof: degree of freedom, defaults to n-1 for sample, not n
+    :return: a tuple of floats mean, variance, standard deviation,
+             coefficient of variation, m2, see get_aggregate_m2()
+    """
+    mean = psumn / pcountn if pcountn else NAN
+    # rounding can leave a tiny negative m2 for constant values
+    m2 = max(0., psumsqn - psumn * mean) if pcountn else NAN
+    return get_aggregate_m2(m2, mean, pcountn, pdof)
 
-    :param sum of squares, sum, count, degree of freedom defaults to n-1 for sample, not n
-    :return: a tuple of floats   mean, variance, standard deviation, coefficient of variation
-    
+def get_aggregate_m2(pm2, pmean, pcountn, pdof=1):
     """
+    get_aggregate_m2 - compute variance, standard deviation, coefficient
+    of variation from the mean and sum of squared differences from the
+    mean, m2, accumulated with Welford's / Chan's updates rather than
+    from a sum of squares, which loses precision when the mean is large
+    compared to the spread.
 
-    Agg = namedtuple("Agg", "mean variance std coefvar")
+    # note pcountn means the full list n,  not a sample n - 1. The degree of freedom defaults to n-1
+      to match the value that Oracle variance uses.
 
-    # validate inputs check for count == 0
+    :param float pm2: sum of squared differences from the mean
+    :param float pmean: mean
+    :param int pcountn: count
+    :param int pdof: degree of freedom, defaults to n-1 for sample, not n
+    :return: a tuple of floats mean, variance, standard deviation,
+             coefficient of variation, m2
+    """
 
-    mean = psumn / (pcountn) if pcountn else NAN
+    Agg = namedtuple("Agg", "mean variance std coefvar m2")
+
+    mean = pmean
 
     if pcountn == 0 or (pcountn - pdof) <= 0:
-        result = Agg(mean, NAN, NAN, NAN)
+        result = Agg(mean, NAN, NAN, NAN, pm2)
     else:
 
-        # compute variance from sum squared without knowing mean while summing
-        variance = (psumsqn - (psumn * psumn) / (pcountn) ) / (pcountn - pdof) # variance
+        variance = pm2 / (pcountn - pdof) # variance
 
         #compute standard deviation
         if variance < 0:
@@ -133,48 +1115,1510 @@ def get_aggregate(psumsqn, psumn, pcountn, pdof=1):
         else:
             coefvar = std / mean
 
-        result = Agg(mean, variance, std, coefvar)
+        result = Agg(mean, variance, std, coefvar, pm2)
 
     return result
 
-def proc_file(filepath):
+class QuantileSketch(object):
+    """KLL style streaming quantile sketch, see Karnin, Lang, Liberty,
+    "Optimal Quantile Approximation in Streams", 2016.
+
+    Values are kept in levels, a value in level h standing for 2**h
+    values.  When the sketch is full the lowest over full level is
+    sorted and every other value promoted to the next level, so memory
+    is bounded (about 3k values) whatever the number of values added.
+    Sketches of parts of a column can be merged.  Rank error is roughly
+    2 / k, and quantiles are exact while fewer than k values are added.
+    Which half of a level is promoted alternates, rather than being
+    random, so results are repeatable.
     """
-    proc_file - process one .xlsx file
+    __slots__ = 'k', 'levels', 'compactions', 'size', 'max_size'
+
+    def __init__(self, k=200):
+        """
+        :param int k: accuracy / memory, capacity of the largest level
+        """
+        self.k = k
+        self.levels = [[]]
+        self.compactions = 0
+        self.size = 0
+        self.max_size = self._capacity(0)
+
+    def __getstate__(self):
+        return [self.k, self.compactions, self.levels]
+
+    def __setstate__(self, state):
+        self.k, self.compactions, self.levels = state
+        self.size = sum(len(level) for level in self.levels)
+        self.max_size = sum(self._capacity(h) for h in range(len(self.levels)))
+
+    def _capacity(self, h):
+        """_capacity - capacity of level h, smaller for lower levels"""
+        depth = len(self.levels) - h - 1
+        return max(2, int(ceil(self.k * (2. / 3.) ** depth)))
+
+    def _compress(self):
+        """_compress - compact levels until the sketch isn't full"""
+        while self.size >= self.max_size:
+            for h, level in enumerate(self.levels):
+                if len(level) >= self._capacity(h):
+                    break
+            if h + 1 == len(self.levels):
+                self.levels.append([])
+                self.max_size = sum(self._capacity(i) for i in range(len(self.levels)))
+            level.sort()
+            keep = [level.pop()] if len(level) % 2 else []
+            promote = level[self.compactions % 2::2]
+            self.compactions += 1
+            self.levels[h+1].extend(promote)
+            self.levels[h] = keep
+            self.size -= len(level) - len(promote)
+
+    def add(self, x):
+        """add - add a value
+
+        :param float x: value
+        """
+        self.levels[0].append(x)
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def add_array(self, values):
+        """add_array - add an array of values
+
+        :param numpy.ndarray values: values
+        """
+        self.levels[0].extend(values.tolist())
+        self.size += values.size
+        self._compress()
+
+    def merge(self, other):
+        """merge - add the values from another sketch to this one
+
+        :param QuantileSketch other: sketch to add
+        :return: self
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, values in zip(self.levels, other.levels):
+            level.extend(values)
+        self.compactions += other.compactions
+        self.size += other.size
+        self.max_size = sum(self._capacity(h) for h in range(len(self.levels)))
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """quantile - nearest rank estimate of a quantile
+
+        :param float q: quantile, 0 to 1
+        :return: float value, NaN if no values were added
+        """
+        weighted = sorted(
+            (x, 2 ** h) for h, level in enumerate(self.levels) for x in level)
+        if not weighted:
+            return NAN
+        target = q * sum(weight for x, weight in weighted)
+        total = 0
+        for x, weight in weighted:
+            total += weight
+            if total >= target:
+                return x
+        return weighted[-1][0]
+
+MASK64 = (1 << 64) - 1
+
+def splitmix64(x):
+    """splitmix64 - 64 bit hash of a 64 bit int, the SplitMix64 finalizer
+
+    :param int x: value, 0 to 2**64-1
+    :return: int hash
+    """
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+def splitmix64_array(x):
+    """splitmix64_array - splitmix64() for a numpy.uint64 array
+
+    :param numpy.ndarray x: uint64 values
+    :return: uint64 array of hashes
+    """
+    x = x + np.uint64(0x9E3779B97F4A7C15)  # uint64 arithmetic wraps
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+class DistinctCounter(object):
+    """HyperLogLog distinct count estimate, see Flajolet et al.,
+    "HyperLogLog: the analysis of a near-optimal cardinality estimation
+    algorithm", 2007, with linear counting for small counts.
+
+    Uses 2**p one byte registers whatever the number of values, with
+    about 1.04 / sqrt(2**p) relative error, 1.6% for p=12.  Numbers are
+    hashed from their float64 bits, so 1 and 1.0 are the same value,
+    text from its UTF-8 bytes.
+    """
+    __slots__ = 'p', 'registers'
+
+    def __init__(self, p=12):
+        """
+        :param int p: precision, 4 to 16
+        """
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def __getstate__(self):
+        return [self.p, base64.b64encode(self.registers.tobytes()).decode('ascii')]
+
+    def __setstate__(self, state):
+        self.p = state[0]
+        self.registers = np.frombuffer(
+            base64.b64decode(state[1]), dtype=np.uint8).copy()
+
+    def add_hash(self, h):
+        """add_hash - add a value by its 64 bit hash
+
+        :param int h: hash
+        """
+        index = h >> (64 - self.p)
+        rest = (h << self.p) & MASK64
+        rank = min(65 - rest.bit_length(), 65 - self.p)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, x):
+        """add - add a numeric value
+
+        :param float x: value
+        """
+        # + 0.0 so -0.0 is 0.0
+        self.add_hash(splitmix64(struct.unpack('<Q', struct.pack('<d', x + 0.))[0]))
+
+    def add_text(self, text):
+        """add_text - add a text value
+
+        :param str text: value
+        """
+        digest = sha1(text.encode('utf-8')).digest()
+        self.add_hash(struct.unpack('<Q', digest[:8])[0])
+
+    def add_array(self, values):
+        """add_array - add an array of numeric values
+
+        :param numpy.ndarray values: values
+        """
+        if not values.size:
+            return
+        h = splitmix64_array((values.astype(np.float64) + 0.).view(np.uint64))
+        index = (h >> np.uint64(64 - self.p)).astype(np.intp)
+        rest = h << np.uint64(self.p)
+        # count leading zeros by halving
+        zeros = np.zeros(values.size, dtype=np.uint8)
+        for shift in 32, 16, 8, 4, 2, 1:
+            small = rest < np.uint64(1 << (64 - shift))
+            zeros += np.uint8(shift) * small
+            rest = np.where(small, rest << np.uint64(shift), rest)
+        zeros[rest == 0] = 64
+        rank = np.minimum(zeros + 1, 65 - self.p).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        """merge - add the values counted by another DistinctCounter
+
+        :param DistinctCounter other: counter with the same precision
+        :return: self
+        """
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    @property
+    def estimate(self):
+        """estimate - estimated number of distinct values"""
+        m = float(self.registers.size)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.ldexp(1., -self.registers.astype(int)))
+        zeros = int(np.sum(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * np.log(m / zeros)))
+        return int(round(raw))
+
+class TopValues(object):
+    """Space-Saving heavy hitters, see Metwally, Agrawal, El Abbadi,
+    "Efficient Computation of Frequent and Top-k Elements in Data
+    Streams", 2005.
+
+    Tracks at most k values.  A new value replaces the least frequent
+    tracked value, inheriting its count as a possible over count, so
+    counts are upper bounds, exact when error is 0, and any value seen
+    more than n / k times is tracked.
+    """
+    __slots__ = 'k', 'counts'
+
+    def __init__(self, k=10):
+        """
+        :param int k: number of values tracked
+        """
+        self.k = k
+        self.counts = {}  # value -> [count, error]
+
+    def __getstate__(self):
+        return [self.k, [[value, c[0], c[1]] for value, c in self.counts.items()]]
+
+    def __setstate__(self, state):
+        self.k = state[0]
+        self.counts = {value: [count, error] for value, count, error in state[1]}
+
+    def add(self, value):
+        """add - count a value
+
+        :param str value: value
+        """
+        counts = self.counts
+        if value in counts:
+            counts[value][0] += 1
+        elif len(counts) < self.k:
+            counts[value] = [1, 0]
+        else:
+            least = min(counts, key=lambda i: counts[i][0])
+            count = counts.pop(least)[0]
+            counts[value] = [count + 1, count]
+
+    def merge(self, other):
+        """merge - add the counts from another TopValues, a value missing
+        from a full summary might have been counted up to its least count
+
+        :param TopValues other: values to add
+        :return: self
+        """
+        def least(counts, k):
+            return min(c[0] for c in counts.values()) if len(counts) >= k else 0
+        mine, theirs = least(self.counts, self.k), least(other.counts, other.k)
+        merged = {}
+        for value in set(self.counts) | set(other.counts):
+            a = self.counts.get(value, [mine, mine])
+            b = other.counts.get(value, [theirs, theirs])
+            merged[value] = [a[0] + b[0], a[1] + b[1]]
+        top = sorted(merged, key=lambda i: merged[i][0], reverse=True)[:self.k]
+        self.counts = {value: merged[value] for value in top}
+        return self
+
+    def top(self):
+        """top - (value, count, error) tuples, most frequent first"""
+        return sorted(((value, c[0], c[1]) for value, c in self.counts.items()),
+                      key=lambda i: (-i[1], i[0]))
+
+class Histogram(object):
+    """Streaming histogram, with fixed edges, or auto bins on a power of
+    10 lattice.
+
+    Fixed edges (including log spaced) have counts below the first edge
+    and above the last kept separately, and only merge with histograms
+    with the same edges.
+
+    Auto bins are [k*w, (k+1)*w) for integer k and w a power of 10,
+    chosen from the range of the first pilot values so there are about
+    `bins` bins.  If values outside that range make more than 4 * bins
+    bins, w is multiplied by 10, merging bins, so memory stays O(bins).
+    Because every w is a power of 10, histograms from different files
+    merge exactly after bringing them to the larger w.
+
+    Values from add() are buffered and counted HIST_BUFFER at a time with
+    numpy, see flush().
+    """
+    __slots__ = 'edges', 'counts', 'bins', 'pilot', 'power', 'waiting', 'buffer'
+
+    def __init__(self, edges=None, bins=50, pilot=1000):
+        """
+        :param list edges: fixed bin edges, increasing, None for auto bins
+        :param int bins: auto bins, target number of bins
+        :param int pilot: auto bins, values used to choose the bin width
+        """
+        self.bins, self.pilot = bins, pilot
+        self.power = self.waiting = None
+        self.buffer = []  # values from add() not counted yet
+        if edges is not None:
+            self.edges = np.asarray(edges, dtype=np.float64)
+            # [0] below edges[0], [-1] above edges[-1]
+            self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        else:
+            self.edges = None
+            self.counts = {}  # k -> count for bin [k*w, (k+1)*w)
+            self.waiting = []  # pilot values
+
+    def __getstate__(self):
+        self.flush()
+        if self.edges is not None:
+            return ['fixed', self.edges.tolist(), self.counts.tolist()]
+        return ['auto', self.bins, self.pilot, self.power, self.waiting,
+                sorted(self.counts.items())]
+
+    def __setstate__(self, state):
+        self.buffer = []
+        if state[0] == 'fixed':
+            self.bins = self.pilot = self.power = self.waiting = None
+            self.edges = np.array(state[1], dtype=np.float64)
+            self.counts = np.array(state[2], dtype=np.int64)
+        else:
+            self.edges = None
+            self.bins, self.pilot, self.power, self.waiting = state[1:5]
+            self.counts = {int(k): count for k, count in state[5]}
+
+    def _index(self, values):
+        """_index - fixed edges, counts index for an array of values"""
+        index = np.searchsorted(self.edges, values, side='right')
+        index[values == self.edges[-1]] = len(self.edges) - 1  # last bin closed
+        return index
+
+    def _start(self):
+        """_start - auto bins, choose the bin width from the pilot values"""
+        waiting, self.waiting = self.waiting, None
+        if not waiting:
+            self.power = 0
+            return
+        span = max(waiting) - min(waiting)
+        if span <= 0:
+            span = abs(waiting[0]) or 1.
+        self.power = int(ceil(np.log10(span / self.bins)))
+        self._add_auto(np.array(waiting, dtype=np.float64))
+
+    def _add_auto(self, values):
+        """_add_auto - auto bins, count an array of values"""
+        index, counts = np.unique(
+            np.floor(values / 10. ** self.power).astype(np.int64),
+            return_counts=True)
+        for k, count in zip(index.tolist(), counts.tolist()):
+            self.counts[k] = self.counts.get(k, 0) + count
+        while len(self.counts) > 4 * self.bins:
+            self._coarsen(self.power + 1)
+
+    def _coarsen(self, power):
+        """_coarsen - auto bins, merge bins for a larger width 10**power"""
+        factor = 10 ** (power - self.power)
+        counts = {}
+        for k, count in self.counts.items():
+            counts[k // factor] = counts.get(k // factor, 0) + count
+        self.counts, self.power = counts, power
+
+    def add(self, x):
+        """add - count a value, when the buffer's flushed
+
+        :param float x: value
+        """
+        if self.edges is None and self.power is None:
+            self.waiting.append(x)
+            if len(self.waiting) >= self.pilot:
+                self._start()
+            return
+        self.buffer.append(x)
+        if len(self.buffer) >= HIST_BUFFER:
+            self.flush()
+
+    def flush(self):
+        """flush - count values buffered by add()"""
+        if not self.buffer:
+            return
+        values, self.buffer = np.array(self.buffer, dtype=np.float64), []
+        if self.edges is not None:
+            self.counts += np.bincount(self._index(values), minlength=len(self.counts))
+        else:
+            self._add_auto(values)
+
+    def add_array(self, values):
+        """add_array - count an array of values
+
+        :param numpy.ndarray values: values
+        """
+        if not values.size:
+            return
+        self.flush()
+        if self.edges is not None:
+            self.counts += np.bincount(self._index(values), minlength=len(self.counts))
+        elif self.power is None:
+            self.waiting.extend(values.tolist())
+            if len(self.waiting) >= self.pilot:
+                self._start()
+        else:
+            self._add_auto(values)
+
+    def merge(self, other):
+        """merge - add counts from another Histogram
+
+        :param Histogram other: histogram, with the same edges if fixed
+        :return: self
+        """
+        self.flush()
+        other.flush()
+        if self.edges is not None or other.edges is not None:
+            if self.edges is None or other.edges is None or \
+               not np.array_equal(self.edges, other.edges):
+                raise ValueError("Can't merge histograms with different edges")
+            self.counts += other.counts
+            return self
+        if other.power is None:
+            if other.waiting:
+                self.add_array(np.array(other.waiting, dtype=np.float64))
+            return self
+        if self.power is None:
+            waiting = self.waiting
+            self.power, self.waiting = other.power, None
+            self.counts = dict(other.counts)
+            if waiting:
+                self._add_auto(np.array(waiting, dtype=np.float64))
+            return self
+        if other.power > self.power:
+            self._coarsen(other.power)
+        counts = other.counts
+        if other.power < self.power:
+            factor = 10 ** (self.power - other.power)
+            counts = {}
+            for k, count in other.counts.items():
+                counts[k // factor] = counts.get(k // factor, 0) + count
+        for k, count in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + count
+        while len(self.counts) > 4 * self.bins:
+            self._coarsen(self.power + 1)
+        return self
+
+    def rows(self):
+        """rows - (lower, upper, count) for each non-empty bin, in order,
+        -inf / inf bounds for values outside fixed edges
+        """
+        self.flush()
+        if self.edges is not None:
+            bounds = [-np.inf] + self.edges.tolist() + [np.inf]
+            last = len(self.counts) - 1
+            for i, count in enumerate(self.counts.tolist()):
+                if count or 0 < i < last:  # outside edges only if counted
+                    yield bounds[i], bounds[i+1], count
+            return
+        if self.power is None:
+            self._start()
+        for k in sorted(self.counts):
+            if self.power >= 0:
+                yield k * 10 ** self.power, (k + 1) * 10 ** self.power, self.counts[k]
+            else:  # divide, 3 / 10. is 0.3, 3 * 0.1 is 0.30000000000000004
+                width = 10 ** -self.power
+                yield k / float(width), (k + 1) / float(width), self.counts[k]
+
+def quantile_name(percent):
+    """quantile_name - output column name for a percentile, 5 -> 'p5'"""
+    return 'p%g' % percent
+
+class ColumnStats(object):
+    """Running stats for one column.  Numbers are buffered, from add() or
+    add_array() alike, and merged as a block with the pairwise parallel
+    variance update when flushed.  proc_file() flushes every STATS_ROWS
+    rows, so the blocks, and results, are the same whether a column is
+    read cell by cell or with --batch, and at most STATS_ROWS rows of
+    numbers are buffered for all the stats in a sheet.  Whole ColumnStats
+    are merged the same way, see
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
+
+    Stats are available as attributes or items, d.n or d['n'], and with a
+    QuantileSketch, percentiles as items, d['p50'].  Unlike the AttrDict
+    this replaced, the file and field names aren't repeated in every
+    column's stats, they're answer['filepath'] and the answer['fields']
+    keys.
+
+    With __slots__ and no summaries, a ColumnStats is 152 bytes on 64 bit
+    CPython 3, about 380 bytes with the int and float objects it holds
+    once it has seen numbers, plus any buffered numbers, 8 bytes each.
+
+    Optional fixed size summaries are None unless requested:
+    sketch, a QuantileSketch of numbers, distinct and distinct_bad,
+    DistinctCounters of numbers and bad values, top, TopValues of
+    bad values, and hist, a Histogram of numbers.
+    """
+    STATE = ('n', 'blank', 'bad', 'sum', 'sumsq', 'min', 'max', 'mean', 'm2',
+             'sketch', 'distinct', 'distinct_bad', 'top', 'hist')
+    __slots__ = STATE + ('buffer',)
+    SUMMARIES = {
+        'sketch': QuantileSketch,
+        'distinct': DistinctCounter,
+        'distinct_bad': DistinctCounter,
+        'top': TopValues,
+        'hist': Histogram,
+    }
+
+    def __init__(self, sketch_k=0, distinct_p=0, top_k=0, hist=None):
+        """
+        :param int sketch_k: QuantileSketch accuracy, 0 for no sketch
+        :param int distinct_p: DistinctCounter precision, 0 for no
+            distinct counts
+        :param int top_k: number of bad values tracked, 0 for none
+        :param dict hist: Histogram() arguments, None for no histogram
+        """
+        self.n = self.blank = self.bad = 0
+        self.sum = self.sumsq = self.m2 = 0.
+        # NaN until a value is seen
+        self.min = self.max = self.mean = NAN
+        self.sketch = QuantileSketch(sketch_k) if sketch_k else None
+        self.distinct = DistinctCounter(distinct_p) if distinct_p else None
+        self.distinct_bad = DistinctCounter(distinct_p) if distinct_p else None
+        self.top = TopValues(top_k) if top_k else None
+        self.hist = Histogram(**hist) if hist is not None else None
+        self.buffer = None  # array('d') of numbers not yet in n, sum etc.
+
+    def __getitem__(self, key):
+        if key.startswith('p') and key[1:2].isdigit():
+            if self.sketch is None:
+                return NAN
+            return self.sketch.quantile(float(key[1:]) / 100.)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __getstate__(self):
+        self.flush()
+        state = []
+        for k in self.STATE:
+            value = getattr(self, k)
+            if k in self.SUMMARIES and value is not None:
+                value = value.__getstate__()
+            state.append(value)
+        return state
+
+    def __setstate__(self, state):
+        for k in self.SUMMARIES:
+            setattr(self, k, None)
+        self.buffer = None
+        for k, value in zip(self.STATE, state):
+            if k in self.SUMMARIES and value is not None:
+                summary = self.SUMMARIES[k].__new__(self.SUMMARIES[k])
+                summary.__setstate__(value)
+                value = summary
+            setattr(self, k, value)
+
+    def add(self, x):
+        """add - update with a numeric value, when the buffer's flushed
+
+        :param float x: value
+        """
+        buffer = self.buffer
+        if buffer is None:
+            buffer = self.buffer = array('d')
+        buffer.append(x)
+        if len(buffer) >= STATS_ROWS:  # only columns sharing a name get here
+            self.flush()
+        if self.sketch is not None:
+            self.sketch.add(x)
+        if self.distinct is not None:
+            self.distinct.add(x)
+        if self.hist is not None:
+            self.hist.add(x)
+
+    def flush(self):
+        """flush - merge numbers buffered by add() / add_array() into the
+        stats as one block
+        """
+        buffer = self.buffer
+        if not buffer:
+            return
+        self.buffer = None
+        n = len(buffer)
+        if n < STATS_SMALL:  # e.g. many groups, numpy's overhead dominates
+            total = sum(buffer)
+            mean = total / n
+            self._merge_moments(n, total, sum([x * x for x in buffer]), mean,
+                                sum([(x - mean) ** 2 for x in buffer]),
+                                min(buffer), max(buffer))
+            return
+        values = np.frombuffer(buffer, dtype=np.float64)
+        total = float(values.sum())
+        mean = total / n
+        deltas = values - mean
+        self._merge_moments(n, total, float((values * values).sum()), mean,
+                            float((deltas * deltas).sum()),
+                            float(values.min()), float(values.max()))
+
+    def add_array(self, values):
+        """add_array - update with an array of numeric values, when the
+        buffer's flushed
+
+        :param numpy.ndarray values: float64 values, no NaNs
+        """
+        if not values.size:
+            return
+        if self.buffer is None:
+            self.buffer = array('d')
+        self.buffer.frombytes(np.asarray(values, dtype=np.float64).tobytes())
+        if self.sketch is not None:
+            self.sketch.add_array(values)
+        if self.distinct is not None:
+            self.distinct.add_array(values)
+        if self.hist is not None:
+            self.hist.add_array(values)
+
+    def add_bad(self, value):
+        """add_bad - count a non-numeric value
+
+        :param value: cell value
+        """
+        self.bad += 1
+        if self.top is not None or self.distinct_bad is not None:
+            text = unicode(value)
+            if self.top is not None:
+                self.top.add(text)
+            if self.distinct_bad is not None:
+                self.distinct_bad.add_text(text)
+
+    def merge(self, other):
+        """merge - combine stats from another ColumnStats into this one
+
+        :param ColumnStats other: stats to add
+        :return: self
+        """
+        self.flush()
+        other.flush()
+        self._merge_moments(other.n, other.sum, other.sumsq, other.mean,
+                            other.m2, other.min, other.max)
+        self.blank += other.blank
+        self.bad += other.bad
+        for k in self.SUMMARIES:
+            theirs = getattr(other, k)
+            if theirs is not None:
+                mine = getattr(self, k)
+                if mine is None:
+                    setattr(self, k, theirs)
+                else:
+                    mine.merge(theirs)
+        return self
+
+    def _merge_moments(self, n, total, sumsq, mean, m2, low, high):
+        """_merge_moments - combine n, sum, sumsq, mean, m2, min, and max
+        of other values, with the pairwise update
+        """
+        if n and not self.n:
+            self.mean, self.m2 = mean, m2
+            self.min, self.max = low, high
+        elif n:
+            both = self.n + n
+            delta = mean - self.mean
+            self.mean += delta * n / both
+            self.m2 += m2 + delta * delta * self.n * n / both
+            self.min = min(self.min, low)
+            self.max = max(self.max, high)
+        self.n += n
+        self.sum += total
+        self.sumsq += sumsq
+
+    @property
+    def aggregate(self):
+        """see get_aggregate_m2()"""
+        self.flush()
+        return get_aggregate_m2(self.m2, self.mean, self.n)
+
+    @property
+    def variance(self):
+        return self.aggregate.variance
+
+    @property
+    def std(self):
+        return self.aggregate.std
+
+    @property
+    def coefvar(self):
+        return self.aggregate.coefvar
+
+def iter_stats(answer, buckets=False):
+    """iter_stats - generator - (group, bucket, field, ColumnStats) for
+    each field, or each field in each group with --group-by.  group is
+    None without --group-by, otherwise a tuple of the --group-by fields'
+    values.  bucket is None, or with buckets True, the start of each
+    --time-column bucket, see time_bucket()
+
+    :param dict answer: answer from proc_file()
+    :param bool buckets: stats for time buckets rather than whole sheet
+    """
+    if buckets:
+        # None (no time) sorts first in Python 2, can't be compared in 3
+        keys = sorted(answer.get('buckets', {}),
+                      key=lambda k: (k[0] or (), k[1] is not None, k[1] or 0))
+        for key in keys:
+            for field, d in answer['buckets'][key].items():
+                yield key[0], key[1], field, d
+        return
+    for field, d in answer['fields'].items():
+        yield None, None, field, d
+    for key in sorted(answer.get('groups', {})):
+        for field, d in answer['groups'][key].items():
+            yield key, None, field, d
+
+EXCEL_EPOCH = datetime.datetime(1899, 12, 30)
+
+def time_bucket(value, seconds):
+    """time_bucket - start of the time bucket holding a time
+
+    :param value: datetime, date, time of day, timedelta, or Excel serial
+        date number
+    :param float seconds: bucket size
+    :return: float seconds since EXCEL_EPOCH, or None if value isn't a time
+    """
+    if isinstance(value, DATETIME_TYPES):
+        # times of day and timedeltas are from EXCEL_EPOCH, as Excel has them
+        t = excel_number(value) * 86400
+    else:
+        try:
+            t = float(value) * 86400
+        except (ValueError, TypeError):
+            return None
+        if isnan(t) or abs(t) == float('inf'):
+            return None
+    # to the millisecond, serial dates read as 14:29:59.999999 etc.
+    return (round(t, 3) // seconds) * seconds
+
+def bucket_name(bucket):
+    """bucket_name - ISO text for a time_bucket() value, None -> ''"""
+    if bucket is None:
+        return ''
+    return (EXCEL_EPOCH + datetime.timedelta(seconds=bucket)).isoformat()
+
+def group_text(value):
+    """group_text - text for a --group-by field value, None -> '', floats
+    in full so groups aren't merged by rounding
+    """
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return repr(value)
+    return unicode(value)
+
+def group_name(key):
+    """group_name - text for a group key tuple in output, None -> ''"""
+    return '' if key is None else '|'.join(key)
+
+class CoMoments(object):
+    """Running co-moments of several columns, for covariance and
+    correlation, updated a block of rows at a time with a matrix product,
+    and merged with the pairwise update, as ColumnStats but with outer
+    products.  Only rows where every column is a number are used
+    (complete cases), so all entries share the same n.
+    """
+    __slots__ = 'fields', 'n', 'mean', 'm2'
+
+    def __init__(self, fields=()):
+        """
+        :param list fields: field names of the columns
+        """
+        self.fields = list(fields)
+        self.n = 0
+        self.mean = np.zeros(len(self.fields))
+        self.m2 = np.zeros((len(self.fields), len(self.fields)))
+
+    def __getstate__(self):
+        return [self.fields, self.n, self.mean.tolist(), self.m2.tolist()]
+
+    def __setstate__(self, state):
+        self.fields, self.n = state[0], state[1]
+        self.mean = np.array(state[2], dtype=np.float64).reshape(len(self.fields))
+        self.m2 = np.array(state[3], dtype=np.float64).reshape(
+            (len(self.fields), len(self.fields)))
+
+    def add_block(self, x):
+        """add_block - update with a block of rows
+
+        :param numpy.ndarray x: rows x columns, NaN for blank / bad,
+            rows with any NaN are skipped
+        """
+        x = x[~np.isnan(x).any(axis=1)]
+        if not len(x):
+            return
+        block = CoMoments(self.fields)
+        block.n = len(x)
+        block.mean = x.mean(axis=0)
+        deltas = x - block.mean
+        block.m2 = np.dot(deltas.T, deltas)
+        self.merge(block)
+
+    def merge(self, other):
+        """merge - combine co-moments from another CoMoments
+
+        :param CoMoments other: co-moments of the same fields
+        :return: self
+        """
+        if not other.n:
+            return self
+        if not self.n:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + np.outer(delta, delta) * (float(self.n) * other.n / n)
+        self.mean += delta * (float(other.n) / n)
+        self.n = n
+        return self
+
+    @property
+    def covariance(self):
+        """sample covariance matrix, NaN if n < 2"""
+        if self.n < 2:
+            return np.full_like(self.m2, NAN)
+        return self.m2 / (self.n - 1)
+
+    @property
+    def correlation(self):
+        """correlation matrix, NaN for columns with no variance"""
+        std = np.sqrt(np.diag(self.m2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = self.m2 / np.outer(std, std)
+        corr[~np.isfinite(corr)] = NAN
+        return corr
+
+def merge_answers(answers, max_groups=None):
+    """
+    merge_answers - combine proc_file() answers for the shards of one file,
+    merging pairs, then pairs of pairs, etc.  Answers are merged in place.
+
+    :param list answers: answers from proc_file()
+    :param int max_groups: --max-groups, checked for the merged groups /
+        time buckets, which may be more than any shard has
+    :return: combined answer, or None if any shard was aborted
+    """
+    if any(answer is None for answer in answers):
+        return None
+    while len(answers) > 1:
+        merged = []
+        for a, b in zip(answers[::2], answers[1::2]):
+            for field, d in a['fields'].items():
+                d.merge(b['fields'][field])
+            if 'comoments' in a:
+                a['comoments'].merge(b['comoments'])
+            if 'sample' in a:
+                for k in a['sample']:
+                    a['sample'][k] += b['sample'][k]
+            for kind in 'groups', 'buckets':
+                for key, stats in b.get(kind, {}).items():
+                    if key in a[kind]:
+                        for field, d in a[kind][key].items():
+                            d.merge(stats[field])
+                    else:
+                        a[kind][key] = stats
+            groups = len(a.get('buckets') or a.get('groups') or ())
+            if max_groups is not None and groups > max_groups:
+                raise ValueError(
+                    "%s: more than --max-groups %d groups / time buckets "
+                    "after merging --shards, raise --max-groups if there's "
+                    "memory for them" % (a['filepath'], max_groups))
+            merged.append(a)
+        if len(answers) % 2:
+            merged.append(answers[-1])
+        answers = merged
+    return answers[0]
+
+class PhaseTimer(object):
+    """Accumulate elapsed time in phases of processing"""
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self.last = time.time()
+
+    def lap(self, phase):
+        """lap - add the time since the last lap to phase"""
+        now = time.time()
+        self.phases[phase] += now - self.last
+        self.last = now
+
+def peak_rss():
+    """peak_rss - peak resident memory of this process, megabytes
+
+    :return: float, or None where not available (Windows)
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on MacOS
+    return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+def split_names(names):
+    """split_names - flatten --fields / --exclude values
+
+    :param names: None, 'a,b', or ['a,b', 'c']
+    :return: list of names / patterns
+    """
+    if not names:
+        return []
+    if isinstance(names, (str, unicode)):
+        names = [names]
+    return [i.strip() for name in names for i in name.split(',') if i.strip()]
+
+def get_renames(names):
+    """get_renames - --rename values as a dict
+
+    :param names: None, 'a=b,c=d', or ['a=b,c=d', 'e=f']
+    :return: {old: new}
+    """
+    return dict(i.split('=', 1) for i in split_names(names))
+
+def select_columns(header, include=None, exclude=None, keep=None):
+    """select_columns - indices of columns to process
+
+    :param list header: field names from the first row
+    :param include: only fields matching these names / patterns, see
+        split_names() for format
+    :param exclude: not fields matching these names / patterns
+    :param keep: fields always selected, e.g. --group-by fields
+    :return: list of 0 based column indices
+    """
+    include = split_names(include)
+    exclude = split_names(exclude)
+    keep = split_names(keep)
+
+    def matches(name, patterns):
+        return any(name == i or fnmatchcase(name, i) for i in patterns)
+
+    columns = []
+    for col, name in enumerate(header):
+        name = '' if name is None else unicode(name)
+        if name in keep:
+            columns.append(col)
+            continue
+        if include and not matches(name, include):
+            continue
+        if matches(name, exclude):
+            continue
+        columns.append(col)
+    return columns
+
+def get_histogram_args(opt):
+    """get_histogram_args - Histogram() arguments from options
+
+    :param argparse.Namespace opt: options
+    :return: dict
+    """
+    if opt.hist_edges:
+        return {'edges': sorted(float(i) for i in split_names(opt.hist_edges))}
+    if opt.hist_log:
+        low, high, bins = [float(i) for i in split_names(opt.hist_log)]
+        return {'edges': np.logspace(np.log10(low), np.log10(high), int(bins) + 1).tolist()}
+    return {'bins': opt.hist_bins, 'pilot': opt.hist_pilot}
+
+def in_shard(position, shard, shards):
+    """in_shard - is a data row in a shard
+
+    :param int position: 0 based position of row, not counting field names
+    :param int shard: shard number
+    :param int shards: number of shards
+    :return: bool
+    """
+    return (position // SHARD_ROWS) % shards == shard
+
+def in_sample(position, fraction, seed=0):
+    """in_sample - is a data row in a --sample, a Bernoulli sample decided
+    by hashing the row's position, so it's the same for any --shards
+
+    :param int position: 0 based position of row, not counting field names
+    :param float fraction: fraction of rows sampled
+    :param int seed: seed, different seeds sample different rows
+    :return: bool
+    """
+    return splitmix64((seed << 32 ^ position) & MASK64) < fraction * 2.**64
+
+class RowReservoir(object):
+    """Reservoir sample of k rows, for --max-rows, using Algorithm L, which
+    picks the position of the next row to keep before it's read, so rows
+    in between can be skipped without reading their values.
+    """
+    def __init__(self, k, seed=0):
+        """
+        :param int k: rows to keep
+        :param int seed: random seed
+        """
+        self.k = k
+        self.random = random.Random(seed)
+        self.rows = []
+        self.next = 0  # position of next row to keep
+        self.w = exp(log(self._uniform()) / k)
+
+    def _uniform(self):
+        """_uniform - random number in (0, 1)"""
+        while True:
+            u = self.random.random()
+            if u > 0:
+                return u
+
+    def wanted(self, position):
+        """wanted - is the row at position kept
+
+        :param int position: 0 based position of row
+        :return: bool
+        """
+        return position == self.next
+
+    def add(self, position, row):
+        """add - keep a row, wanted(position) must be True
+
+        :param int position: 0 based position of row
+        :param list row: row values
+        """
+        if len(self.rows) < self.k:
+            self.rows.append(row)
+            if len(self.rows) < self.k:
+                self.next += 1
+                return
+        else:
+            self.rows[self.random.randrange(self.k)] = row
+            self.w *= exp(log(self._uniform()) / self.k)
+        self.next = position + int(floor(log(self._uniform()) / log(1 - self.w))) + 1
+
+BAD = object()  # cell_number() result for values that aren't numbers
+NUMBER_TYPES = set([float, int, long, bool])
+TEXT_TYPES = set([str, unicode])
+DATETIME_TYPES = (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)
+PROFILE_MISSES = 16  # values not fitting a column's profile before re-profiling
+MEMO_SIZE = 1024  # text values remembered per column by CellHandler
+
+def excel_number(value):
+    """excel_number - a datetime, date, time, or timedelta as a number of
+    days, since EXCEL_EPOCH for datetimes and dates, as Excel stores them
+
+    :param value: datetime.datetime, date, time, or timedelta
+    :return: float days
+    """
+    if isinstance(value, datetime.datetime):
+        return (value - EXCEL_EPOCH).total_seconds() / 86400.
+    if isinstance(value, datetime.date):
+        return float((value - EXCEL_EPOCH.date()).days)
+    if isinstance(value, datetime.time):
+        return (value.hour * 3600 + value.minute * 60 + value.second
+                + value.microsecond / 1e6) / 86400.
+    return value.total_seconds() / 86400.
+
+def cell_number(value, datetimes='bad'):
+    """cell_number - the generic path, a cell value as a number
+
+    :param value: cell value
+    :param str datetimes: 'bad' or 'numeric', see --datetimes
+    :return: float, None for blank, or BAD
+    """
+    if value is None:
+        return None
+    if isinstance(value, DATETIME_TYPES):
+        return excel_number(value) if datetimes == 'numeric' else BAD
+    if unicode(value).strip() == '':
+        return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return BAD
+
+def negate_value(value):
+    """negate_value - negate a cell value if it's a number, for --negate
+
+    :param value: cell value
+    :return: negated number, or value unchanged
+    """
+    if type(value) in NUMBER_TYPES:
+        return -value
+    if type(value) in TEXT_TYPES:
+        try:
+            return -float(value)
+        except ValueError:
+            pass
+    return value
+
+class CellHandler(object):
+    """Add a column's cell values to its ColumnStats, cell by cell, with a
+    handler for the column's profile, numbers, text, or datetimes, so
+    numbers never go through text conversion or exceptions, and text is
+    only converted the first time it's seen.  Values not fitting the
+    profile are still handled by type, and after PROFILE_MISSES of them
+    the column is profiled again from the latest.  Other values take the
+    generic path, cell_number().
+    """
+    __slots__ = 'd', 'datetimes', 'add', 'misses', 'memo'
+
+    def __init__(self, d, datetimes='bad'):
+        """
+        :param ColumnStats d: stats to update, may be changed between
+            values, e.g. for --group-by
+        :param str datetimes: 'bad' or 'numeric', see --datetimes
+        """
+        self.d = d
+        self.datetimes = datetimes
+        self.misses = 0
+        self.memo = {}  # text -> cell_number(text)
+        self.add = self.add_first
+
+    def _profile(self, value):
+        """_profile - use the handler for value's type"""
+        if value.__class__ in NUMBER_TYPES:
+            self.add = self.add_number
+        elif value.__class__ in TEXT_TYPES:
+            self.add = self.add_text
+        elif isinstance(value, DATETIME_TYPES):
+            self.add = self.add_datetime
+        else:
+            self.add = self.add_any
+        self.misses = 0
+
+    def _miss(self, value):
+        """_miss - a value not fitting the profile"""
+        if value.__class__ in NUMBER_TYPES:
+            self.d.add(float(value))
+        elif value.__class__ in TEXT_TYPES:
+            self.add_text(value)
+        else:
+            self.add_any(value)
+        self.misses += 1
+        if self.misses >= PROFILE_MISSES:
+            self._profile(value)
+
+    def add_first(self, value):
+        """add_first - profile the column from its first non-blank value"""
+        if value is None:
+            self.d.blank += 1
+            return
+        self._profile(value)
+        self.add(value)
+
+    def add_any(self, value):
+        """add_any - add any value, the generic path"""
+        x = cell_number(value, self.datetimes)
+        if x is None:
+            self.d.blank += 1
+        elif x is BAD:
+            self.d.add_bad(value)
+        else:
+            self.d.add(x)
+
+    def add_number(self, value):
+        """add_number - add a value, for numeric columns"""
+        if value.__class__ in NUMBER_TYPES:
+            self.d.add(float(value))
+        elif value is None:
+            self.d.blank += 1
+        else:
+            self._miss(value)
+
+    def add_text(self, value):
+        """add_text - add a value, for text columns"""
+        if value.__class__ in TEXT_TYPES:
+            x = self.memo.get(value, self)  # self for not seen
+            if x is self:
+                if len(self.memo) >= MEMO_SIZE:
+                    self.memo.clear()
+                x = self.memo[value] = cell_number(value)
+            if x is None:
+                self.d.blank += 1
+            elif x is BAD:
+                self.d.add_bad(value)
+            else:
+                self.d.add(x)
+        elif value is None:
+            self.d.blank += 1
+        else:
+            self._miss(value)
+
+    def add_datetime(self, value):
+        """add_datetime - add a value, for datetime columns"""
+        if isinstance(value, DATETIME_TYPES):
+            if self.datetimes == 'numeric':
+                self.d.add(excel_number(value))
+            else:
+                self.d.add_bad(value)
+        elif value is None:
+            self.d.blank += 1
+        else:
+            self._miss(value)
+
+def block_to_array(column, datetimes='bad'):
+    """block_to_array - convert a column of cell values to float64, as the
+    cell by cell loop in proc_file() would
+
+    :param list column: cell values
+    :param str datetimes: 'bad' or 'numeric', see --datetimes
+    :return: float array with NaN for blank / bad, blank mask, bad mask
+    """
+    blank_count = column.count(None)
+    try:  # fast path, all values numbers or None
+        x = np.array(column, dtype=np.float64)
+        blank = np.isnan(x)
+        if blank.sum() == blank_count:  # no 'nan' text etc.
+            return x, blank, np.zeros(len(column), dtype=bool)
+    except (ValueError, TypeError):
+        pass
+
+    # numbers in one step, only the other values, mostly blanks and a
+    # few bad ones, take the generic path
+    x = np.empty(len(column))
+    blank = np.zeros(len(column), dtype=bool)
+    bad = np.zeros(len(column), dtype=bool)
+    numeric = [type(value) in NUMBER_TYPES for value in column]
+    mask = np.array(numeric, dtype=bool)
+    x[mask] = [value for value, number in zip(column, numeric) if number]
+    for i in np.flatnonzero(~mask):
+        number = cell_number(column[i], datetimes)
+        if number is None:
+            blank[i] = True
+            x[i] = NAN
+        elif number is BAD:
+            bad[i] = True
+            x[i] = NAN
+        else:
+            x[i] = number
+    return x, blank, bad
+
+def accumulate_block(stats, fields, block, datetimes='bad'):
+    """accumulate_block - update field stats from a block of rows with
+    vectorized reductions
+
+    :param dict stats: {field: ColumnStats}, updated in place
+    :param list fields: field names
+    :param list block: rows of cell values
+    :param str datetimes: 'bad' or 'numeric', see --datetimes
+    """
+    width = len(fields)
+    block = [
+        row if len(row) == width else (list(row) + [None]*width)[:width]
+        for row in block
+    ]
+    for field, column in zip(fields, zip(*block)):
+        d = stats[field]
+        x, blank, bad = block_to_array(list(column), datetimes)
+        d.blank += int(blank.sum())
+        for i in np.flatnonzero(bad):
+            d.add_bad(column[i])
+        d.add_array(x[~(blank | bad)])
+
+def proc_file(filepath, opt=None, shard=0, sheet=None):
+    """
+    proc_file - process one sheet of an .xlsx file, closing the workbook
+    when done
 
     :param str filepath: path to file
+    :param argparse.Namespace opt: options, see get_defaults()
+    :param int shard: shard of file to process when opt.shards > 1
+    :param str sheet: name of sheet to process, default the first
     :return: list of lists, rows of info. as expected in main()
     """
+    try:
+        return _proc_file(filepath, opt, shard, sheet)
+    finally:
+        close_workbook()
 
-    print(filepath)
+def proc_workbook(filepath, opt=None, shard=0):
+    """
+    proc_workbook - process the --sheets of an .xlsx file, opening the
+    zip, workbook metadata, and shared strings once for all of them
 
-    # get the first sheet
-    book = load_workbook(filename=filepath, read_only=True, data_only=True)
-    sheets = book.get_sheet_names()
-    sheet = book[sheets[0]]
-    row_source = sheet.rows
-    row0 = next(row_source)
+    :param str filepath: path to file
+    :param argparse.Namespace opt: options, see get_defaults()
+    :param int shard: shard of each sheet to process when opt.shards > 1
+    :return: list of answers from proc_file(), one per sheet, or None if
+        aborted by ./STOP
+    """
+    if opt is None:
+        opt = get_defaults()
+    timer = PhaseTimer()  # opening is timed for the first sheet
+    try:
+        book = get_workbook(filepath, opt.engine,
+                            lazy_strings=opt.lazy_strings, timer=timer)
+        if opt.engine == 'xml':
+            names = [name for name, path in book.sheets]
+        else:
+            names = [i.title for i in book.worksheets]
+        answers = []
+        for sheet in select_sheets(names, opt.sheets):
+            answer = _proc_file(filepath, opt, shard, sheet, timer)
+            if answer is None:
+                return None
+            answers.append(answer)
+            timer = None
+        return answers
+    finally:
+        close_workbook()
+
+def _proc_file(filepath, opt=None, shard=0, sheet=None, timer=None):
+    """_proc_file - proc_file(), the workbook is left open
+
+    :param PhaseTimer timer: timer already running, e.g. from opening
+        the workbook
+    """
+
+    if opt is None:
+        opt = get_defaults()
+
+    if opt.verbose:
+        print(filepath)
+    if timer is None:
+        timer = PhaseTimer()
+
+    shards = opt.shards
+    reservoir = None
+    if opt.max_rows:  # split between shards, which have equal numbers of rows
+        reservoir = RowReservoir(
+            opt.max_rows // shards + (shard < opt.max_rows % shards),
+            opt.seed * shards + shard)
+
+    sample = {'rows': 0}  # rows in shard so far, sampled or not
+
+    def keep(position):
+        """is the data row at position processed, before it's counted"""
+        if shards > 1 and not in_shard(position, shard, shards):
+            return False
+        if opt.sample and not in_sample(position, opt.sample, opt.seed):
+            return False
+        # the reservoir samples rows numbered within the shard
+        return reservoir is None or reservoir.wanted(sample['rows'])
+
+    skip = drop = None
+    if shards > 1 or opt.sample or reservoir:
+        skip = lambda position: position and not keep(position-1)
+    if shards > 1:  # other shards' rows aren't parsed, see RowFilter
+        drop = lambda position: position and not in_shard(position-1, shard, shards)
+
+    group_by = split_names(opt.group_by)
+    time_column = opt.time_column if opt.buckets else None
+    key_fields = group_by + ([time_column] if time_column else [])
+    select = None
+    if opt.fields or opt.exclude:
+        select = partial(select_columns, include=opt.fields,
+                         exclude=opt.exclude, keep=key_fields)
+
+    row_source = ROW_READERS[opt.engine](
+        filepath, skip=skip, select=select, timer=timer,
+        sheet=sheet, lazy_strings=opt.lazy_strings, drop=drop)
     # get field names from the first row
-    fields = [i.value for i in row0]
+    fields = next(row_source)
+    timer.lap('parse')
+
+    sketch_k = opt.sketch_k if opt.quantiles else 0
+    distinct_p = opt.distinct_precision if opt.values else 0
+    top_k = opt.top_k if opt.values else 0
+    hist = get_histogram_args(opt) if opt.histograms else None
+
+    if sheet is None:  # the first sheet, already open
+        book = get_workbook(filepath, opt.engine, lazy_strings=opt.lazy_strings)
+        if opt.engine == 'xml':
+            sheet = book.sheets[0][0]
+        else:
+            sheet = book.worksheets[0].title
+
+    keyed = bool(key_fields)  # rows are split by --group-by / --time-column
+    if keyed:
+        missing = [i for i in key_fields if i not in fields]
+        if missing:
+            raise ValueError("%s: no --group-by / --time-column field(s) %s" % (
+                filepath, ', '.join(missing)))
+        key_cols = [fields.index(i) for i in group_by]
+        time_col = fields.index(time_column) if time_column else None
+        stat_cols = [i for i in range(len(fields))
+                     if i not in key_cols and i != time_col]
+        fields = [fields[i] for i in stat_cols]
+
+    renames = get_renames(opt.rename)
+    renamed = {}  # new name -> original names, for the answer
+    if renames:
+        for i in fields:
+            if i in renames and i not in renamed.get(renames[i], []):
+                renamed.setdefault(renames[i], []).append(i)
+        fields = [renames.get(i, i) for i in fields]
+    neg_cols = select_columns(fields, include=opt.negate) if opt.negate else []
+
+    hist_fields = set()
+    if hist is not None:
+        hist_fields = set(fields[i] for i in select_columns(fields, include=opt.hist_fields))
+
+    def new_stats():
+        return {
+            field:ColumnStats(sketch_k, distinct_p, top_k,
+                              hist if field in hist_fields else None)
+            for field in fields
+        }
+
+    # (group, bucket) -> (field stats, ColumnStats for each column, rows
+    # waiting for accumulate_block()), group is None without --group-by, bucket
+    # None without --time-column
+    groups = {}
+    # one CellHandler for each column, shared by the groups, pointed at the
+    # group's ColumnStats for each row, so a group costs only its stats
+    handlers = [CellHandler(None, opt.datetimes) for field in fields]
+
+    def new_group(key):
+        if len(groups) >= opt.max_groups:
+            raise ValueError(
+                "%s: more than --max-groups %d groups / time buckets for "
+                "--group-by / --time-column %s, raise --max-groups if "
+                "there's memory for %d fields per group"
+                % (filepath, opt.max_groups, ','.join(key_fields), len(fields)))
+        stats = new_stats()
+        # columns with the same name share stats
+        groups[key] = stats, [stats[field] for field in fields], []
+        return groups[key]
 
     data = {
         'filepath': filepath,
-        'fields': {field:AttrDict({f:0 for f in FIELDS}) for field in fields}
+        'sheet': sheet,
     }
+    if renamed:
+        data['renamed'] = renamed
+    if not keyed:
+        stats, columns, block = new_group((None, None))
+        data['fields'] = stats
+        for handler, d in zip(handlers, columns):
+            handler.d = d
+
+    cov_cols = None  # indices in (keyed) rows of --covariance fields
+    cov_block = []  # rows of --covariance values waiting for add_block()
+    if opt.covariance and opt.matrix:
+        cov_cols = select_columns(fields, include=opt.covariance)
+        data['comoments'] = CoMoments([fields[i] for i in cov_cols])
 
-    for field in fields:
-        # init. mins/maxs with invalid value for later calc.
-        data['fields'][field].update(dict(
-            min=NAN,
-            max=NAN,
-            field=field,
-            file=filepath,
-        ))
+    def flush():
+        """accumulate waiting rows"""
+        for stats, columns, block in groups.values():
+            if block:
+                accumulate_block(stats, fields, block, opt.datetimes)
+                del block[:]
+        if cov_block:
+            x = np.column_stack([block_to_array(list(column), opt.datetimes)[0]
+                                 for column in zip(*cov_block)])
+            data['comoments'].add_block(x)
+            del cov_block[:]
+
+    touched = set()  # keys of groups given rows since flush_stats()
+
+    def flush_stats():
+        """accumulate waiting rows and flush ColumnStats buffers, for the
+        groups given rows since the last call, see STATS_ROWS
+        """
+        for key in touched if keyed else list(groups):
+            stats, columns, block = groups[key]
+            if block:
+                accumulate_block(stats, fields, block, opt.datetimes)
+                del block[:]
+            for d in stats.values():
+                d.flush()
+        touched.clear()
+
+    def data_rows():
+        """rows to process, from this shard, and --sample / --max-rows"""
+        for position, row in enumerate(row_source):
+            timer.lap('parse')
+            if shards > 1 and not in_shard(position, shard, shards):
+                continue
+            wanted = keep(position)
+            sample['rows'] += 1
+            if not wanted:
+                continue
+            if reservoir is not None:
+                reservoir.add(sample['rows'] - 1, row)
+                continue
+            yield row
+        if reservoir is not None:
+            for row in reservoir.rows:
+                yield row
 
     rows = 0
-    for row in row_source:
+    waiting = 0  # rows waiting for accumulate_block()
+    for row in data_rows():
 
         if rows % 1000 == 0:  # feedback every 1000 rows
-            print(rows)
+            if opt.verbose:
+                print(rows)
             # Much cleaner to exit by creating a file called "STOP" in the
             # local directory than to try and use Ctrl-C, when using
             # multiprocessing.  Save time by checking only every 1000 rows.
@@ -184,94 +2628,793 @@ def proc_file(filepath):
 
         rows += 1
 
-        for cell_n, cell in enumerate(row):
-            d = data['fields'][fields[cell_n]]
-            if cell.value is None or unicode(cell.value).strip() == '':
-                d.blank += 1
-            else:
-                try:
-                    x = float(cell.value)
-                    d.sum += x
-                    d.sumsq += x*x
-                    d.n += 1
-                    # min is x if no value seen yet, else min(prev-min, x)
-                    if isnan(d.min):
-                        d.min = x
-                    else:
-                        d.min = min(d.min, x)
-                    # as for min
-                    if isnan(d.max):
-                        d.max = x
-                    else:
-                        d.max = max(d.max, x)
-                except ValueError, TypeError:
-                    d.bad += 1
+        if keyed:
+            group = bucket = None
+            if key_cols:
+                group = tuple(group_text(row[i] if i < len(row) else None)
+                              for i in key_cols)
+            if time_col is not None:
+                bucket = time_bucket(
+                    row[time_col] if time_col < len(row) else None, opt.bucket)
+            key = group, bucket
+            stats, columns, block = groups.get(key) or new_group(key)
+            touched.add(key)
+            row = [row[i] if i < len(row) else None for i in stat_cols]
 
-    assert sum(d.n+d.blank+d.bad for d in data['fields'].values()) == rows * len(fields)
+        if neg_cols:
+            row = list(row)
+            for i in neg_cols:
+                if i < len(row):
+                    row[i] = negate_value(row[i])
 
-    # compute the derived values
-    for field in data['fields']:
-        d = data['fields'][field]
-        d.update(get_aggregate(d.sumsq, d.sum, d.n)._asdict().items())
+        if cov_cols:
+            cov_block.append([row[i] if i < len(row) else None for i in cov_cols])
+            if not opt.batch and len(cov_block) == COMOMENT_ROWS:
+                flush()
+
+        if opt.batch:
+            block.append(row)
+            waiting += 1
+            if waiting == opt.batch:
+                flush()
+                waiting = 0
+        elif keyed:
+            for handler, d, value in zip(handlers, columns, row):
+                handler.d = d
+                handler.add(value)
+        else:
+            for handler, value in zip(handlers, row):
+                handler.add(value)
+
+        if rows % STATS_ROWS == 0:
+            flush_stats()
+
+        timer.lap('accumulate')
+
+    timer.lap('parse')  # end of row_source
+
+    flush()
+    flush_stats()
+    if keyed:
+        # whole sheet / group stats, merged from time buckets if needed
+        totals = {}
+        if time_col is None:
+            totals = {key[0]: stats for key, (stats, columns, block) in groups.items()}
+        else:
+            data['buckets'] = {key: stats for key, (stats, columns, block) in groups.items()}
+            for (group, bucket), (stats, columns, block) in groups.items():
+                total = totals.get(group) or totals.setdefault(group, new_stats())
+                for field, d in stats.items():
+                    total[field].merge(d)
+        if key_cols:
+            data['fields'] = {}
+            data['groups'] = totals
+        else:
+            data['fields'] = totals.get(None) or new_stats()
+
+    assert sum(d.n+d.blank+d.bad for group, bucket, field, d
+               in iter_stats(data)) == rows * len(fields)
+    if opt.sample or opt.max_rows:
+        sample['sampled'] = rows
+        data['sample'] = sample
+    timer.lap('aggregate')
+
+    seconds = sum(timer.phases.values())
+    data['metrics'] = {
+        'engine': opt.engine,
+        'phases': dict(timer.phases),
+        'seconds': seconds,
+        'rows': rows,
+        'cells': rows * len(fields),
+        'rows_per_sec': rows / seconds if seconds else None,
+        'cells_per_sec': rows * len(fields) / seconds if seconds else None,
+        'peak_rss_mb': peak_rss(),
+    }
 
     return data
 
-def get_answers(opt=None, **kwargs):
-    """get_answers - process files
+_PROFILER = None  # cProfile.Profile for --profile, one per worker process
+
+def proc_task(task, opt):
+    """proc_task - proc_workbook() wrapper for the processor pool
+
+    :param tuple task: (filepath, shard)
+    :param argparse.Namespace opt: options
+    :return: (task, answers from proc_workbook(), metrics dict), the
+        metrics dict has a 'sheets' list of each sheet's metrics
+    """
+    global _PROFILER
+    filepath, shard = task
+    info = {'pid': os.getpid(), 'start': time.time(), 'sheets': []}
+    if opt.profile:
+        if _PROFILER is None:
+            _PROFILER = cProfile.Profile()
+        _PROFILER.enable()
+    answers = proc_workbook(filepath, opt, shard)
+    if opt.profile:
+        _PROFILER.disable()
+        # cumulative for this worker, rewritten after each task
+        _PROFILER.dump_stats(os.path.join(opt.profile, "worker-%d.prof" % info['pid']))
+    info['end'] = time.time()
+    for answer in answers or []:
+        info['sheets'].append(dict(answer.pop('metrics'), sheet=answer['sheet']))
+    return task, answers, info
+
+def available_cpus():
+    """available_cpus - number of CPUs this process can use, allowing for
+    CPU affinity and cgroup (container) CPU quotas
+
+    :return: int >= 1
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # Python 2, Windows, MacOS
+        cpus = multiprocessing.cpu_count()
+
+    quota = None
+    try:  # cgroup v2, "max 100000" or "150000 100000"
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            limit, period = cpu_max.read().split()[:2]
+        if limit != 'max':
+            quota = float(limit) / float(period)
+    except (IOError, OSError, ValueError):
+        try:  # cgroup v1, quota is -1 if not limited
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as cfs_quota:
+                limit = float(cfs_quota.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as cfs_period:
+                period = float(cfs_period.read())
+            if limit > 0:
+                quota = limit / period
+        except (IOError, OSError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, int(ceil(quota)))
+
+    return max(1, cpus)
+
+def get_work(filepath):
+    """get_work - estimate the work in processing a file, the compressed
+    size of its worksheets, from the zip directory
+
+    :param str filepath: path to file
+    :return: int bytes, 0 if not a readable zip
+    """
+    try:
+        with zipfile.ZipFile(filepath) as archive:
+            return sum(
+                info.compress_size for info in archive.infolist()
+                if info.filename.startswith('xl/worksheets/')
+            )
+    except (IOError, zipfile.BadZipfile):
+        return 0
+
+def imap_bounded(pool, func, tasks, window):
+    """imap_bounded - generator - like pool.imap(), results in task order,
+    but only submit tasks up to window ahead of the next result to be
+    yielded, so at most window results are held waiting for a slow one
+
+    :param multiprocessing.Pool pool: pool to use
+    :param function func: function to apply
+    :param iterable tasks: arguments for func
+    :param int window: max. tasks submitted but not yielded
+    """
+    tasks = iter(tasks)
+    pending = deque()
+    while True:
+        while len(pending) < window:
+            task = next(tasks, None)
+            if task is None:
+                break
+            pending.append(pool.apply_async(func, (task,)))
+        if not pending:
+            break
+        yield pending.popleft().get()
+
+class ResultCache(object):
+    """Persistent cache of proc_file() answers in an SQLite file, keyed
+    on the CRC32s and sizes of the relevant zip members, so checking the
+    cache only reads the zip directory, and a copy of a file under
+    another name still hits.  Field names which aren't JSON types, like
+    dates, are stored tagged, see CACHE_TYPES, answers with other field
+    names aren't cached, and are counted in skipped.
+    """
+    def __init__(self, path, max_age=None, max_size=None):
+        """
+        :param str path: path to SQLite file
+        :param float max_age: days after which unused entries are dropped
+        :param float max_size: megabytes beyond which least recently used
+            entries are dropped
+        """
+        self.max_age = max_age
+        self.max_size = max_size
+        self.hits = self.misses = self.skipped = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("""create table if not exists result (
+            key text primary key, answer text, used real, size integer)""")
+
+    @staticmethod
+    def get_key(filepath, opt):
+        """get_key - cache key for the --sheets of a file
+
+        :param str filepath: path to file
+        :param argparse.Namespace opt: options
+        :return: str key, or None if the file can't be read as a zip
+        """
+        try:
+            with zipfile.ZipFile(filepath) as archive:
+                members = sorted(
+                    (info.filename, info.CRC, info.file_size)
+                    for info in archive.infolist()
+                    if CACHE_MEMBERS.match(info.filename)
+                )
+        except (IOError, zipfile.BadZipfile):
+            return None
+        options = [getattr(opt, k) for k in CACHE_OPTIONS]
+        options.extend(bool(getattr(opt, k)) for k in CACHE_FLAGS)
+        key = [CACHE_VERSION, options, members, opt.sheets]
+        if opt.sample or opt.max_rows:  # each shard draws its own sample
+            key.append(max(1, opt.shards))
+        return sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+    def get(self, key, filepath):
+        """get - get a file's answers from the cache
+
+        :param str key: from get_key()
+        :param str filepath: path to file, answers are shared by copies
+        :return: answers as from proc_workbook(), or None
+        """
+        row = self.db.execute(
+            "select answer from result where key = ?", [key]).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute(
+            "update result set used = ? where key = ?", [time.time(), key])
+        return [self._load(stored, filepath)
+                for stored in json.loads(row[0], object_hook=self._decode)]
+
+    @staticmethod
+    def _load(stored, filepath):
+        """_load - answer from its JSON form, see _dump()"""
+        answer = {'filepath': filepath, 'sheet': stored['sheet'], 'fields': {}}
+        if 'groups' in stored:
+            answer['groups'] = {}
+        for group, field, state in stored['fields']:
+            d = ColumnStats()
+            d.__setstate__(state)
+            if group is None:
+                answer['fields'][field] = d
+            else:
+                answer['groups'].setdefault(tuple(group), {})[field] = d
+        if 'buckets' in stored:
+            answer['buckets'] = {}
+            for group, bucket, field, state in stored['buckets']:
+                d = ColumnStats()
+                d.__setstate__(state)
+                key = None if group is None else tuple(group), bucket
+                answer['buckets'].setdefault(key, {})[field] = d
+        if 'comoments' in stored:
+            answer['comoments'] = CoMoments()
+            answer['comoments'].__setstate__(stored['comoments'])
+        for k in 'sample', 'renamed':
+            if k in stored:
+                answer[k] = stored[k]
+        return answer
+
+    def put(self, key, answers):
+        """put - store a file's answers in the cache
+
+        :param str key: from get_key()
+        :param list answers: answers from proc_workbook()
+        """
+        try:
+            text = json.dumps([self._dump(answer) for answer in answers],
+                              default=self._encode)
+        except (TypeError, ValueError):  # a field name _encode() can't store
+            self.skipped += 1
+            return
+        self.db.execute(
+            "insert or replace into result values (?, ?, ?, ?)",
+            [key, text, time.time(), len(text)]
+        )
+        self.db.commit()  # keep results from interrupted runs
+
+    @staticmethod
+    def _encode(value):
+        """_encode - JSON form of a non-JSON field name, see CACHE_TYPES"""
+        for tag, (type_, formats) in CACHE_TYPES.items():
+            if value.__class__ is type_ and getattr(value, 'tzinfo', None) is None:
+                return {'__type__': tag, 'iso': value.isoformat()}
+        raise TypeError("%r is not JSON serializable" % (value,))
+
+    @staticmethod
+    def _decode(obj):
+        """_decode - field name from its _encode() form, other objects as is"""
+        if '__type__' not in obj:
+            return obj
+        type_, formats = CACHE_TYPES[obj['__type__']]
+        for format_ in formats:
+            try:
+                value = datetime.datetime.strptime(obj['iso'], format_)
+            except ValueError:
+                continue
+            if type_ is datetime.date:
+                return value.date()
+            if type_ is datetime.time:
+                return value.time()
+            return value
+        raise ValueError("bad cached %s %s" % (obj['__type__'], obj['iso']))
+
+    @staticmethod
+    def _dump(answer):
+        """_dump - JSON form of an answer, without its filepath"""
+        stored = {
+            'sheet': answer['sheet'],
+            'fields': [
+                # not key, list comprehensions leak names in Python 2
+                [group, field, d.__getstate__()]
+                for group, bucket, field, d in iter_stats(answer)
+            ],
+        }
+        if 'groups' in answer:
+            stored['groups'] = True
+        if 'buckets' in answer:
+            stored['buckets'] = [
+                [group, bucket, field, d.__getstate__()]
+                for group, bucket, field, d in iter_stats(answer, buckets=True)
+            ]
+        if 'comoments' in answer:
+            stored['comoments'] = answer['comoments'].__getstate__()
+        for k in 'sample', 'renamed':
+            if k in answer:
+                stored[k] = answer[k]
+        return stored
+
+    def close(self):
+        """close - drop old entries, save changes, and close"""
+        if self.max_age is not None:
+            self.db.execute("delete from result where used < ?",
+                [time.time() - self.max_age * 24 * 3600])
+        if self.max_size is not None:
+            total = 0
+            for key, size in self.db.execute(
+                "select key, size from result order by used desc").fetchall():
+                total += size
+                if total > self.max_size * 1024 * 1024:
+                    self.db.execute("delete from result where key = ?", [key])
+        self.db.commit()
+        self.db.close()
+
+def get_answers(opt=None, summary=None, **kwargs):
+    """get_answers - generator - process files, yielding answers as each
+    file is finished, or in input order if opt.ordered
 
     :param argparse.Namespace opt: options
-    :return: list of answers from proc_file
+    :param dict summary: if supplied, run summary info. is added to this
+        when the generator is exhausted
+    :return: answers from proc_file
     """
 
     if opt is None:  # API call rather than command line
-        opt = type("opt", (), kwargs)
+        opt = get_defaults(**kwargs)
+    if summary is None:
+        summary = {}
 
     # pass filenames through glob() to expand "2017_*.xlsx" etc.
     files = []
+    seen = set()  # files, for fast "in" with many files
     for filepath in opt.files:
-        files.extend(glob.glob(filepath))
-
-    # create a pool of processors
-    pool = multiprocessing.Pool(multiprocessing.cpu_count()-1)
+        for i in glob.glob(filepath):
+            if i not in seen:
+                seen.add(i)
+                files.append(i)
 
     # try/except isn't blocking float() TypeError in some files
     files = [i for i in files
              if "LOPC_2015-05-14_141710SEPMEP_Andrea.xlsx" not in i]
 
-    # process file list with processor pool
-    return pool.map(proc_file, files)
+    # answers from the cache, and keys for files not in the cache
+    cache = None
+    cached = {}
+    keys = {}
+    if opt.cache and not opt.no_cache:
+        cache = ResultCache(opt.cache, opt.cache_max_age, opt.cache_max_size)
+        for filepath in files:
+            keys[filepath] = cache.get_key(filepath, opt)
+            if keys[filepath] is not None:
+                answers = cache.get(keys[filepath], filepath)
+                if answers is not None:
+                    cached[filepath] = answers
+    todo = [i for i in files if i not in cached]
+
+    # create a pool of processors
+    processes = opt.jobs or available_cpus()
+    pool = multiprocessing.Pool(processes, maxtasksperchild=opt.max_tasks or None)
+    start = time.time()
+    workers = defaultdict(lambda: [0, 0., None])  # pid -> [tasks, busy seconds, peak RSS]
+    totals = defaultdict(int)  # rows, cells
+    metrics = open(opt.metrics, 'w') if opt.metrics else None
+    if opt.profile and not os.path.exists(opt.profile):
+        os.makedirs(opt.profile)
+
+    def write_metrics(**kwargs):
+        """write a line to --metrics"""
+        if metrics is not None:
+            metrics.write(json.dumps(kwargs, sort_keys=True) + '\n')
+            metrics.flush()
+
+    # process file list with processor pool, as shards if requested, each
+    # task does all the --sheets of a file, so it's only opened once
+    shards = max(1, opt.shards)
+    if not opt.ordered:
+        # largest first, so a big file doesn't start last and set the run time
+        todo.sort(key=get_work, reverse=True)
+    tasks = [(filepath, shard) for filepath in todo for shard in range(shards)]
+    func = partial(proc_task, opt=opt)
+    if opt.ordered:
+        results = imap_bounded(pool, func, tasks, 2 * processes * shards)
+    else:
+        results = pool.imap_unordered(func, tasks)
+
+    def finished():
+        """(filepath, answers) for each file as its last shard finishes,
+        answers is [None] if aborted
+        """
+        parts = defaultdict(list)
+        for (filepath, shard), answers, info in results:
+            sheets = info.pop('sheets')
+            worker = workers[info['pid']]
+            worker[0] += 1
+            worker[1] += info['end'] - info['start']
+            if sheets:
+                worker[2] = sheets[-1].get('peak_rss_mb')
+            for metrics in sheets or [{}]:
+                totals['rows'] += metrics.get('rows', 0)
+                totals['cells'] += metrics.get('cells', 0)
+                write_metrics(file=filepath, shard=shard, **dict(info, **metrics))
+            parts[filepath].append(answers)
+            if len(parts[filepath]) == shards:
+                merge_start = time.time()
+                answers = parts.pop(filepath)
+                if any(i is None for i in answers):
+                    yield filepath, [None]
+                    continue
+                answers = [merge_answers(list(sheet), opt.max_groups)
+                           for sheet in zip(*answers)]
+                if shards > 1:
+                    write_metrics(file=filepath,
+                                  merge_seconds=time.time()-merge_start)
+                if cache is not None and keys[filepath]:
+                    cache.put(keys[filepath], answers)
+                yield filepath, answers
+
+    def from_cache(filepath):
+        """a cached file's answers"""
+        for answer in cached.pop(filepath):
+            write_metrics(file=filepath, sheet=answer['sheet'], cached=True)
+            yield answer
+
+    completed = False
+    try:
+        if opt.ordered:
+            computed = finished()
+            for filepath in files:
+                if filepath in cached:
+                    for answer in from_cache(filepath):
+                        yield answer
+                else:
+                    for answer in next(computed)[1]:
+                        yield answer
+        else:
+            for filepath in list(cached):
+                for answer in from_cache(filepath):
+                    yield answer
+            for filepath, answers in finished():
+                for answer in answers:
+                    yield answer
+        completed = True
+    finally:
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+        if cache is not None:
+            cache.close()
+            summary['cache hits'] = cache.hits
+            summary['cache misses'] = cache.misses
+            summary['cache skipped'] = cache.skipped
+        if metrics is not None:
+            metrics.close()
+        summary['workers'] = processes
+        elapsed = max(time.time() - start, 1e-6)
+        for pid, (count, busy, rss) in workers.items():
+            summary['worker %d' % pid] = "%d tasks, %.1f seconds, %d%% busy%s" % (
+                count, busy, 100 * busy / elapsed,
+                '' if rss is None else ", %d MB peak" % rss)
+        summary['rows'] = totals['rows']
+        summary['cells'] = totals['cells']
+        summary['cells / second'] = int(totals['cells'] / elapsed)
+
+def get_fields(opt=None, buckets=False):
+    """get_fields - output table columns, FIELDS plus --quantiles
+
+    :param argparse.Namespace opt: options
+    :param bool buckets: columns for the --buckets table
+    :return: list of column names
+    """
+    fields = list(FIELDS)
+    if buckets:
+        fields.insert(fields.index('field'), 'bucket')
+    if opt is None:
+        return fields
+    if opt.group_by:
+        fields.insert(fields.index('field') - buckets, 'group')
+    if opt.quantiles:
+        fields.extend(quantile_name(float(i)) for i in split_names(opt.quantiles))
+    if opt.sample or opt.max_rows:
+        fields.extend(SAMPLE_FIELDS)
+    return fields
+
+def normal_quantile(p):
+    """normal_quantile - inverse of the standard normal CDF, by bisection
+
+    :param float p: probability, 0 < p < 1
+    :return: float z
+    """
+    low, high = -40., 40.
+    for _ in range(100):
+        mid = (low + high) / 2
+        if (1 + erf(mid / sqrt(2))) / 2 < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
 
-def get_table_rows(answers):
+def mean_interval(d, fraction, confidence=0.95):
+    """mean_interval - confidence interval for the mean of a field from
+    sampled rows, using the sample variance with a finite population
+    correction, so the interval is just the mean when all rows are read
+
+    :param ColumnStats d: stats for sampled rows
+    :param float fraction: fraction of rows sampled
+    :param float confidence: confidence level
+    :return: (low, high)
+    """
+    if fraction >= 1:
+        return d.mean, d.mean
+    if d.n < 2:
+        return NAN, NAN
+    half = normal_quantile(0.5 + confidence / 2) * d.std / sqrt(d.n) * sqrt(1 - fraction)
+    return d.mean - half, d.mean + half
+
+def get_table_rows(answers, header=True, fields=None, buckets=False,
+                   confidence=0.95):
     """get_table_rows - generator - convert get_answers() output to table format
 
     :param list answers: output from get_answers()
+    :param bool header: start with a row of column names
+    :param list fields: output columns, from get_fields(), default FIELDS
+    :param bool buckets: rows for --time-column buckets, see iter_stats()
+    :param float confidence: confidence level for SAMPLE_FIELDS
     :return: list of rows suitable for csv.writer
     """
-    yield FIELDS
+    if fields is None:
+        fields = FIELDS
+    if header:
+        yield fields
     for answer in answers:
-        for field in answer['fields']:
-            row = [answer['fields'][field][k] for k in FIELDS]
+        if answer is None:  # aborted by ./STOP
+            continue
+        sample = answer.get('sample')
+        fraction = 1.
+        if sample and sample['sampled'] < sample['rows']:
+            fraction = sample['sampled'] / float(sample['rows'])
+        for group, bucket, field, d in iter_stats(answer, buckets):
+            keys = {'file': answer['filepath'], 'sheet': answer['sheet'],
+                    'group': group_name(group), 'bucket': bucket_name(bucket),
+                    'field': field, 'sampled': fraction, 'estimate': fraction < 1}
+            if 'mean_low' in fields:
+                keys['mean_low'], keys['mean_high'] = mean_interval(
+                    d, fraction, confidence)
+            row = [keys[k] if k in keys else d[k] for k in fields]
             if PYTHON_2:
                 yield [unicode(col).encode('utf-8') for col in row]
             else:
                 yield row
 
-def main():
-    """main() - when invoked directly"""
-    opt = get_options()
+def get_value_fields(opt=None):
+    """get_value_fields - --values table columns, VALUE_FIELDS plus group
+
+    :param argparse.Namespace opt: options
+    :return: list of column names
+    """
+    fields = list(VALUE_FIELDS)
+    if opt is not None and opt.group_by:
+        fields.insert(fields.index('field'), 'group')
+    return fields
+
+def get_value_rows(answers, header=True, fields=None):
+    """get_value_rows - generator - --values table rows, a row for each of
+    the most common bad values in each field, or one row with no value
+    if the field has no bad values
+
+    :param list answers: output from get_answers()
+    :param bool header: start with a row of column names
+    :param list fields: output columns, from get_value_fields(), default
+        VALUE_FIELDS
+    :return: list of rows suitable for csv.writer
+    """
+    if fields is None:
+        fields = VALUE_FIELDS
+    if header:
+        yield fields
+    for answer in answers:
+        if answer is None:  # aborted by ./STOP
+            continue
+        for group, bucket, field, d in iter_stats(answer):
+            keys = {
+                'file': answer['filepath'], 'sheet': answer['sheet'],
+                'group': group_name(group), 'field': field, 'n': d.n, 'bad': d.bad,
+                'distinct': d.distinct.estimate if d.distinct is not None else '',
+                'distinct_bad':
+                    d.distinct_bad.estimate if d.distinct_bad is not None else '',
+            }
+            top = d.top.top() if d.top is not None else []
+            for keys['value'], keys['count'], keys['error'] in top or [('', '', '')]:
+                row = [keys[k] for k in fields]
+                if PYTHON_2:
+                    yield [unicode(col).encode('utf-8') for col in row]
+                else:
+                    yield row
 
+def get_matrix_rows(answers, header=True):
+    """get_matrix_rows - generator - --matrix .csv table rows, one for
+    each pair of --covariance fields, upper triangle including the
+    diagonal (variances)
+
+    :param list answers: output from get_answers()
+    :param bool header: start with a row of column names
+    :return: list of rows suitable for csv.writer
+    """
+    if header:
+        yield MATRIX_FIELDS
+    for answer in answers:
+        if answer is None or 'comoments' not in answer:
+            continue
+        comoments = answer['comoments']
+        cov, corr = comoments.covariance, comoments.correlation
+        for i, field in enumerate(comoments.fields):
+            for j in range(i, len(comoments.fields)):
+                row = [answer['filepath'], answer['sheet'], field,
+                       comoments.fields[j], comoments.n, cov[i, j], corr[i, j]]
+                if PYTHON_2:
+                    yield [unicode(col).encode('utf-8') for col in row]
+                else:
+                    yield row
+
+def save_matrices(path, answers):
+    """save_matrices - write --matrix .npz, with arrays files, sheets, and
+    for the i'th answer, fields_i, n_i, mean_i, covariance_i, and
+    correlation_i
+
+    :param str path: .npz file
+    :param list answers: answers with co-moments
+    """
+    arrays = {'files': [], 'sheets': []}
+    for i, answer in enumerate(answers):
+        comoments = answer['comoments']
+        arrays['files'].append(answer['filepath'])
+        arrays['sheets'].append(answer['sheet'])
+        arrays['fields_%d' % i] = np.array(comoments.fields, dtype='U')
+        arrays['n_%d' % i] = np.array(comoments.n)
+        arrays['mean_%d' % i] = comoments.mean
+        arrays['covariance_%d' % i] = comoments.covariance
+        arrays['correlation_%d' % i] = comoments.correlation
+    arrays['files'] = np.array(arrays['files'], dtype='U')
+    arrays['sheets'] = np.array(arrays['sheets'], dtype='U')
+    np.savez_compressed(path, **arrays)
+
+def merge_histograms(histograms, answer):
+    """merge_histograms - add an answer's histograms to combined
+    histograms for all files
+
+    :param dict histograms: {(group, field): Histogram}, updated
+    :param dict answer: answer from get_answers()
+    """
+    for group, bucket, field, d in iter_stats(answer):
+        if d.hist is None:
+            continue
+        if (group, field) in histograms:
+            histograms[(group, field)].merge(d.hist)
+        else:  # a copy, so merging doesn't alter answers
+            hist = Histogram.__new__(Histogram)
+            hist.__setstate__(d.hist.__getstate__())
+            histograms[(group, field)] = hist
+
+def get_histogram_rows(histograms, fields=None):
+    """get_histogram_rows - generator - --histograms table rows
+
+    :param dict histograms: from merge_histograms()
+    :param list fields: output columns, HISTOGRAM_FIELDS plus group
+    :return: list of rows suitable for csv.writer
+    """
+    if fields is None:
+        fields = HISTOGRAM_FIELDS
+    yield fields
+    for group, field in sorted(histograms, key=lambda k: (k[0] or (), k[1])):
+        keys = {'group': group_name(group), 'field': field}
+        for keys['lower'], keys['upper'], keys['count'] in histograms[(group, field)].rows():
+            row = [keys[k] for k in fields]
+            if PYTHON_2:
+                yield [unicode(col).encode('utf-8') for col in row]
+            else:
+                yield row
+
+def open_csv(path):
+    """open_csv - open a file for csv.writer"""
     # csv.writer does its own EOL handling,
     # see https://docs.python.org/3/library/csv.html#csv.reader
     if PYTHON_2:
-        output = open(opt.output, 'wb')
-    else:
-        output = open(opt.output, 'w', newline='')
+        return open(path, 'wb')
+    return open(path, 'w', newline='')
 
-    start = time.time()
-    with output as out:
+def main():
+    """main() - when invoked directly"""
+    opt = get_options()
+
+    # (file, csv.writer, get_rows(answers, header)) for each output table
+    outputs = []
+
+    def add_output(path, get_rows):
+        out = open_csv(path)
         writer = csv.writer(out)
-        for row in get_table_rows(get_answers(opt)):
-            writer.writerow(row)
+        writer.writerows(get_rows([]))
+        outputs.append((out, writer, get_rows))
+
+    add_output(opt.output, partial(get_table_rows, fields=get_fields(opt),
+                                   confidence=opt.confidence))
+    if opt.values:
+        add_output(opt.values,
+                   partial(get_value_rows, fields=get_value_fields(opt)))
+    if opt.buckets:
+        add_output(opt.buckets, partial(
+            get_table_rows, fields=get_fields(opt, buckets=True), buckets=True,
+            confidence=opt.confidence))
+    histograms = {}  # combined --histograms, written at the end
+    matrices = None  # answers for --matrix .npz, written at the end
+    if opt.matrix:
+        if opt.matrix.lower().endswith('.npz'):
+            matrices = []
+        else:
+            add_output(opt.matrix, get_matrix_rows)
+
+    start = time.time()
+    summary = {}
+    try:
+        # write each file as it's finished, so a partial run is still useful
+        for answer in get_answers(opt, summary=summary):
+            for out, writer, get_rows in outputs:
+                writer.writerows(get_rows([answer], header=False))
+                out.flush()
+            if opt.histograms and answer is not None:
+                merge_histograms(histograms, answer)
+            if matrices is not None and answer is not None:
+                matrices.append({k: answer[k] for k in ('filepath', 'sheet', 'comoments')})
+    finally:
+        for out, writer, get_rows in outputs:
+            out.close()
+    if matrices is not None:
+        save_matrices(opt.matrix, matrices)
+    if opt.histograms:
+        fields = list(HISTOGRAM_FIELDS)
+        if opt.group_by:
+            fields.insert(0, 'group')
+        with open_csv(opt.histograms) as out:
+            csv.writer(out).writerows(get_histogram_rows(histograms, fields))
+    for name in sorted(summary):
+        print("%s: %s" % (name, summary[name]))
     print("%d seconds" % (time.time()-start))
 
 if __name__ == '__main__':
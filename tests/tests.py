@@ -5,11 +5,16 @@ Terry N Brown, Brown.TerryN@epa.gov, Sun Jan  1 10:51:59 2017
 """
 
 import csv
+import io
 import os
+import pickle
+import re
 import shutil
+import sqlite3
 import sys
 import tempfile
 import unittest
+import zipfile
 
 from contextlib import contextmanager
 
@@ -85,6 +90,20 @@ class TestSheetStats(unittest.TestCase):
         if sheet_stats_dir not in sys.path:
             sys.path.append(sheet_stats_dir)
 
+    def assertAnswersClose(self, answer0, answer1):
+        """assertAnswersClose - check two answers from proc_file() have
+        the same stats, to float tolerance
+        """
+        import sheet_stats
+        self.assertEqual(set(answer0['fields']), set(answer1['fields']))
+        for field, d in answer0['fields'].items():
+            for param in sheet_stats.FIELDS[3:]:
+                a, b = d[param], answer1['fields'][field][param]
+                if a != a:  # NaN
+                    self.assertTrue(b != b, "%s %s" % (field, param))
+                else:
+                    self.assertTrue(isclose(a, b), "%s %s" % (field, param))
+
     def test_sheet_stats(self):
         """Test output from sheet_stats.py
 
@@ -122,9 +141,10 @@ class TestSheetStats(unittest.TestCase):
                     # check variance etc. only when blank == bad == 0
                     chk_variance = int(row[fields.index('blank')]) == 0 and \
                                    int(row[fields.index('bad')]) == 0
-                    # skip path and field name
-                    for parameter, value in zip(fields[2:], row[2:]):
-                        field = row[1].decode('utf-8') if PYTHON_2 else row[1]
+                    # skip path, sheet, and field name
+                    field = row[fields.index('field')]
+                    field = field.decode('utf-8') if PYTHON_2 else field
+                    for parameter, value in zip(fields[3:], row[3:]):
                         check = parameter in parameters  # skip blank, bad, etc.
                         check = check and (  # Excel include blanks in variance calc.,
                             chk_variance or  # so skip those cases
@@ -164,5 +184,1162 @@ class TestSheetStats(unittest.TestCase):
 
         self.assertEqual(checks, 90, "Expected 90 comparisons")
 
+    def test_verbose(self):
+        """Test proc_file() only prints progress with --verbose"""
+
+        import sheet_stats
+        filepath = os.path.join(self.test_file_dir, "test_one.xlsx")
+        for verbose in False, True:
+            out = io.BytesIO() if PYTHON_2 else io.StringIO()
+            stdout, sys.stdout = sys.stdout, out
+            try:
+                sheet_stats.proc_file(filepath, sheet_stats.get_defaults(verbose=verbose))
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(out.getvalue().split(), [filepath, '0'] if verbose else [])
+
+    def test_cache(self):
+        """Test --cache gives the same answers, and hits for copied files"""
+
+        import sheet_stats
+        with mk_temp_dir() as temp_dir:
+            shutil.copy(os.path.join(self.test_file_dir, "test_one.xlsx"),
+                        os.path.join(temp_dir, "copy.xlsx"))
+            files = [os.path.join(self.test_file_dir, "*.xlsx")]
+            cache = os.path.join(temp_dir, "cache.sqlite")
+            summaries = []
+            runs = []
+            for run_files in files, files, [os.path.join(temp_dir, "*.xlsx")]:
+                summaries.append({})
+                runs.append(sorted(
+                    sheet_stats.get_answers(
+                        files=run_files, cache=cache, summary=summaries[-1]),
+                    key=lambda answer: answer['filepath']
+                ))
+            hits = [(i['cache hits'], i['cache misses']) for i in summaries]
+            self.assertEqual(hits, [(0, 2), (2, 0), (1, 0)])
+            for answer0, answer1 in zip(runs[0], runs[1]):
+                self.assertEqual(answer0['filepath'], answer1['filepath'])
+                self.assertAnswersClose(answer0, answer1)
+            self.assertEqual(runs[2][0]['filepath'],
+                             os.path.join(temp_dir, "copy.xlsx"))
+            test_one = [i for i in runs[0] if i['filepath'].endswith('test_one.xlsx')]
+            self.assertAnswersClose(test_one[0], runs[2][0])
+
+            # non-string headers, cached as they are
+            import datetime
+            from openpyxl import Workbook
+            filepath = os.path.join(temp_dir, "dates.xlsx")
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['x', datetime.datetime(2017, 5, 14, 14, 17), 2017])
+            for i in range(10):
+                sheet.append([i, i * 2, i * 3])
+            book.save(filepath)
+            summaries = []
+            runs = []
+            for run in range(2):
+                summaries.append({})
+                runs.append(list(sheet_stats.get_answers(
+                    files=[filepath], cache=cache, summary=summaries[-1])))
+            hits = [(i['cache hits'], i['cache misses'], i['cache skipped'])
+                    for i in summaries]
+            self.assertEqual(hits, [(0, 1, 0), (1, 0, 0)])
+            self.assertEqual(set(runs[1][0]['fields']), set(
+                ['x', datetime.datetime(2017, 5, 14, 14, 17), 2017]))
+            self.assertAnswersClose(runs[0][0], runs[1][0])
+
+            # answers with field names it can't store aren't cached
+            results = sheet_stats.ResultCache(cache)
+            answer = runs[0][0]
+            answer['fields'] = {object(): answer['fields']['x']}
+            results.put('unstorable', [answer])
+            self.assertEqual(results.skipped, 1)
+            self.assertEqual(results.get('unstorable', filepath), None)
+            results.close()
+
+            # --shards changes results only with --sample / --max-rows
+            def key(**kwargs):
+                return sheet_stats.ResultCache.get_key(
+                    filepath, sheet_stats.get_defaults(**kwargs))
+            self.assertEqual(key(shards=1), key(shards=2))
+            self.assertNotEqual(key(max_rows=5, shards=1), key(max_rows=5, shards=2))
+            self.assertNotEqual(key(sample=0.5, shards=1), key(sample=0.5, shards=2))
+
+    def test_metrics(self):
+        """Test --metrics writes a JSON line for each file"""
+
+        import json
+        import sheet_stats
+        with mk_temp_dir() as temp_dir:
+            metrics = os.path.join(temp_dir, "metrics.jsonl")
+            list(sheet_stats.get_answers(
+                files=[os.path.join(self.test_file_dir, "*.xlsx")],
+                engine='xml', metrics=metrics
+            ))
+            with open(metrics) as lines:
+                metrics = [json.loads(line) for line in lines]
+        self.assertEqual(len(metrics), 2)
+        for metric in metrics:
+            self.assertEqual(metric['rows'], 20)
+            self.assertEqual(metric['cells'], 120)
+            self.assertEqual(
+                set(metric['phases']),
+                {'open', 'shared strings', 'parse', 'accumulate', 'aggregate'}
+            )
+
+    def test_ordered(self):
+        """Test --ordered gives answers in input order"""
+
+        import sheet_stats
+        files = [os.path.join(self.test_file_dir, i)
+                 for i in ("test_two.xlsx", "test_one.xlsx")]
+        answers = sheet_stats.get_answers(files=files, ordered=True, shards=2)
+        self.assertEqual([i['filepath'] for i in answers], files)
+
+    def test_engines(self):
+        """Test 'xml' engine output matches 'openpyxl' engine output"""
+
+        import sheet_stats
+        for filename in "test_one.xlsx", "test_two.xlsx":
+            filepath = os.path.join(self.test_file_dir, filename)
+            outputs = []
+            for engine in sheet_stats.ENGINES:
+                opt = sheet_stats.get_defaults(engine=engine)
+                answer = sheet_stats.proc_file(filepath, opt)
+                outputs.append([
+                    [str(col) for col in row]
+                    for row in sheet_stats.get_table_rows([answer])
+                ])
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_batch(self):
+        """Test numpy block accumulation matches cell by cell accumulation"""
+
+        import datetime
+        import sheet_stats
+        filepath = os.path.join(self.test_file_dir, "test_one.xlsx")
+        cell = sheet_stats.proc_file(filepath, sheet_stats.get_defaults())
+        # block size smaller than the sheet to test updates across blocks
+        block = sheet_stats.proc_file(
+            filepath, sheet_stats.get_defaults(batch=7))
+        self.assertAnswersClose(cell, block)
+        # output is identical, over several STATS_ROWS blocks
+        from benchmarks.generate import generate
+        with mk_temp_dir() as path:
+            generated = os.path.join(path, "batch.xlsx")
+            generate(generated, rows=2500, cols=3, blank=0.1, bad=0.05, seed=1)
+            outputs = [
+                list(sheet_stats.get_table_rows([sheet_stats.proc_file(
+                    generated, sheet_stats.get_defaults(batch=batch))]))
+                for batch in (0, 7, 1000)
+            ]
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertEqual(outputs[0], outputs[2])
+        # a bad value only sends itself down the generic path
+        x, blank, bad = sheet_stats.block_to_array(
+            [1, 2.5, None, 'n/a', ' ', '3', True, datetime.time(12)])
+        self.assertEqual(x[~(blank | bad)].tolist(), [1., 2.5, 3., 1.])
+        self.assertEqual(blank.tolist(), [False, False, True, False, True,
+                                          False, False, False])
+        self.assertEqual(bad.tolist(), [False, False, False, True, False,
+                                        False, False, True])
+
+    def test_aggregate(self):
+        """Test get_aggregate() from sums matches ColumnStats"""
+
+        import sheet_stats
+        filepath = os.path.join(self.test_file_dir, "test_one.xlsx")
+        answer = sheet_stats.proc_file(filepath)
+        for field, d in answer['fields'].items():
+            agg = sheet_stats.get_aggregate(d.sumsq, d.sum, d.n)
+            for param in 'mean', 'variance', 'std', 'coefvar':
+                self.assertTrue(isclose(getattr(agg, param), d[param]),
+                                "%s %s" % (field, param))
+        # rounding leaves sumsq - sum * mean below 0 for these
+        x = [0.1] * 3
+        self.assertEqual(sheet_stats.get_aggregate(
+            sum(i * i for i in x), sum(x), len(x)).variance, 0)
+        with self.assertRaises(KeyError):
+            d['file']
+        # slots only, and no buffered numbers left after proc_file()
+        self.assertFalse(hasattr(d, '__dict__'))
+        self.assertTrue(d.buffer is None)
+
+    def test_fields(self):
+        """Test --fields / --exclude select fields without changing stats"""
+
+        import sheet_stats
+        filepath = os.path.join(self.test_file_dir, "test_one.xlsx")
+        whole = sheet_stats.proc_file(filepath, sheet_stats.get_defaults())
+        for engine in sheet_stats.ENGINES:
+            opt = sheet_stats.get_defaults(
+                engine=engine, fields=['a,*field*'], exclude='space field')
+            answer = sheet_stats.proc_file(filepath, opt)
+            fields = set(answer['fields'])
+            self.assertEqual(len(fields), 2)
+            self.assertTrue('a' in fields)
+            whole['fields'] = {
+                k: v for k, v in whole['fields'].items() if k in fields}
+            self.assertAnswersClose(whole, answer)
+
+    def test_shards(self):
+        """Test merged shards match processing the file in one piece"""
+
+        import sheet_stats
+        filepath = os.path.join(self.test_file_dir, "test_one.xlsx")
+        whole = sheet_stats.proc_file(filepath, sheet_stats.get_defaults())
+        shard_rows = sheet_stats.SHARD_ROWS
+        sheet_stats.SHARD_ROWS = 3  # so all shards get some rows
+        try:
+            for engine in sheet_stats.ENGINES:
+                opt = sheet_stats.get_defaults(engine=engine, shards=3)
+                merged = sheet_stats.merge_answers([
+                    sheet_stats.proc_file(filepath, opt, shard)
+                    for shard in range(opt.shards)
+                ])
+                self.assertAnswersClose(whole, merged)
+            # rows may leave out r, shards mustn't renumber them
+            with mk_temp_dir() as path:
+                rless = os.path.join(path, "rless.xlsx")
+                with zipfile.ZipFile(filepath) as source, \
+                        zipfile.ZipFile(rless, 'w') as dest:
+                    for name in source.namelist():
+                        data = source.read(name)
+                        if name.startswith('xl/worksheets/'):
+                            data = re.sub(br'(<row) r="\d+"', br'\1', data)
+                        dest.writestr(name, data)
+                opt = sheet_stats.get_defaults(engine='xml', shards=3)
+                merged = sheet_stats.merge_answers([
+                    sheet_stats.proc_file(rless, opt, shard)
+                    for shard in range(opt.shards)
+                ])
+                self.assertAnswersClose(whole, merged)
+        finally:
+            sheet_stats.SHARD_ROWS = shard_rows
+
+        # only the rows not dropped reach the parser, whatever the chunk size
+        reader = sheet_stats.XLSXReader(filepath)
+        rows = list(reader.rows())
+        chunk = sheet_stats.RowFilter.CHUNK
+        try:
+            for sheet_stats.RowFilter.CHUNK in 7, 100, chunk:
+                dropped = list(reader.rows(drop=lambda position: position % 3 == 1))
+                self.assertEqual(dropped, [None if i % 3 == 1 else row
+                                           for i, row in enumerate(rows)])
+        finally:
+            sheet_stats.RowFilter.CHUNK = chunk
+            reader.close()
+        xml = (b'<x:worksheet xmlns:x="%s"><x:sheetData><x:row r="1"><x:c><x:v>1'
+               b'</x:v></x:c></x:row><x:row><x:c><x:v>2</x:v></x:c></x:row>'
+               b'<x:row r="4"/><x:row r=\'5\'><x:c><x:v>5</x:v></x:c></x:row>'
+               b'</x:sheetData><x:rowBreaks/></x:worksheet>'
+               % sheet_stats.SHEET_NS[1:-1].encode('ascii'))
+        for drop, expected in ((lambda position: False, [b'1', b'2', b'5']),
+                               (lambda position: position % 2, [b'1', b'5'])):
+            source = sheet_stats.RowFilter(io.BytesIO(xml), drop)
+            root = sheet_stats.ElementTree.fromstring(source.read())
+            self.assertEqual([i.text.encode('ascii') for i in root.iter(
+                sheet_stats.VALUE_TAG)], expected)
+            self.assertEqual(len(list(root.iter(sheet_stats.ROW_TAG))),
+                             len(expected) + (not drop(3)))
+
+    def test_sheets(self):
+        """Test --sheets processes each sheet as if it was the only one"""
+
+        import sheet_stats
+        from benchmarks.generate import generate
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "sheets.xlsx")
+            generate(filepath, rows=30, cols=3, sheets=3)
+            names = sheet_stats.get_sheet_names(filepath)
+            self.assertEqual(names, ['Sheet1', 'Sheet2', 'Sheet3'])
+            self.assertEqual(
+                sheet_stats.select_sheets(names, 'Sheet3,2,Sheet2,missing'),
+                ['Sheet3', 'Sheet2'])
+            for engine in sheet_stats.ENGINES:
+                opt = sheet_stats.get_defaults(engine=engine)
+                first = sheet_stats.proc_file(filepath, opt)
+                self.assertEqual(first['sheet'], 'Sheet1')
+                answers = list(sheet_stats.get_answers(
+                    files=[filepath], sheets='all', engine=engine, ordered=True))
+                self.assertEqual([i['sheet'] for i in answers], names)
+                self.assertAnswersClose(first, answers[0])
+                for answer in answers:
+                    self.assertAnswersClose(answer, sheet_stats.proc_file(
+                        filepath, opt, sheet=answer['sheet']))
+                # proc_workbook() opens the workbook once for all sheets
+                opened = []
+                get_workbook = sheet_stats.get_workbook
+                def counted(*args, **kwargs):
+                    if not sheet_stats._WORKBOOK:
+                        opened.append(args[0])
+                    return get_workbook(*args, **kwargs)
+                sheet_stats.get_workbook = counted
+                try:
+                    opt = sheet_stats.get_defaults(engine=engine, sheets='3,1')
+                    answers = sheet_stats.proc_workbook(filepath, opt)
+                finally:
+                    sheet_stats.get_workbook = get_workbook
+                self.assertEqual(opened, [filepath])
+                self.assertEqual([i['sheet'] for i in answers], ['Sheet3', 'Sheet1'])
+                self.assertAnswersClose(first, answers[1])
+                # proc_file() doesn't leave the workbook open
+                self.assertEqual(sheet_stats._WORKBOOK, {})
+                if os.path.isdir('/proc/self/fd'):
+                    self.assertNotIn(os.path.realpath(filepath), [
+                        os.path.realpath(os.path.join('/proc/self/fd', i))
+                        for i in os.listdir('/proc/self/fd')])
+
+    def test_quantiles(self):
+        """Test --quantiles, exact for small columns, close for merged
+        sketches of large ones
+        """
+
+        import numpy as np
+        import sheet_stats
+        filepath = os.path.join(self.test_file_dir, "test_one.xlsx")
+        for batch in 0, 7:
+            opt = sheet_stats.get_defaults(quantiles='0,50,100', batch=batch)
+            answer = sheet_stats.proc_file(filepath, opt)
+            rows = list(sheet_stats.get_table_rows(
+                [answer], fields=sheet_stats.get_fields(opt)))
+            self.assertEqual(rows[0][-3:], ['p0', 'p50', 'p100'])
+            for d in answer['fields'].values():
+                if d.n:
+                    self.assertEqual(d['p0'], d.min)
+                    self.assertEqual(d['p100'], d.max)
+
+        x = np.random.RandomState(0).normal(size=20000)
+        parts = []
+        for part in np.split(x, 4):
+            parts.append(sheet_stats.ColumnStats(sketch_k=100))
+            for value in part[:100]:
+                parts[-1].add(value)
+            parts[-1].add_array(part[100:])
+        d = parts[0]
+        for part in parts[1:]:
+            d.merge(part)
+        self.assertEqual(d.n, x.size)
+        ordered = np.sort(x)
+        for q in 5, 50, 95:
+            rank = np.searchsorted(ordered, d['p%d' % q]) / float(x.size)
+            self.assertTrue(abs(rank - q / 100.) < 0.02, (q, rank))
+
+    def test_values(self):
+        """Test --values distinct counts and most common bad values,
+        for whole files and merged shards
+        """
+
+        import numpy as np
+        import sheet_stats
+        from benchmarks.generate import generate
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "values.xlsx")
+            csv_path = os.path.join(path, "values.csv")
+            generate(filepath, rows=300, cols=3, bad=0.1, csv_path=csv_path)
+            with open(csv_path) as data:
+                reader = csv.reader(data)
+                fields = next(reader)
+                columns = list(zip(*reader))
+            for shards in 1, 2:
+                opt = sheet_stats.get_defaults(values='values.csv', shards=shards)
+                answer = sheet_stats.merge_answers([
+                    sheet_stats.proc_file(filepath, opt, shard)
+                    for shard in range(shards)
+                ])
+                for field, column in zip(fields, columns):
+                    d = answer['fields'][field]
+                    numbers, bad = set(), {}
+                    for value in column:
+                        try:
+                            numbers.add(float(value))
+                        except ValueError:
+                            if value:
+                                bad[value] = bad.get(value, 0) + 1
+                    # fewer bad values than --top-k, so counts are exact
+                    self.assertEqual(
+                        sorted((i[0], i[1]) for i in d.top.top()),
+                        sorted(bad.items()))
+                    self.assertEqual(d.distinct_bad.estimate, len(bad))
+                    # three standard errors
+                    error = 3 * 1.04 / np.sqrt(2 ** opt.distinct_precision)
+                    self.assertTrue(
+                        abs(d.distinct.estimate / float(len(numbers)) - 1) < error,
+                        (field, d.distinct.estimate, len(numbers)))
+            rows = list(sheet_stats.get_value_rows([answer]))
+            self.assertEqual(rows[0], sheet_stats.VALUE_FIELDS)
+
+            # counters survive --cache
+            cache = sheet_stats.ResultCache(os.path.join(path, "cache.sqlite"))
+            key = cache.get_key(filepath, opt)
+            cache.put(key, [answer])
+            cached, = cache.get(key, filepath)
+            cache.close()
+            for field in fields:
+                self.assertTrue((cached['fields'][field].distinct.registers ==
+                                 answer['fields'][field].distinct.registers).all())
+            self.assertEqual(list(sheet_stats.get_value_rows([cached])), rows)
+
+        # large counts, cell by cell and array updates agree and merge
+        x = np.random.RandomState(0).normal(size=50000)
+        whole = sheet_stats.DistinctCounter()
+        whole.add_array(x)
+        part = sheet_stats.DistinctCounter()
+        for value in x[:1000]:
+            part.add(float(value))
+        part.add_array(x[1000:])
+        self.assertTrue((whole.registers == part.registers).all())
+        self.assertTrue(abs(whole.estimate / 50000. - 1) < 0.05)
+        # worker results are pickled
+        copy = pickle.loads(pickle.dumps(whole, pickle.HIGHEST_PROTOCOL))
+        self.assertTrue((copy.registers == whole.registers).all())
+        self.assertEqual(copy.p, whole.p)
+
+        top = sheet_stats.TopValues(2)
+        for value in 'aaaabbbc':
+            top.add(value)
+        other = sheet_stats.TopValues(2)
+        for value in 'ccccca':
+            other.add(value)
+        self.assertEqual([i[0] for i in top.merge(other).top()], ['c', 'a'])
+
+    def test_group_by(self):
+        """Test --group-by stats match stats for each group's rows"""
+
+        import sheet_stats
+        from openpyxl import Workbook
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "groups.xlsx")
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['survey', 'leg', 'x', 'y'])
+            expected = {}
+            for i in range(60):
+                key = ('s%d' % (i % 2), str(i % 3))
+                row = [key[0], i % 3, i * 0.5, 'bad' if i % 7 == 0 else i]
+                sheet.append(row)
+                expected.setdefault(key, []).append(row)
+            book.save(filepath)
+
+            for engine in sheet_stats.ENGINES:
+                for batch in 0, 7:
+                    opt = sheet_stats.get_defaults(
+                        engine=engine, batch=batch, group_by='survey,leg',
+                        shards=2)
+                    answer = sheet_stats.merge_answers([
+                        sheet_stats.proc_file(filepath, opt, shard)
+                        for shard in range(opt.shards)
+                    ])
+                    self.assertEqual(answer['fields'], {})
+                    self.assertEqual(set(answer['groups']), set(expected))
+                    for key, rows in expected.items():
+                        stats = answer['groups'][key]
+                        self.assertEqual(set(stats), set(['x', 'y']))
+                        self.assertTrue(isclose(stats['x'].sum, sum(i[2] for i in rows)))
+                        self.assertEqual(stats['y'].bad, sum(1 for i in rows if i[3] == 'bad'))
+            rows = list(sheet_stats.get_table_rows(
+                [answer], fields=sheet_stats.get_fields(opt)))
+            self.assertEqual(rows[0][:4], ['file', 'sheet', 'group', 'field'])
+            self.assertEqual(len(rows), 1 + len(expected) * 2)
+
+            opt = sheet_stats.get_defaults(group_by='leg', max_groups=2)
+            self.assertRaises(ValueError, sheet_stats.proc_file, filepath, opt)
+
+            # memory per group and field is about what --max-groups says
+            import tracemalloc
+            filepath = os.path.join(path, "many.xlsx")
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['id', 'a', 'b', 'c', 'd'])
+            for i in range(2000):
+                sheet.append([i, i * 0.5, i * 1.5, 'bad' if i % 7 else i, None])
+            book.save(filepath)
+            opt = sheet_stats.get_defaults(group_by='id')
+            tracemalloc.start()
+            try:
+                answer = sheet_stats.proc_file(filepath, opt)
+                used = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(len(answer['groups']), 2000)
+            self.assertTrue(used < 2000 * 4 * 400, used / 2000. / 4)
+
+            # each shard has 3 groups, merged they have 6
+            filepath = os.path.join(path, "stripes.xlsx")
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['stripe', 'x'])
+            for i in range(60):
+                sheet.append([i // 10, i])
+            book.save(filepath)
+            shard_rows = sheet_stats.SHARD_ROWS
+            sheet_stats.SHARD_ROWS = 10
+            try:
+                opt = sheet_stats.get_defaults(group_by='stripe', max_groups=3,
+                                               shards=2)
+                answers = [sheet_stats.proc_file(filepath, opt, shard)
+                           for shard in range(opt.shards)]
+                self.assertEqual([len(i['groups']) for i in answers], [3, 3])
+                self.assertRaises(ValueError, sheet_stats.merge_answers,
+                                  answers, opt.max_groups)
+            finally:
+                sheet_stats.SHARD_ROWS = shard_rows
+
+    def test_buckets(self):
+        """Test --time-column buckets, for out of order rows"""
+
+        import datetime
+        import random
+        import sheet_stats
+        from openpyxl import Workbook
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "times.xlsx")
+            start = datetime.datetime(2017, 5, 14, 14, 17)
+            rows = [[start + datetime.timedelta(seconds=30 * i), i, i * 2.]
+                    for i in range(40)]
+            random.Random(1).shuffle(rows)
+            rows.append([None, 100, 100.])
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['UTC', 'x', 'y'])
+            for row in rows:
+                sheet.append(row)
+            # serial date numbers as well as datetimes
+            sheet.cell(row=2, column=1).value = \
+                (rows[0][0] - datetime.datetime(1899, 12, 30)).total_seconds() / 86400
+            book.save(filepath)
+
+            whole = sheet_stats.proc_file(filepath, sheet_stats.get_defaults(
+                exclude='UTC'))
+            for engine in sheet_stats.ENGINES:
+                for batch in 0, 7:
+                    opt = sheet_stats.get_defaults(
+                        engine=engine, batch=batch, time_column='UTC',
+                        buckets='buckets.csv', bucket=300)
+                    answer = sheet_stats.proc_file(filepath, opt)
+                    self.assertAnswersClose(whole, answer)
+                    sums = {}
+                    for group, bucket, field, d in sheet_stats.iter_stats(
+                            answer, buckets=True):
+                        if field == 'x':
+                            sums[sheet_stats.bucket_name(bucket)] = d.sum
+                    self.assertEqual(sums, {
+                        '': 100,
+                        '2017-05-14T14:15:00': sum(range(0, 6)),
+                        '2017-05-14T14:20:00': sum(range(6, 16)),
+                        '2017-05-14T14:25:00': sum(range(16, 26)),
+                        '2017-05-14T14:30:00': sum(range(26, 36)),
+                        '2017-05-14T14:35:00': sum(range(36, 40)),
+                    })
+            table = list(sheet_stats.get_table_rows(
+                [answer], fields=sheet_stats.get_fields(opt, buckets=True),
+                buckets=True))
+            self.assertEqual(table[0][:4], ['file', 'sheet', 'bucket', 'field'])
+            self.assertEqual(len(table), 1 + 6 * 2)
+
+            # time of day cells, read as datetime.time
+            filepath = os.path.join(path, "time_of_day.xlsx")
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['UTC', 'x'])
+            for i in range(20):
+                sheet.append([datetime.time(14, 17 + i // 2, 30 * (i % 2)), i])
+            book.save(filepath)
+            for engine in sheet_stats.ENGINES:
+                answer = sheet_stats.proc_file(filepath, sheet_stats.get_defaults(
+                    engine=engine, time_column='UTC', buckets='buckets.csv',
+                    bucket=300))
+                sums = dict((sheet_stats.bucket_name(bucket), d.sum)
+                            for group, bucket, field, d
+                            in sheet_stats.iter_stats(answer, buckets=True))
+                self.assertEqual(sums, {
+                    '1899-12-30T14:15:00': sum(range(0, 6)),
+                    '1899-12-30T14:20:00': sum(range(6, 16)),
+                    '1899-12-30T14:25:00': sum(range(16, 20)),
+                }, engine)
+
+            # many small buckets don't keep numbers buffered to the end
+            filepath = os.path.join(path, "small_buckets.xlsx")
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['UTC', 'x', 'y'])
+            for i in range(300):
+                sheet.append([start + datetime.timedelta(seconds=10 * i), i, 'y'])
+            book.save(filepath)
+            live = []  # ColumnStats given numbers
+            buffered = []  # numbers buffered for all of them, after each add
+            add, add_array = sheet_stats.ColumnStats.add, sheet_stats.ColumnStats.add_array
+
+            def track(method):
+                def tracked(self, x):
+                    method(self, x)
+                    live.append(self)
+                    buffered.append(sum(len(d.buffer) for d in set(live) if d.buffer))
+                return tracked
+
+            stats_rows = sheet_stats.STATS_ROWS
+            sheet_stats.STATS_ROWS = 10
+            sheet_stats.ColumnStats.add = track(add)
+            sheet_stats.ColumnStats.add_array = track(add_array)
+            try:
+                for batch in 0, 7:
+                    del live[:], buffered[:]
+                    answer = sheet_stats.proc_file(filepath, sheet_stats.get_defaults(
+                        batch=batch, time_column='UTC', buckets='buckets.csv',
+                        bucket=30))
+                    self.assertEqual(len(answer['buckets']), 100)
+                    self.assertTrue(max(buffered) <= 10, max(buffered))
+            finally:
+                sheet_stats.STATS_ROWS = stats_rows
+                sheet_stats.ColumnStats.add = add
+                sheet_stats.ColumnStats.add_array = add_array
+
+    def test_covariance(self):
+        """Test --covariance matches numpy for complete cases, with
+        blocks, shards, and the .npz and .csv outputs
+        """
+
+        import numpy as np
+        import sheet_stats
+        from openpyxl import Workbook
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "cov.xlsx")
+            rand = np.random.RandomState(2)
+            x = rand.normal(size=(50, 3))
+            x[:, 1] += x[:, 0]
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['x1um', 'x2um', 'x3um', 'other'])
+            complete = []
+            for i, row in enumerate(x.tolist()):
+                if i % 9 == 0:
+                    row[i % 3] = 'n/a' if i % 2 else None
+                else:
+                    complete.append(row)
+                sheet.append(row + [i])
+            book.save(filepath)
+            expected = np.cov(np.array(complete), rowvar=False)
+
+            sheet_stats.COMOMENT_ROWS, comoment_rows = 4, sheet_stats.COMOMENT_ROWS
+            try:
+                for batch, shards in (0, 1), (7, 1), (0, 2):
+                    opt = sheet_stats.get_defaults(
+                        covariance=['*um'], matrix='m.npz', batch=batch,
+                        shards=shards)
+                    answer = sheet_stats.merge_answers([
+                        sheet_stats.proc_file(filepath, opt, shard)
+                        for shard in range(shards)
+                    ])
+                    comoments = answer['comoments']
+                    self.assertEqual(comoments.fields, ['x1um', 'x2um', 'x3um'])
+                    self.assertEqual(comoments.n, len(complete))
+                    self.assertTrue(np.allclose(comoments.covariance, expected))
+            finally:
+                sheet_stats.COMOMENT_ROWS = comoment_rows
+            self.assertTrue(np.allclose(
+                comoments.correlation, np.corrcoef(np.array(complete), rowvar=False)))
+
+            rows = list(sheet_stats.get_matrix_rows([answer]))
+            self.assertEqual(rows[0], sheet_stats.MATRIX_FIELDS)
+            self.assertEqual(len(rows), 1 + 6)
+            npz = os.path.join(path, "matrix.npz")
+            sheet_stats.save_matrices(npz, [answer])
+            saved = np.load(npz)
+            self.assertEqual(list(saved['fields_0']), comoments.fields)
+            self.assertTrue(np.allclose(saved['covariance_0'], expected))
+
+    def test_histograms(self):
+        """Test --histograms fixed and auto bins count every number once,
+        with blocks, shards, and merging auto bins of different widths
+        """
+
+        import numpy as np
+        import sheet_stats
+        from openpyxl import Workbook
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "hist.xlsx")
+            rand = np.random.RandomState(3)
+            x = rand.exponential(10, size=300)
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['x', 'other'])
+            for i, value in enumerate(x.tolist()):
+                sheet.append([value if i % 11 else 'n/a', i])
+            book.save(filepath)
+            numbers = np.array([v for i, v in enumerate(x.tolist()) if i % 11])
+
+            edges = [0, 5, 10, 20, 40]
+            expected = np.histogram(numbers, bins=edges)[0].tolist()
+            for batch, shards in (0, 1), (7, 1), (0, 3):
+                for args in ({'hist_edges': '0,5,10,20,40'},
+                             {'hist_bins': 10, 'hist_pilot': 20}):
+                    opt = sheet_stats.get_defaults(
+                        histograms='h.csv', hist_fields=['x'], batch=batch,
+                        shards=shards, **args)
+                    answer = sheet_stats.merge_answers([
+                        sheet_stats.proc_file(filepath, opt, shard)
+                        for shard in range(shards)
+                    ])
+                    self.assertIsNone(answer['fields']['other'].hist)
+                    rows = list(answer['fields']['x'].hist.rows())
+                    self.assertEqual(sum(r[2] for r in rows), len(numbers))
+                    if 'hist_edges' in args:
+                        self.assertEqual([r[2] for r in rows[:4]], expected)
+                        self.assertEqual(rows[-1][:2], (40, np.inf))
+                        self.assertEqual(rows[-1][2], (numbers > 40).sum())
+                    else:
+                        for lower, upper, count in rows:
+                            self.assertEqual(count, ((numbers >= lower) & (numbers < upper)).sum())
+
+            fine = sheet_stats.Histogram(bins=1000, pilot=10)
+            coarse = sheet_stats.Histogram(bins=2, pilot=10)
+            fine.add_array(numbers[:150])
+            for value in numbers[150:].tolist():
+                coarse.add(value)
+            self.assertLess(fine.power, coarse.power)
+            fine.merge(coarse)
+            self.assertEqual(fine.power, coarse.power)
+            self.assertEqual(sum(r[2] for r in fine.rows()), len(numbers))
+            with self.assertRaises(ValueError):
+                sheet_stats.Histogram(edges=[0, 1]).merge(sheet_stats.Histogram())
+
+            # add() buffers values, counts match add_array() and pickling
+            y = rand.normal(size=3 * sheet_stats.HIST_BUFFER + 5)
+            for kwargs in {'edges': [-1, 0, 1]}, {'bins': 10, 'pilot': 50}:
+                one = sheet_stats.Histogram(**kwargs)
+                for value in y.tolist():
+                    one.add(value)
+                copy = pickle.loads(pickle.dumps(one, pickle.HIGHEST_PROTOCOL))
+                whole = sheet_stats.Histogram(**kwargs)
+                whole.add_array(y[:50])
+                whole.add_array(y[50:])
+                self.assertEqual(list(copy.rows()), list(whole.rows()))
+                self.assertEqual(list(one.rows()), list(whole.rows()))
+
+            histograms = {}
+            sheet_stats.merge_histograms(histograms, answer)
+            sheet_stats.merge_histograms(histograms, answer)
+            rows = list(sheet_stats.get_histogram_rows(histograms))
+            self.assertEqual(rows[0], sheet_stats.HISTOGRAM_FIELDS)
+            self.assertEqual(sum(int(r[3]) for r in rows[1:]), 2 * len(numbers))
+            self.assertEqual(sum(r[2] for r in answer['fields']['x'].hist.rows()), len(numbers))
+
+    def test_sample(self):
+        """Test --sample picks the same rows for any engine or --shards,
+        --max-rows keeps at most N rows, and both mark estimates
+        """
+
+        import sheet_stats
+        from benchmarks.generate import generate
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "sample.xlsx")
+            generate(filepath, rows=2000, cols=3, blank=0.1, bad=0.05, seed=4)
+            full = sheet_stats.proc_file(filepath, sheet_stats.get_defaults(engine='xml'))
+
+            def run(**kwargs):
+                opt = sheet_stats.get_defaults(**kwargs)
+                answer = sheet_stats.merge_answers([
+                    sheet_stats.proc_file(filepath, opt, shard)
+                    for shard in range(opt.shards)
+                ])
+                return answer, list(sheet_stats.get_table_rows(
+                    [answer], header=False, fields=sheet_stats.get_fields(opt)))
+
+            expected = None
+            for engine in sheet_stats.ENGINES:
+                for shards, batch in (1, 0), (3, 0), (1, 64):
+                    answer, rows = run(sample=0.2, engine=engine, shards=shards, batch=batch)
+                    self.assertEqual(answer['sample']['rows'], 2000)
+                    self.assertTrue(300 < answer['sample']['sampled'] < 500)
+                    stats = sorted((field, d.n, d.blank, d.bad)
+                                   for field, d in answer['fields'].items())
+                    if expected is None:
+                        expected = stats
+                    self.assertEqual(stats, expected)
+            fields = sheet_stats.get_fields(sheet_stats.get_defaults(sample=0.2))
+            for row in rows:
+                self.assertEqual(str(row[fields.index('estimate')]), 'True')
+                low, mean, high = [float(row[fields.index(k)])
+                                   for k in ('mean_low', 'mean', 'mean_high')]
+                self.assertTrue(low < mean < high)
+
+            # --max-rows is split between shards, so make shards the same size
+            sheet_stats.SHARD_ROWS, shard_rows = 100, sheet_stats.SHARD_ROWS
+            try:
+                for shards in 1, 2:
+                    answer, rows = run(max_rows=100, shards=shards, engine='xml')
+                    self.assertEqual(answer['sample'], {'rows': 2000, 'sampled': 100})
+                    for d in answer['fields'].values():
+                        self.assertEqual(d.n + d.blank + d.bad, 100)
+            finally:
+                sheet_stats.SHARD_ROWS = shard_rows
+
+            answer, rows = run(max_rows=5000)
+            for row in rows:
+                self.assertEqual(str(row[fields.index('estimate')]), 'False')
+                self.assertEqual(row[fields.index('mean_low')], row[fields.index('mean')])
+            for field, d in answer['fields'].items():
+                self.assertTrue(isclose(d.sum, full['fields'][field].sum))
+
+            reservoir = sheet_stats.RowReservoir(5, seed=1)
+            for position in range(1000):
+                if reservoir.wanted(position):
+                    reservoir.add(position, position)
+            self.assertEqual(len(set(reservoir.rows)), 5)
+
+    def test_datetimes(self):
+        """Test per column cell handlers match the generic path, cell by
+        cell and in blocks, with --datetimes bad or numeric
+        """
+
+        import datetime
+        import sheet_stats
+        from openpyxl import Workbook
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "datetimes.xlsx")
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['when', 'mixed', 'text'])
+            start = datetime.datetime(2020, 1, 1)
+            for i in range(100):
+                sheet.append([
+                    start + datetime.timedelta(hours=i) if i % 7 else None,
+                    # runs of text and numbers re-profile the column
+                    'n/a' if 20 <= i < 60 or i % 9 == 0 else i * 0.5,
+                    ' ' if i % 5 == 0 else 'x%d' % (i % 3) if i % 4 else '%d' % i,
+                ])
+            book.save(filepath)
+
+            for datetimes in 'bad', 'numeric':
+                expected = None
+                for engine in sheet_stats.ENGINES:
+                    for batch in 0, 16:
+                        opt = sheet_stats.get_defaults(
+                            engine=engine, batch=batch, datetimes=datetimes)
+                        answer = sheet_stats.proc_file(filepath, opt)
+                        stats = {field: (d.n, d.blank, d.bad, round(d.sum, 6))
+                                 for field, d in answer['fields'].items()}
+                        if expected is None:
+                            expected = stats
+                        self.assertEqual(stats, expected)
+                # the generic path, by hand
+                rows = list(sheet_stats.read_rows_openpyxl(filepath))
+                for col, field in enumerate(rows[0]):
+                    values = [sheet_stats.cell_number(row[col], datetimes) for row in rows[1:]]
+                    self.assertEqual(expected[field][:3], (
+                        sum(1 for i in values if i is not None and i is not sheet_stats.BAD),
+                        values.count(None),
+                        sum(1 for i in values if i is sheet_stats.BAD),
+                    ))
+                when = answer['fields']['when']
+                if datetimes == 'bad':
+                    self.assertEqual((when.n, when.bad), (0, 85))
+                else:
+                    self.assertEqual((when.n, when.bad), (85, 0))
+                    self.assertTrue(isclose(when.min, 43831.))
+            self.assertEqual(sheet_stats.excel_number(datetime.time(18)), 0.75)
+
+    def test_scan_xlsx(self):
+        """Test scan_xlsx reads field names like openpyxl, keeps the error
+        labels, and doesn't scan files already in its journal
+        """
+
+        import datetime
+        import scan_xlsx
+        from openpyxl import Workbook
+        with mk_temp_dir() as path:
+            good = os.path.join(self.test_file_dir, "test_one.xlsx")
+            dated = os.path.join(path, "dated.xlsx")
+            book = Workbook()
+            book.active.append([' depth ', datetime.datetime(2017, 1, 3), 7])
+            book.active.append(['x', 'y', 'z'])
+            book.save(dated)
+            empty = os.path.join(path, "empty.xlsx")
+            Workbook().save(empty)
+            bad = os.path.join(path, "bad.xlsx")
+            with open(bad, 'w') as out:
+                out.write("not a zip file")
+            removed = os.path.join(path, "removed.xlsx")
+            # zips which aren't readable .xlsx files
+            partless = os.path.join(path, "partless.xlsx")
+            truncated = os.path.join(path, "truncated.xlsx")
+            corrupt = os.path.join(path, "corrupt.xlsx")
+            badindex = os.path.join(path, "badindex.xlsx")
+            # an invalid deflate block type in the worksheet, so zlib.error
+            shutil.copy(good, corrupt)
+            with zipfile.ZipFile(good) as source:
+                offset = source.getinfo('xl/worksheets/sheet1.xml').header_offset
+            with open(corrupt, 'r+b') as out:
+                out.seek(offset + 26)  # name and extra lengths
+                lengths = bytearray(out.read(4))
+                out.seek(lengths[0] + 256 * lengths[1] + lengths[2] + 256 * lengths[3], 1)
+                out.write(b'\xff' * 8)
+            with zipfile.ZipFile(partless, 'w') as out:
+                out.writestr('xl/other.xml', '<other/>')
+            # writestr() updates the ZipInfos, so each copy opens good again
+            for copy, edit in (
+                    (truncated, lambda data: data[:data.index(b'<row') + 10]),
+                    (badindex, lambda data: data.replace(b'<v>0</v>', b'<v>999</v>', 1))):
+                with zipfile.ZipFile(good) as source:
+                    with zipfile.ZipFile(copy, 'w') as out:
+                        for info in source.infolist():
+                            data = source.read(info.filename)
+                            if info.filename.startswith('xl/worksheets/'):
+                                data = edit(data)
+                            out.writestr(info, data)
+            files = [good, dated, empty, bad, removed, partless, truncated,
+                     corrupt, badindex]
+
+            journal = os.path.join(path, "xlsx.jsonl")
+            results = scan_xlsx.scan(files[:3], journal, jobs=2)
+            with open(journal, 'a') as out:
+                out.write('{"file": "interrupted')  # partial line
+            results = scan_xlsx.scan(files, journal, jobs=2)
+
+            sheet = load_workbook(good, read_only=True).worksheets[0]
+            expected = [i.value.strip() for i in next(sheet.iter_rows())]
+            fields = {k: v['fields'] for k, v in results.items()}
+            self.assertEqual(fields[good], expected)
+            self.assertEqual(fields[dated], ['depth', '2017-01-03 00:00:00', 7])
+            self.assertEqual(fields[empty], [scan_xlsx.NO_ROWS])
+            self.assertEqual(fields[bad], [scan_xlsx.BAD_ZIPFILE])
+            self.assertEqual(fields[removed], [scan_xlsx.FILE_REMOVED])
+            self.assertEqual(fields[partless], [scan_xlsx.BAD_XLSX])
+            self.assertEqual(fields[truncated], [scan_xlsx.BAD_XLSX])
+            self.assertEqual(fields[corrupt], [scan_xlsx.BAD_XLSX])
+            self.assertEqual(fields[badindex], [scan_xlsx.BAD_XLSX])
+
+            with open(journal) as lines:
+                self.assertEqual(len(lines.readlines()), 10)
+            self.assertEqual(scan_xlsx.scan(files, journal), results)
+            with open(journal) as lines:
+                self.assertEqual(len(lines.readlines()), 10)
+
+            # a changed file is scanned again
+            book = Workbook()
+            book.active.append(['Zug_DW', 'ZugDW2', 'Depth'])
+            book.save(dated)
+            os.utime(dated, (0, 12345))
+            results = scan_xlsx.scan(files, journal, jobs=1)
+            self.assertEqual(results[dated]['fields'], ['Zug_DW', 'ZugDW2', 'Depth'])
+            with open(journal) as lines:
+                self.assertEqual(len(lines.readlines()), 11)
+
+    def test_header_index(self):
+        """Test the field name index updates only changed files, and finds
+        names exactly, by prefix, and fuzzily
+        """
+
+        import scan_xlsx
+        with mk_temp_dir() as path:
+            index = scan_xlsx.HeaderIndex(os.path.join(path, "index.db"))
+            entries = [
+                {'file': 'a.xlsx', 'mtime': 1., 'size': 10,
+                 'fields': ['ZugDW', 'Depth', None, 'Temp']},
+                {'file': 'b.xlsx', 'mtime': 1., 'size': 10,
+                 'fields': ['Zug_DW', 'depth ']},
+                {'file': 'c.xlsx', 'mtime': 1., 'size': 10,
+                 'fields': [scan_xlsx.BAD_ZIPFILE]},
+            ]
+            self.assertEqual(index.update(entries), 3)
+            self.assertEqual(index.update(entries), 0)
+
+            def files(name, match):
+                return [(i[0], i[1], i[2]) for i in index.query(name, match)]
+
+            self.assertEqual(files('ZugDW', 'exact'), [('ZugDW', 'a.xlsx', 0)])
+            self.assertEqual(files('zug dw', 'fuzzy'),
+                             [('ZugDW', 'a.xlsx', 0), ('Zug_DW', 'b.xlsx', 0)])
+            self.assertEqual(files('ZgDW', 'fuzzy'), files('zug dw', 'fuzzy'))
+            self.assertEqual(files('de', 'prefix'),
+                             [('Depth', 'a.xlsx', 1), ('depth ', 'b.xlsx', 1)])
+            self.assertEqual(files(scan_xlsx.BAD_ZIPFILE, 'exact'), [])
+
+            entries[1] = {'file': 'b.xlsx', 'mtime': 2., 'size': 10,
+                          'fields': ['Depth', 'Zug_DW']}
+            self.assertEqual(index.update(entries), 1)
+            self.assertEqual(files('zugdw', 'fuzzy'),
+                             [('ZugDW', 'a.xlsx', 0), ('Zug_DW', 'b.xlsx', 1)])
+
+            opt = scan_xlsx.get_options(['--index', 'x', '--query', 'zugdw',
+                                         '--mapping', 'ZugDW'])
+            self.assertEqual(list(scan_xlsx.get_query_rows(index, opt)), [
+                "    %r: 'ZugDW',  # 1 files" % u'ZugDW',
+                "    %r: 'ZugDW',  # 1 files" % u'Zug_DW',
+            ])
+            opt.mapping, opt.files = None, True
+            self.assertEqual(list(scan_xlsx.get_query_rows(index, opt)),
+                             ['a.xlsx', 'b.xlsx'])
+            index.close()
+
+    def test_db2xlsx_backends(self):
+        """Test db2xlsx_compare runs offline against the SQLite stand-in,
+        with parameters, pooled connections, and cached results
+        """
+
+        import db2xlsx_compare
+        import sheet_stats
+        from openpyxl import Workbook
+        fixture = os.path.join(self.test_file_dir, "nearshore_fixture.json")
+        with mk_temp_dir() as path:
+            queries = os.path.join(path, "queries")
+            backend = db2xlsx_compare.SQLiteBackend(fixture, size=2)
+            measures = db2xlsx_compare.get_measures(backend, 11, 1, queries)
+            self.assertEqual([i['measure_name'] for i in measures['items']], ['Temp'])
+            stats = db2xlsx_compare.get_db_stats(backend, 13, 1, queries)
+            temp = [i for i in stats['items'] if i['field'] == 'Temp'][0]
+            self.assertEqual((temp['n'], temp['min'], temp['max']), (4, 18.25, 20.0))
+            self.assertEqual(backend.pool.opened, 1)
+            backend.close()
+            # a failed connect doesn't use up the pool
+            attempts = []
+            def connect():
+                attempts.append(None)
+                if len(attempts) == 1:
+                    raise IOError("no DB")
+                return sqlite3.connect(':memory:')
+            pool = db2xlsx_compare.ConnectionPool(connect, size=1)
+            with self.assertRaises(IOError):
+                with pool.connection():
+                    pass
+            self.assertEqual(pool.opened, 0)
+            with pool.connection() as conn:
+                self.assertEqual(conn.execute("select 1").fetchone(), (1,))
+            pool.close()
+            self.assertEqual(
+                db2xlsx_compare.inline_params(
+                    "where a = :survey and b = :name and c = '12:30'",
+                    {'survey': 13, 'name': "O'Brien"}),
+                "where a = 13 and b = 'O''Brien' and c = '12:30'")
+
+            # sheet_stats.py output for a leg matching the fixture
+            xl_file = os.path.join(path, "GB_Leg1.xlsx")
+            book = Workbook()
+            sheet = book.active
+            sheet.append(['Temp', 'ZugDW', '105um', 'DDLat', 'DDLong', 'Depth',
+                          'Design_km', 'UTC'])
+            for i, (temp, zug, um) in enumerate(zip(
+                    [18.25, 18.5, 19.125, 20.0], [0.5, 1.25, 2.0, 0.75],
+                    [10.0, 12.0, 11.0, 9.0])):
+                sheet.append([temp, zug, um, 44.5 + i * 0.01, -88.0 - i * 0.01,
+                              5.0 + i, 1.5 * i, 40400.5 + i * 0.001])
+            book.save(xl_file)
+            stats_csv = os.path.join(path, "stats.csv")
+            answer = sheet_stats.proc_file(xl_file)
+            renamed = sheet_stats.proc_file(xl_file, sheet_stats.get_defaults(
+                rename=['Temp=T,UTC=UTC_Time'], negate=['Depth']))
+            self.assertEqual(sorted(renamed['fields']), sorted(
+                ['T', 'ZugDW', '105um', 'DDLat', 'DDLong', 'Depth', 'Design_km',
+                 'UTC_Time']))
+            self.assertEqual(renamed['renamed'], {'T': ['Temp'], 'UTC_Time': ['UTC']})
+            depth = renamed['fields']['Depth']
+            self.assertEqual((depth.min, depth.max), (-8.0, -5.0))
+            with open(stats_csv, 'wb' if PYTHON_2 else 'w') as out:
+                csv.writer(out).writerows(sheet_stats.get_table_rows([answer]))
+
+            output = os.path.join(path, "match_errors.csv")
+            args = ['--backend', 'sqlite', '--fixture', fixture, '--stats', stats_csv,
+                    '--queries', queries, '--output', output]
+            # --jobs unset, one comparing process, all CPUs for --integrated
+            self.assertIsNone(db2xlsx_compare.get_options(args).jobs)
+            leg_to_xlsx = db2xlsx_compare.LEG_TO_XLSX
+            db2xlsx_compare.LEG_TO_XLSX = {(13, 1): xl_file}
+            try:
+                db2xlsx_compare.main(args)
+                with open(output) as errors:
+                    self.assertEqual(len(list(csv.reader(errors))), 1)
+                # an empty DB, so results must come from the cache
+                empty = os.path.join(path, "empty.json")
+                with open(empty, 'w') as out:
+                    out.write('{}')
+                args[args.index(fixture)] = empty
+                db2xlsx_compare.main(args)
+                with open(output) as errors:
+                    self.assertEqual(len(list(csv.reader(errors))), 1)
+                answer['fields']['Temp'].max = 21.0
+                with open(stats_csv, 'wb' if PYTHON_2 else 'w') as out:
+                    csv.writer(out).writerows(sheet_stats.get_table_rows([answer]))
+                db2xlsx_compare.main(args)
+                with open(output) as errors:
+                    rows = list(csv.DictReader(errors))
+                self.assertEqual([(i['xl_field'], i['stat'], i['xl_val'], i['db_val'])
+                                  for i in rows], [('Temp', 'max', '21.0', '20.0')])
+                # legs compared in parallel, survey 11 has no sheet_stats.py output
+                db2xlsx_compare.LEG_TO_XLSX[(11, 1)] = os.path.join(path, "LE_Leg1.xlsx")
+                db2xlsx_compare.main(args + ['--jobs', '2', '--report'])
+                with open(output) as errors:
+                    rows = list(csv.DictReader(errors))
+                self.assertEqual([i['stat'] for i in rows[-1:]], ['max'])
+                self.assertEqual(set((i['survey'], i['db_field'], i['stat']) for i in rows[:-1]),
+                                 set(('11', i, 'missing in other')
+                                     for i in ['Temp'] + db2xlsx_compare.EXTRA_FIELDS))
+                # stats straight from the XLSX file, not the edited .csv
+                db2xlsx_compare.main(args + ['--integrated'])
+                with open(output) as errors:
+                    rows = list(csv.DictReader(errors))
+                self.assertEqual(set((i['survey'], i['stat']) for i in rows),
+                                 set([('11', 'missing in other')]))
+                # mismatches report XLSX column names, not DB field names
+                stats = {'n': 4, 'min': 1.0, 'max': 2.0, 'mean': 1.5}
+                errors, lines = db2xlsx_compare.compare_leg((
+                    13, 1, xl_file, {'UTC_Time': stats}, {},
+                    {'UTC_Time': dict(stats, max=3.0)}, {'UTC_Time': 'UTC'}))
+                self.assertEqual([(i.xl_field, i.db_field, i.stat) for i in errors
+                                  if i.stat != 'missing in other'],
+                                 [('UTC', 'UTC_Time', 'max')])
+                self.assertIn("UTC -> UTC_Time:", '\n'.join(lines))
+            finally:
+                db2xlsx_compare.LEG_TO_XLSX = leg_to_xlsx
+
+    def test_lazy_strings(self):
+        """Test on demand shared strings give the same rows as the list"""
+
+        import sheet_stats
+        from benchmarks.generate import generate
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "strings.xlsx")
+            generate(filepath, rows=50, cols=4, strings=0.5)
+            for filepath in filepath, os.path.join(self.test_file_dir, "test_one.xlsx"):
+                eager = list(sheet_stats.read_rows_xml(filepath))
+                lazy = list(sheet_stats.read_rows_xml(filepath, lazy_strings=True))
+                self.assertEqual(eager, lazy)
+
+    def test_generate(self):
+        """Test stats for a generated workbook match its CSV reference"""
+
+        import sheet_stats
+        from benchmarks.generate import generate
+        with mk_temp_dir() as path:
+            filepath = os.path.join(path, "generated.xlsx")
+            csv_path = os.path.join(path, "generated.csv")
+            generate(filepath, rows=200, cols=5, blank=0.1, bad=0.05,
+                     strings=0.3, seed=1, csv_path=csv_path)
+            expected = {}
+            with open(csv_path) as data:
+                reader = csv.reader(data)
+                fields = next(reader)
+                values = {k: [] for k in fields}
+                for row in reader:
+                    for field, value in zip(fields, row):
+                        values[field].append(value)
+            for engine in sheet_stats.ENGINES:
+                opt = sheet_stats.get_defaults(engine=engine)
+                answer = sheet_stats.proc_file(filepath, opt)
+                for field in fields:
+                    d = answer['fields'][field]
+                    numbers = []
+                    for value in values[field]:
+                        try:
+                            numbers.append(float(value))
+                        except ValueError:
+                            pass
+                    blank = sum(1 for i in values[field] if not i)
+                    self.assertEqual(d['n'], len(numbers))
+                    self.assertEqual(d['blank'], blank)
+                    self.assertEqual(d['bad'], len(values[field]) - len(numbers) - blank)
+                    self.assertTrue(isclose(d['sum'], sum(numbers)))
+                    self.assertEqual(d['max'], max(numbers))
+
 if __name__ == '__main__':
     unittest.main()